@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Benchmark of the averaging of the digitizer records.
+
+Compare the throughput of `AverageReducer`, which accumulates the raw
+samples as integers and scales the result once, with the previous
+reduction of the drivers, which added the sum of each buffer to a float64
+average.
+
+Usage::
+
+    python benchmarks/bench_average.py [--records N] [--samples N]
+
+"""
+import argparse
+
+import numpy as np
+
+from exopy_hqc_legacy.instruments.drivers.acquisition_tools import (
+    AverageReducer)
+from bench_utils import timeit, print_table
+
+
+def legacy_average(buffers, samples):
+    """Average of the records as computed by the previous drivers.
+
+    """
+    average = np.zeros(samples)
+    count = 0
+    for records in buffers:
+        average += np.sum(records, 0)
+        count += len(records)
+    return average/count
+
+
+def reducer_average(buffers, samples):
+    """Average of the records computed by an AverageReducer.
+
+    """
+    reducer = AverageReducer(1, samples)
+    start = 0
+    for records in buffers:
+        reducer.reduce(0, records, start)
+        start += len(records)
+    return reducer.result(0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--records', type=int, default=500,
+                        help='number of records per buffer')
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--buffers', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for dtype in (np.uint16, np.int16):
+        info = np.iinfo(dtype)
+        buffers = [rng.integers(info.min, info.max, (args.records,
+                                                     args.samples),
+                                dtype=dtype)
+                   for _ in range(args.buffers)]
+        nbytes = sum(b.nbytes for b in buffers)
+        t_old, old = timeit(lambda: legacy_average(buffers, args.samples))
+        t_new, new = timeit(lambda: reducer_average(buffers, args.samples))
+        np.testing.assert_allclose(new, old, rtol=1e-12)
+        rows.append([np.dtype(dtype).name, '%.2f GB/s' % (nbytes/t_old/1e9),
+                     '%.2f GB/s' % (nbytes/t_new/1e9)])
+
+    print('%d buffers of %d records x %d samples (single thread)' %
+          (args.buffers, args.records, args.samples))
+    print_table(['samples', 'float64 average', 'AverageReducer'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Benchmark of the chunked demodulation used by DemodSPTask.
+
+Compare the duration and the peak memory of `demodulate` and
+`demodulate_periods` with the previous implementation of DemodSPTask, which
+multiplied the full record array by the cosine and sine and took the means.
+
+Usage::
+
+    python benchmarks/bench_demodulation.py [--records N] [--samples N]
+
+"""
+import argparse
+
+import numpy as np
+
+from exopy_hqc_legacy.utils.demodulation import (demodulation_kernel,
+                                                 demodulate,
+                                                 demodulate_periods)
+from bench_utils import timeit, peak_memory, print_table
+
+
+def legacy_demodulate(records, freq, num_loop):
+    """Per record quadratures as computed by the previous DemodSPTask.
+
+    """
+    ntraces, nsamples = np.shape(records)
+    ch = records.reshape(ntraces//num_loop, num_loop, nsamples)
+    phi = np.linspace(0, 2*np.pi*freq*((nsamples-1)*2e-9), nsamples)
+    ch_i = 2*np.mean(ch*np.cos(phi), axis=2)
+    ch_q = 2*np.mean(ch*np.sin(phi), axis=2)
+    return ch_i + 1j*ch_q
+
+
+def legacy_demodulate_periods(records, freq, samples_per_period, num_loop):
+    """Per period quadratures as computed by the previous DemodSPTask (ref2
+    trace mode).
+
+    """
+    ntraces, nsamples = np.shape(records)
+    phi = np.linspace(0, 2*np.pi*freq*((nsamples-1)*2e-9), nsamples)
+    shape = (ntraces//num_loop, num_loop, nsamples//samples_per_period,
+             samples_per_period)
+    ch_i = 2*np.mean((records*np.cos(phi)).reshape(shape), axis=3)
+    ch_q = 2*np.mean((records*np.sin(phi)).reshape(shape), axis=3)
+    return ch_i + 1j*ch_q
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--num-loop', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    sampling_rate = 500e6
+    freq = 50e6
+    samples_per_period = int(sampling_rate/freq)
+    nsamples = args.samples - args.samples % samples_per_period
+    rng = np.random.default_rng(0)
+    records = rng.normal(0, 1000, (args.records, nsamples)).astype(np.float32)
+    kernel = demodulation_kernel(freq, sampling_rate, nsamples)
+
+    cases = [
+        ('per record', lambda: legacy_demodulate(records, freq,
+                                                 args.num_loop),
+         lambda: demodulate(records, kernel, args.num_loop)),
+        ('per period',
+         lambda: legacy_demodulate_periods(records, freq, samples_per_period,
+                                           args.num_loop),
+         lambda: demodulate_periods(records, kernel, samples_per_period,
+                                    args.num_loop)),
+    ]
+
+    print('%d records x %d float32 samples' % (args.records, nsamples))
+    rows = []
+    for name, legacy, new in cases:
+        t_old, old = timeit(legacy)
+        t_new, res = timeit(new)
+        np.testing.assert_allclose(res, old, rtol=1e-6, atol=1e-6)
+        rows.append([name, '%.3f s' % t_old,
+                     '%.1f MB' % (peak_memory(legacy)/1e6),
+                     '%.3f s' % t_new, '%.1f MB' % (peak_memory(new)/1e6)])
+    print_table(['quadratures', 'old time', 'old peak', 'new time',
+                 'new peak'], rows)
+
+
+if __name__ == '__main__':
+    main()
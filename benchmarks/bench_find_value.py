@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Benchmark of the lookup of a value in a column by ArrayFindValueTask.
+
+Compare the cost of building a `SortedIndex` and of looking values up in it
+with the scan by blocks of `find_first` and the previous `np.where` over the
+whole column, on sorted and random data.
+
+Usage::
+
+    python benchmarks/bench_find_value.py [--rows N] [--lookups N]
+
+"""
+import argparse
+
+import numpy as np
+
+from exopy_hqc_legacy.tasks.tasks.util.array_tasks import (SortedIndex,
+                                                           find_first,
+                                                           MATCH_TOLERANCE)
+from bench_utils import timeit, print_table
+
+
+def legacy_find(data, value):
+    """Lookup as performed before, on the whole column.
+
+    """
+    return int(np.where(np.abs(data - value) < MATCH_TOLERANCE)[0][0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=10**6,
+                        help='number of rows of the column')
+    parser.add_argument('--lookups', type=int, default=100,
+                        help='number of values looked up')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for name, data in (('sorted', np.linspace(0, 1, args.rows)),
+                       ('random', rng.standard_normal(args.rows))):
+        values = data[rng.integers(0, args.rows, args.lookups)]
+        t_build, index = timeit(lambda: SortedIndex(data))
+        t_index, r_index = timeit(lambda: [index.find_first(v)
+                                           for v in values])
+        t_scan, r_scan = timeit(lambda: [find_first(data, v)
+                                         for v in values])
+        t_where, r_where = timeit(lambda: [legacy_find(data, v)
+                                           for v in values])
+        assert r_index == r_scan == r_where
+        rows.append([name, '%.1f ms' % (t_build*1e3),
+                     '%.1f us' % (t_index/args.lookups*1e6),
+                     '%.2f ms' % (t_scan/args.lookups*1e3),
+                     '%.2f ms' % (t_where/args.lookups*1e3)])
+
+    print('Lookups in a column of %d float64 (time per lookup)' % args.rows)
+    print_table(['data', 'index build', 'indexed', 'block scan', 'np.where'],
+                rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Benchmark of the writing of traces in a HDF5 file.
+
+Compare the previous behavior of the HDF5 saving (automatic chunks, datasets
+extended by one row and file flushed at each call) with tuned chunks, a
+geometric growth of the datasets and the rows staged by `_HDF5BatchWriter`,
+for several compression filters.
+
+Usage::
+
+    python benchmarks/bench_hdf5.py [--calls N] [--samples N]
+
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from exopy_hqc_legacy.tasks.tasks.util.save_tasks import (_HDF5File,
+                                                          _HDF5BatchWriter,
+                                                          _chunk_shape,
+                                                          HDF5_GROWTH)
+from bench_utils import print_table
+
+
+def row_by_row(path, trace, calls, chunks, growth, compress=None,
+               shuffle=False):
+    """Write each trace in its own call, flushing the file after each one.
+
+    A growth of 1 extends the dataset by a single row when it is full.
+
+    """
+    length = len(trace)
+    options = dict(compression=compress) if compress else {}
+    with h5py.File(path, 'w', libver='latest') as f:
+        d = f.create_dataset('trace', (1, length), maxshape=(None, length),
+                             dtype=trace.dtype, chunks=chunks,
+                             shuffle=shuffle, **options)
+        start = time.perf_counter()
+        for i in range(calls):
+            if d.shape[0] <= i:
+                d.resize((max(i + 1, int(d.shape[0]*growth)), length))
+            d[i] = trace
+            f.flush()
+        d.resize((calls, length))
+        duration = time.perf_counter() - start
+    return duration
+
+
+def staged(path, trace, calls, rows, compress='None', shuffle=False):
+    """Write the traces through a `_HDF5BatchWriter`.
+
+    """
+    length = len(trace)
+    f = _HDF5File(path, 'w', libver='latest')
+    chunks = _chunk_shape((length,), trace.itemsize, rows)
+    f.create_dataset('trace', (1, length), (None, length), trace.dtype,
+                     compress, chunks, shuffle)
+    f.attrs['count_calls'] = 0
+    f.writer = _HDF5BatchWriter(f, OrderedDict(trace=(length,)), trace.dtype,
+                                rows, 1)
+    start = time.perf_counter()
+    for i in range(calls):
+        f.writer.append({'trace': trace})
+    f.close()
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calls', type=int, default=2000,
+                        help='number of traces to write')
+    parser.add_argument('--samples', type=int, default=10000,
+                        help='number of points of a trace')
+    parser.add_argument('--rows', type=int, default=100,
+                        help='number of rows written at once when staging')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    x = np.arange(args.samples)
+    trace = (np.sin(x/7.)*0.1 +
+             rng.normal(0, 0.01, args.samples)).astype('float32')
+    tuned = _chunk_shape((args.samples,), trace.itemsize, args.rows)
+
+    cases = [
+        ('auto chunks, +1 row', row_by_row, (True, 1)),
+        ('auto chunks, +1 row, gzip', row_by_row, (True, 1, 'gzip')),
+        ('tuned chunks, growth', row_by_row, (tuned, HDF5_GROWTH)),
+        ('tuned chunks, growth, gzip', row_by_row,
+         (tuned, HDF5_GROWTH, 'gzip')),
+        ('tuned chunks, growth, shuffle+lzf', row_by_row,
+         (tuned, HDF5_GROWTH, 'lzf', True)),
+        ('staged', staged, (args.rows,)),
+        ('staged, gzip', staged, (args.rows, 'gzip')),
+        ('staged, shuffle+gzip', staged, (args.rows, 'gzip', True)),
+        ('staged, shuffle+lzf', staged, (args.rows, 'lzf', True)),
+    ]
+
+    directory = tempfile.mkdtemp()
+    rows = []
+    try:
+        for name, writer, options in cases:
+            path = os.path.join(directory, 'bench.h5')
+            duration = writer(path, trace, args.calls, *options)
+            with h5py.File(path, 'r') as f:
+                assert f['trace'].shape == (args.calls, args.samples)
+                np.testing.assert_array_equal(f['trace'][-1], trace)
+            rows.append([name, '%.0f' % (args.calls/duration),
+                         '%.1f' % (os.path.getsize(path)/2**20)])
+    finally:
+        shutil.rmtree(directory)
+
+    print('%d traces of %d float32 points' % (args.calls, args.samples))
+    print_table(['writing', 'calls/s', 'size (MiB)'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Helpers shared by the benchmarks.
+
+"""
+import time
+import tracemalloc
+
+
+def timeit(func, repeat=3):
+    """Best duration in seconds of several calls of a function.
+
+    Returns
+    -------
+    duration : float
+        Duration of the fastest call.
+
+    result :
+        Value returned by the last call.
+
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_memory(func):
+    """Peak of the memory allocated by a call of a function, in bytes.
+
+    numpy reports its allocations to tracemalloc, so the temporary arrays are
+    accounted for.
+
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def print_table(header, rows):
+    """Print rows of values aligned in columns.
+
+    """
+    rows = [header] + [[str(v) for v in row] for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)))
@@ -0,0 +1,825 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Tools shared by the digitizer drivers to process acquired buffers.
+
+The acquisition thread of a driver should only wait for buffers and hand them
+back to the board. The reduction of the data (averaging, copying the records,
+...) is delegated to a pool of workers through a `BufferPipeline`.
+
+:Contains:
+    AcquisitionStats :
+        Counters describing the last acquisition performed by a driver.
+    ScaledArray :
+        Raw samples along with the scaling converting them to physical units.
+    AverageReducer :
+        Reducer summing the records of each channel.
+    RecordsReducer :
+        Reducer copying each record in a preallocated array.
+    CallbackReducer :
+        Reducer handing the records to a user provided callable.
+    DemodReducer :
+        Reducer demodulating each record as soon as it is acquired.
+    SaturationMonitor :
+        Detection of the clipped records while buffers are reduced.
+    SaturationReport :
+        Summary of the clipping detected during an acquisition.
+    BufferPipeline :
+        Pool of workers used to reduce the buffers.
+    WaitStrategy :
+        Polling strategy used while waiting for the board.
+    ParallelAcquisition :
+        Synchronized acquisition on several boards.
+
+"""
+import time
+from functools import partial
+from threading import Lock, Barrier, BrokenBarrierError
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from .driver_tools import InstrIOError
+
+
+class AcquisitionStats(object):
+    """Counters describing an acquisition.
+
+    Attributes
+    ----------
+    buffers : int
+        Number of buffers which have been acquired.
+
+    bytes : int
+        Number of bytes transferred from the board.
+
+    overruns : int
+        Number of times the board was left without any buffer to fill because
+        all buffers were still being reduced.
+
+    wait_time : float
+        Time spent by the acquisition thread waiting for the board (s).
+
+    transfer_time : float
+        Time spent by the acquisition thread transferring data from the
+        board (s).
+
+    polls : int
+        Number of times the board was polled while waiting.
+
+    reduce_time : float
+        Cumulated time spent by the workers reducing buffers (s).
+
+    elapsed : float
+        Total duration of the acquisition (s).
+
+    """
+    def __init__(self):
+        self.buffers = 0
+        self.bytes = 0
+        self.overruns = 0
+        self.wait_time = 0.0
+        self.transfer_time = 0.0
+        self.polls = 0
+        self.reduce_time = 0.0
+        self.elapsed = 0.0
+        self._lock = Lock()
+
+    @property
+    def throughput(self):
+        """Average transfer rate during the acquisition in bytes/s.
+
+        """
+        return self.bytes/self.elapsed if self.elapsed else 0.0
+
+    def add_reduce_time(self, duration):
+        """Add time spent reducing a buffer (can be called from any thread).
+
+        """
+        with self._lock:
+            self.reduce_time += duration
+
+    def as_dict(self):
+        """Summarize the counters in a dictionary.
+
+        """
+        return {'buffers': self.buffers, 'bytes': self.bytes,
+                'overruns': self.overruns, 'wait_time': self.wait_time,
+                'transfer_time': self.transfer_time, 'polls': self.polls,
+                'reduce_time': self.reduce_time, 'elapsed': self.elapsed,
+                'throughput': self.throughput}
+
+    def __repr__(self):
+        return ('AcquisitionStats(' +
+                ', '.join('%s=%s' % i for i in sorted(self.as_dict().items()))
+                + ')')
+
+
+class ScaledArray(object):
+    """Raw samples along with the scaling converting them to physical units.
+
+    The conversion is performed only when the data are accessed, so that the
+    user can decide when to pay for it. Indexing returns the converted
+    selection as a numpy array, which allows to convert large arrays by
+    chunks.
+
+    Parameters
+    ----------
+    raw : np.ndarray
+        Raw integer samples.
+
+    scale : float, optional
+        Factor by which to multiply the raw samples.
+
+    offset : float, optional
+        Offset to add to the scaled samples.
+
+    dtype : np.dtype, optional
+        Type of the converted data.
+
+    """
+    def __init__(self, raw, scale=1.0, offset=0.0, dtype=np.float64):
+        self.raw = raw
+        self.scale = scale
+        self.offset = offset
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        """Shape of the underlying array.
+
+        """
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        """Number of dimensions of the underlying array.
+
+        """
+        return self.raw.ndim
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        return self._convert(self.raw[key], self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        return self._convert(self.raw, dtype or self.dtype)
+
+    def astype(self, dtype):
+        """Convert the samples to physical units in an array of given type.
+
+        """
+        return self._convert(self.raw, dtype)
+
+    def reshape(self, *shape):
+        """Reshape the underlying array without converting it.
+
+        """
+        return type(self)(self.raw.reshape(*shape), self.scale, self.offset,
+                          self.dtype)
+
+    def _convert(self, raw, dtype):
+        """Convert raw samples performing a single copy.
+
+        """
+        out = np.array(raw, dtype=dtype)
+        if self.scale != 1:
+            out *= self.scale
+        if self.offset:
+            out += self.offset
+        return out
+
+
+class AverageReducer(object):
+    """Sum the records of each channel and average them at the end.
+
+    Integer records are accumulated as integers, the conversion to float and
+    the scaling are performed only once when the result is requested.
+
+    Parameters
+    ----------
+    channel_count : int
+        Number of channels being acquired.
+
+    samples_per_record : int
+        Number of samples in a record.
+
+    scale : float, optional
+        Factor by which to multiply the averaged raw values.
+
+    offset : float, optional
+        Offset to add to the scaled averaged values.
+
+    """
+    def __init__(self, channel_count, samples_per_record, scale=1.0,
+                 offset=0.0):
+        self.scale = scale
+        self.offset = offset
+        self._samples = samples_per_record
+        self._sums = [None]*channel_count
+        self._counts = [0]*channel_count
+        self._lock = Lock()
+
+    def reduce(self, channel, records, start):
+        """Add the records (2D array) of a channel to the running sum.
+
+        """
+        # The partial sum is computed outside the lock so that several
+        # workers can process buffers simultaneously.
+        partial = np.sum(records, 0, dtype=_sum_dtype(records))
+        with self._lock:
+            if self._sums[channel] is None:
+                dtype = (np.int64 if partial.dtype.kind in 'iu'
+                         else np.float64)
+                self._sums[channel] = np.zeros(self._samples, dtype=dtype)
+            self._sums[channel] += partial
+            self._counts[channel] += len(records)
+
+    def result(self, channel):
+        """Averaged record of a channel.
+
+        """
+        count = self._counts[channel]
+        if not count:
+            return np.zeros(self._samples)
+        return self._sums[channel]*(self.scale/count) + self.offset
+
+
+class RecordsReducer(object):
+    """Copy the records of each channel in a preallocated array.
+
+    Parameters
+    ----------
+    channel_count : int
+        Number of channels being acquired.
+
+    records : int
+        Total number of records expected per channel.
+
+    samples_per_record : int
+        Number of samples in a record.
+
+    stored : list, optional
+        Booleans indicating for which channels the records should be stored.
+        By default all channels are stored.
+
+    dtype : np.dtype, optional
+        Type of the array in which to store the records. The conversion is
+        performed during the copy.
+
+    """
+    def __init__(self, channel_count, records, samples_per_record,
+                 stored=None, dtype=np.float64):
+        stored = stored if stored is not None else [True]*channel_count
+        self._data = [np.empty((records, samples_per_record), dtype=dtype)
+                      if s else None for s in stored]
+
+    def reduce(self, channel, records, start):
+        """Copy the records at the right position.
+
+        Different buffers never overlap so no locking is necessary.
+
+        """
+        self._data[channel][start:start+len(records)] = records
+
+    def result(self, channel):
+        """Array of all the records of a channel.
+
+        """
+        return self._data[channel]
+
+
+class CallbackReducer(object):
+    """Hand the records to a user provided callable.
+
+    Parameters
+    ----------
+    callback : callable
+        Callable taking as argument the index of the channel, the records
+        as a 2D array and the index of the first record in the capture. It is
+        called from the worker threads and must not keep a reference to the
+        records array which is reused as soon as the call returns.
+
+    """
+    def __init__(self, callback):
+        self._callback = callback
+
+    def reduce(self, channel, records, start):
+        """Call the user callback.
+
+        """
+        self._callback(channel, records, start)
+
+    def result(self, channel):
+        """The callback is responsible for storing the data.
+
+        """
+        return None
+
+
+class DemodReducer(object):
+    """Demodulate the records of each channel as they are acquired.
+
+    The channels for which no kernel is provided are handed to another
+    reducer.
+
+    Parameters
+    ----------
+    kernels : list
+        Demodulation kernel of each channel. A kernel is an array of shape
+        (samples, 2) containing the weights used to compute the two
+        quadratures, only the first samples of each record are used. None
+        indicates that the channel should not be demodulated.
+
+    records : int
+        Total number of records expected per channel.
+
+    fallback : object, optional
+        Reducer to use for the channels without kernel.
+
+    """
+    def __init__(self, kernels, records, fallback=None):
+        self._kernels = kernels
+        self._fallback = fallback
+        self._data = [np.empty((records, 2)) if k is not None else None
+                      for k in kernels]
+
+    def reduce(self, channel, records, start):
+        """Compute the quadratures of each record.
+
+        """
+        kernel = self._kernels[channel]
+        if kernel is None:
+            self._fallback.reduce(channel, records, start)
+            return
+        out = self._data[channel][start:start+len(records)]
+        np.dot(records[:, :len(kernel)], kernel, out=out)
+
+    def result(self, channel):
+        """Quadratures of each record as an array of shape (records, 2).
+
+        """
+        if self._kernels[channel] is None:
+            return self._fallback.result(channel)
+        return self._data[channel]
+
+
+class SaturationReport(object):
+    """Summary of the clipping detected during an acquisition.
+
+    Attributes
+    ----------
+    minimum : list
+        Minimal raw value seen on each channel.
+
+    maximum : list
+        Maximal raw value seen on each channel.
+
+    clipped_samples : list
+        Number of clipped samples on each channel.
+
+    clipped_records : list
+        Indexes of the records containing clipped samples for each channel.
+
+    names : list
+        Names of the channels.
+
+    """
+    def __init__(self, minimum, maximum, clipped_samples, clipped_records,
+                 names):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.clipped_samples = clipped_samples
+        self.clipped_records = clipped_records
+        self.names = names
+
+    @property
+    def saturated(self):
+        """Whether any sample was clipped.
+
+        """
+        return any(self.clipped_samples)
+
+    def __str__(self):
+        if not self.saturated:
+            return 'No clipped samples.'
+        lines = []
+        for name, samples, records in zip(self.names, self.clipped_samples,
+                                          self.clipped_records):
+            if not samples:
+                continue
+            shown = ', '.join(str(r) for r in records[:10])
+            if len(records) > 10:
+                shown += ', ...'
+            lines.append('Channel %s: %d clipped samples in %d records (%s)' %
+                         (name, samples, len(records), shown))
+        return '\n'.join(lines)
+
+
+class SaturationMonitor(object):
+    """Detect the clipped records while the buffers are reduced.
+
+    Parameters
+    ----------
+    channel_count : int
+        Number of channels being acquired.
+
+    records : int
+        Total number of records expected per channel.
+
+    low : int
+        Raw values strictly below this limit are considered clipped.
+
+    high : int
+        Raw values strictly above this limit are considered clipped.
+
+    abort : bool, optional
+        Raise an InstrIOError as soon as a clipped record is found, which
+        allows to stop the acquisition early.
+
+    names : list, optional
+        Names of the channels used in the report. Default to their index.
+
+    """
+    def __init__(self, channel_count, records, low, high, abort=False,
+                 names=None):
+        self.low = low
+        self.high = high
+        self.abort = abort
+        self.names = names or [str(i) for i in range(channel_count)]
+        self._clipped = [np.zeros(records, dtype=bool)
+                         for i in range(channel_count)]
+        self._samples = [0]*channel_count
+        self._extrema = [[None, None] for i in range(channel_count)]
+        self._lock = Lock()
+
+    def check(self, channel, records, start):
+        """Check a block of records (2D array) of a channel.
+
+        """
+        mins = records.min(axis=1)
+        maxs = records.max(axis=1)
+        clipped = (mins < self.low) | (maxs > self.high)
+        samples = 0
+        if clipped.any():
+            bad = records[clipped]
+            samples = int(np.count_nonzero((bad < self.low) |
+                                           (bad > self.high)))
+
+        # Different blocks never overlap so no locking is needed for them.
+        self._clipped[channel][start:start+len(records)] = clipped
+        mini, maxi = mins.min(), maxs.max()
+        with self._lock:
+            self._samples[channel] += samples
+            extrema = self._extrema[channel]
+            extrema[0] = mini if extrema[0] is None else min(extrema[0], mini)
+            extrema[1] = maxi if extrema[1] is None else max(extrema[1], maxi)
+
+        if samples and self.abort:
+            msg = ('Saturation detected: increase input range or decrease '
+                   'amplification.\n%s')
+            raise InstrIOError(msg % self.report())
+
+    def report(self):
+        """Build a report of the clipping detected so far.
+
+        """
+        with self._lock:
+            return SaturationReport([e[0] for e in self._extrema],
+                                    [e[1] for e in self._extrema],
+                                    list(self._samples),
+                                    [np.flatnonzero(c) for c in self._clipped],
+                                    self.names)
+
+
+def _sum_dtype(records):
+    """Accumulator type to use to sum records over the first axis.
+
+    16 bits samples are summed in int32, which cannot overflow as long as
+    there are at most 2**15 records, and in int64 otherwise.
+
+    """
+    kind, size = records.dtype.kind, records.dtype.itemsize
+    if kind not in 'iu':
+        return np.float64
+    if size <= 2 and len(records) <= 2**15:
+        return np.int32
+    return np.int64
+
+
+class BufferPipeline(object):
+    """Pool of workers in charge of reducing the acquired buffers.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of worker threads. If zero the reduction is performed
+        synchronously in the calling thread.
+
+    stats : AcquisitionStats, optional
+        Counters in which to record the time spent reducing buffers.
+
+    """
+    def __init__(self, workers=1, stats=None):
+        self._executor = (ThreadPoolExecutor(max_workers=workers)
+                          if workers > 0 else None)
+        self._stats = stats
+
+    def submit(self, func, *args):
+        """Schedule the reduction of a buffer and return a future.
+
+        """
+        if self._executor is None:
+            future = Future()
+            try:
+                future.set_result(self._timed_call(func, *args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        return self._executor.submit(self._timed_call, func, *args)
+
+    def shutdown(self):
+        """Wait for all pending reductions and stop the workers.
+
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _timed_call(self, func, *args):
+        """Call the function and record its duration.
+
+        """
+        t = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            if self._stats is not None:
+                self._stats.add_reduce_time(time.perf_counter() - t)
+
+
+class WaitStrategy(object):
+    """Polling strategy used while waiting for the board.
+
+    The condition is first checked in a tight loop, then the thread yields
+    between checks and finally sleeps with an exponentially increasing
+    duration so that long waits do not keep a core busy.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Overall time allowed for an acquisition in seconds, counted from the
+        call to `start`. None means no limit.
+
+    spins : int, optional
+        Number of checks performed without releasing the processor.
+
+    yields : int, optional
+        Number of checks performed yielding the processor in between.
+
+    min_sleep : float, optional
+        First sleep duration in seconds once the yields are exhausted.
+
+    max_sleep : float, optional
+        Maximal sleep duration in seconds.
+
+    """
+    def __init__(self, timeout=None, spins=100, yields=1000, min_sleep=1e-5,
+                 max_sleep=1e-3):
+        self.timeout = timeout
+        self.spins = spins
+        self.yields = yields
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self._deadline = None
+
+    def start(self):
+        """Start counting the time allowed for the acquisition.
+
+        """
+        self._deadline = (time.perf_counter() + self.timeout
+                          if self.timeout is not None else None)
+
+    def wait(self, condition, stats=None, what='the board'):
+        """Wait for a condition to be fulfilled.
+
+        Parameters
+        ----------
+        condition : callable
+            Callable taking no argument, the wait stops as soon as it returns
+            a value evaluating to True.
+
+        stats : AcquisitionStats, optional
+            Counters in which to record the waiting time and number of polls.
+
+        what : str, optional
+            Description of what we are waiting for used in the error message.
+
+        Returns
+        -------
+        result :
+            Value returned by the condition.
+
+        Raises
+        ------
+        InstrIOError :
+            Raised if the deadline is reached before the condition is
+            fulfilled.
+
+        """
+        start = time.perf_counter()
+        sleep = self.min_sleep
+        polls = 0
+        try:
+            while True:
+                polls += 1
+                res = condition()
+                if res:
+                    return res
+                if (self._deadline is not None and
+                        time.perf_counter() > self._deadline):
+                    msg = 'Timeout (%s s) while waiting for %s.'
+                    raise InstrIOError(msg % (self.timeout, what))
+                if polls <= self.spins:
+                    continue
+                elif polls <= self.spins + self.yields:
+                    time.sleep(0)
+                else:
+                    time.sleep(sleep)
+                    sleep = min(2*sleep, self.max_sleep)
+        finally:
+            if stats is not None:
+                stats.wait_time += time.perf_counter() - start
+                stats.polls += polls
+
+
+class ParallelAcquisition(object):
+    """Acquire the traces of several digitizer boards concurrently.
+
+    Each board is driven by its own thread which holds the lock of the board
+    (`DllInstrument.secure`) during the acquisition. Once armed, the boards
+    wait for each other so that the trigger source can be started only when
+    all of them are ready: the records of a given index then correspond to
+    the same trigger on all the boards.
+
+    Parameters
+    ----------
+    drivers : list
+        Drivers of the boards. Their `get_traces` method must accept an
+        `on_armed` callable.
+
+    on_armed : callable, optional
+        Called once, without argument, when all the boards are armed. Usually
+        used to start the trigger source.
+
+    timeout : float, optional
+        Maximal time in seconds during which an armed board waits for the
+        other ones. Once it expires the acquisition is aborted on all the
+        boards, which then release their lock, even if a board never got
+        armed. None means no limit, in which case a board hanging before
+        being armed blocks the other ones.
+
+    Attributes
+    ----------
+    arm_times : list
+        Time (time.perf_counter) at which each board was armed during the
+        last acquisition.
+
+    """
+    def __init__(self, drivers, on_armed=None, timeout=10.0):
+        self.drivers = list(drivers)
+        self.on_armed = on_armed
+        self.timeout = timeout
+        self.arm_times = []
+        self._executor = None
+        self._futures = []
+        self._lock = Lock()
+        self._error = None
+
+    @property
+    def arm_skew(self):
+        """Time elapsed between the arming of the first and last boards.
+
+        """
+        times = [t for t in self.arm_times if t is not None]
+        return max(times) - min(times) if times else 0.0
+
+    def start(self, per_board=None, **kwargs):
+        """Start the acquisition on all the boards and return immediately.
+
+        Parameters
+        ----------
+        per_board : list, optional
+            Keyword arguments of `get_traces` specific to each board (active
+            channels, demodulation kernels, ...).
+
+        **kwargs :
+            Keyword arguments of `get_traces` common to all the boards. As
+            re-arming a single board would break the alignment of the records
+            retry is disabled unless explicitly asked for.
+
+        """
+        if self._futures:
+            raise RuntimeError('An acquisition is already running.')
+        per_board = per_board or [{} for _ in self.drivers]
+        if len(per_board) != len(self.drivers):
+            raise ValueError('Expected settings for %d boards, got %d' %
+                             (len(self.drivers), len(per_board)))
+
+        barrier = Barrier(len(self.drivers), self._all_armed, self.timeout)
+        self.arm_times = [None]*len(self.drivers)
+        self._error = None
+        self._executor = ThreadPoolExecutor(max_workers=len(self.drivers))
+        for i, (driver, settings) in enumerate(zip(self.drivers, per_board)):
+            kw = dict(retry=0)
+            kw.update(kwargs)
+            kw.update(settings)
+            kw['on_armed'] = partial(self._armed, barrier, i)
+            self._futures.append(self._executor.submit(self._acquire, driver,
+                                                       barrier, kw))
+
+    def wait(self):
+        """Wait for the end of the acquisition on all the boards.
+
+        Returns
+        -------
+        data : list
+            Data returned by `get_traces` for each board.
+
+        Raises
+        ------
+        Exception :
+            The first error which occurred on any board. The acquisition is
+            then aborted on all the other boards.
+
+        """
+        try:
+            results = []
+            for future in self._futures:
+                try:
+                    results.append(future.result())
+                except Exception:
+                    results.append(None)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._futures = []
+
+        if self._error is not None:
+            raise self._error
+        return results
+
+    def acquire(self, per_board=None, **kwargs):
+        """Start the acquisition on all the boards and wait for the data.
+
+        See `start` and `wait` for details.
+
+        """
+        self.start(per_board, **kwargs)
+        return self.wait()
+
+    def _acquire(self, driver, barrier, kwargs):
+        """Acquire the traces of a board while holding its lock.
+
+        """
+        try:
+            with driver.secure():
+                return driver.get_traces(**kwargs)
+        except Exception as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            # Do not let the other boards wait for this one.
+            barrier.abort()
+            raise
+
+    def _armed(self, barrier, index):
+        """Wait for all the boards to be armed.
+
+        """
+        self.arm_times[index] = time.perf_counter()
+        try:
+            barrier.wait()
+        except BrokenBarrierError:
+            raise InstrIOError('Not all the boards could be armed (timeout: '
+                               '%s s), acquisition aborted.' % self.timeout)
+
+    def _all_armed(self):
+        """Notify that all the boards are armed.
+
+        """
+        if self.on_armed is not None:
+            try:
+                self.on_armed()
+            except Exception as e:
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+                raise
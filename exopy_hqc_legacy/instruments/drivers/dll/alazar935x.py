@@ -16,14 +16,25 @@ Visual C++ runtime needs to be installed to be able to load the dll.
 """
 import sys
 import math
+import time
+from collections import deque
 from subprocess import call
 
 import numpy as np
 
 from ..dll_tools import DllInstrument
 from ..driver_tools import InstrIOError
+from ..acquisition_tools import (AcquisitionStats, AverageReducer,
+                                 RecordsReducer, CallbackReducer,
+                                 DemodReducer, BufferPipeline, ScaledArray,
+                                 SaturationMonitor)
 from . import atsapi as ats
 
+#: Type of the array in which to store the records for each output format,
+#: None meaning the type of the raw samples.
+RECORDS_DTYPES = {None: np.float64, 'float64': np.float64,
+                  'float32': np.float32, 'raw': None}
+
 
 class Alazar935x(DllInstrument):
     """Driver for Alazar cards of the 935x series.
@@ -58,6 +69,15 @@ class Alazar935x(DllInstrument):
         """
         pass
 
+    def samples_per_record(self, duration):
+        """Number of samples acquired per record for a given duration.
+
+        The board requires the number of samples to be a multiple of 32.
+
+        """
+        samples = int(self.samples_per_sec*duration)
+        return int(math.ceil(samples/32))*32
+
     def configure_board(self):
         """Set standard parameters.
 
@@ -105,9 +125,17 @@ class Alazar935x(DllInstrument):
                              0)
 
     def get_traces(self, channels, duration, delay, records_per_capture,
-                   retry=True, average=False):
+                   retry=True, average=False, buffer_count=4,
+                   buffer_size=1e6, workers=2, callback=None,
+                   demod_kernels=None, output=None, on_saturation='raise',
+                   on_armed=None, timeout=None):
         """Acquire traces and average if asked to.
 
+        The calling thread only waits for the DMA buffers and posts them back
+        to the board, the data are reduced by a pool of workers. Counters
+        describing the acquisition are stored in the `acquisition_stats`
+        attribute.
+
         Parameters
         ----------
         channels : tuple
@@ -129,6 +157,53 @@ class Alazar935x(DllInstrument):
         average : bool, optional
             Should traces be averaged.
 
+        buffer_count : int, optional
+            Number of DMA buffers to allocate.
+
+        buffer_size : int, optional
+            Maximal size of a DMA buffer in bytes.
+
+        workers : int, optional
+            Number of threads used to reduce the buffers. If zero the
+            reduction happens in the acquisition thread.
+
+        callback : callable, optional
+            Callable used to process the records in place of the default
+            reduction (see `CallbackReducer`). In this case the returned data
+            are None for the active channels.
+
+        demod_kernels : tuple, optional
+            Demodulation kernel to apply to each record of each channel, as
+            each buffer is received. A kernel is an array of shape (samples,
+            2) whose columns are the weights of the two quadratures. The
+            corresponding entry in the returned data is then the array of
+            shape (records_per_capture, 2) of the quadratures of each record.
+            None means no demodulation for that channel. Cannot be used when
+            averaging.
+
+        output : {None, 'float64', 'float32', 'raw'}, optional
+            Format of the records when not averaging. By default they are
+            returned as float64 arrays. 'raw' returns `ScaledArray` wrapping
+            the raw samples, which uses four times less memory.
+
+        on_saturation : {'raise', 'report'}, optional
+            The records are checked for clipping as each buffer is received.
+            'raise' aborts the acquisition as soon as a clipped record is
+            found, 'report' only records it. When averaging, 'raise' only
+            raises if the averaged trace is clipped. In all cases a
+            `SaturationReport` is stored in the `saturation_report`
+            attribute.
+
+        on_armed : callable, optional
+            Called without argument once the board is armed and before any
+            record is retrieved. Used to synchronize several boards (see
+            `ParallelAcquisition`), an exception raised by it aborts the
+            acquisition.
+
+        timeout : float, optional
+            Overall time in seconds allowed for the acquisition. By default
+            only the wait for each buffer is limited (to 15 s).
+
         Returns
         -------
         data : list
@@ -136,6 +211,19 @@ class Alazar935x(DllInstrument):
             on the average parameter.
 
         """
+        # Validate the arguments before touching the board.
+        if output not in RECORDS_DTYPES:
+            raise ValueError('Unsupported output format %s' % output)
+        if on_saturation not in ('raise', 'report'):
+            raise ValueError('Unsupported saturation policy %s' %
+                             on_saturation)
+        kernels = [k for k, c in zip(demod_kernels or (None, None), channels)
+                   if c]
+        demodulate = any(k is not None for k in kernels)
+        if demodulate and average:
+            raise ValueError('Demodulation kernels cannot be used when '
+                             'averaging the traces.')
+
         board = self.board
 
         triggerDelay_sec = delay
@@ -150,11 +238,7 @@ class Alazar935x(DllInstrument):
         channels_tuple = channels
         channels = cA | cB
 
-        post_trigger_samples = int(self.samples_per_sec*duration)
-        if post_trigger_samples % 32 == 0:
-            post_trigger_samples = int(post_trigger_samples)
-        else:
-            post_trigger_samples = int((post_trigger_samples)/32 + 1)*32
+        post_trigger_samples = self.samples_per_record(duration)
         # Determine the number of records per buffer
         memory_size_samples, bits_per_sample = board.getChannelInfo()
 
@@ -168,9 +252,8 @@ class Alazar935x(DllInstrument):
         # See remark page 93 in ATS-SDK-Guide 7.1.4
         # + following email exchange with Alazar
         # engineer Romain Deterre
-        bytes_per_buffer_max = 1e6
-        rPB = int(bytes_per_buffer_max // (bytes_per_record * channel_count))
-        records_per_buffer = np.min([rPB, records_per_capture])
+        rPB = int(buffer_size // (bytes_per_record * channel_count))
+        records_per_buffer = max(1, min(rPB, records_per_capture))
         bytes_per_buffer = bytes_per_record*records_per_buffer*channel_count
 
         buffers_per_acquisition = int(math.ceil(records_per_capture /
@@ -178,10 +261,9 @@ class Alazar935x(DllInstrument):
         records_to_ignore = (buffers_per_acquisition*records_per_buffer -
                              records_per_capture)
 
-        buffer_count = 4
         # Allocate DMA buffers
         buffers = []
-        for i in range(buffer_count):
+        for i in range(max(2, buffer_count)):
             buffers.append(ats.DMABuffer(bytes_per_sample, bytes_per_buffer))
 
         # Set the record size
@@ -200,74 +282,147 @@ class Alazar935x(DllInstrument):
                               records_per_acquisition,
                               ats.ADMA_EXTERNAL_STARTCAPTURE | ats.ADMA_NPT)
 
-        # Post DMA buffers to board
+        records_dtype = RECORDS_DTYPES[output] or buffers[0].buffer.dtype
+
+        if demodulate:
+            fallback = RecordsReducer(channel_count, records_per_capture,
+                                      samples_per_record,
+                                      [k is None for k in kernels],
+                                      records_dtype)
+            reducer = DemodReducer(kernels, records_per_capture, fallback)
+        elif callback is not None:
+            reducer = CallbackReducer(callback)
+        elif average:
+            reducer = AverageReducer(channel_count, samples_per_record)
+        else:
+            reducer = RecordsReducer(channel_count, records_per_capture,
+                                     samples_per_record,
+                                     dtype=records_dtype)
+
+        # Check card is not saturated. When averaging, only the averaged
+        # traces can stop the acquisition, the clipped records being
+        # reported.
+        maxADC = 2**16-100
+        minADC = 100
+        monitor = SaturationMonitor(channel_count, records_per_capture,
+                                    minADC, maxADC,
+                                    on_saturation == 'raise' and not average,
+                                    [n for n, c in zip('AB', channels_tuple)
+                                     if c])
+
+        stats = AcquisitionStats()
+        pipeline = BufferPipeline(workers, stats)
+        self.acquisition_stats = stats
+
+        # Post DMA buffers to board. The board fills the buffers in the order
+        # in which they have been posted.
+        posted = deque()
         for buffer in buffers:
             board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+            posted.append(buffer)
+        # Buffers whose content is being reduced by the workers.
+        pending = deque()
 
+        start_time = time.perf_counter()
         board.startCapture()  # Start the acquisition
         buffers_completed = 0
 
-        if not average:
-            data = [np.empty((records_per_capture, samples_per_record))
-                    for i in range(channel_count)]
-        else:
-            data = [np.zeros(samples_per_record) for i in range(channel_count)]
-
-        while buffers_completed < buffers_per_acquisition:
-
-            # Wait for the buffer at the head of the list of available
-            # buffers to be filled by the board.
-            buffer = buffers[buffers_completed % len(buffers)]
-            board.waitAsyncBufferComplete(buffer.addr, timeout_ms=15000)
-            rbuf = np.reshape(buffer.buffer,
-                              (records_per_buffer*channel_count,
-                               samples_per_record))
-            # making sure we only grab the number of records we asked for
-            if buffers_completed < buffers_per_acquisition-1:
-                records_to_ignore_val = 0
-            else:
-                records_to_ignore_val = records_to_ignore
-
-            start = buffers_completed*records_per_buffer
-            stop = start + records_per_buffer-records_to_ignore_val
-            for i in range(channel_count):
-                if average:
-                    data[i] += np.sum(rbuf[i*records_per_buffer:
-                                           (i+1)*records_per_buffer -
-                                           records_to_ignore_val], 0)
-                    data[i] /= records_per_capture
+        try:
+            if on_armed is not None:
+                on_armed()
+
+            while buffers_completed < buffers_per_acquisition:
+
+                # Give back to the board the buffers which have been reduced.
+                # If no buffer is available anymore we have no choice but to
+                # wait for the workers.
+                while pending and (not posted or pending[0][1].done()):
+                    if not posted:
+                        stats.overruns += 1
+                    buffer, future = pending.popleft()
+                    future.result()
+                    board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+                    posted.append(buffer)
+
+                # Wait for the buffer at the head of the list of available
+                # buffers to be filled by the board.
+                buffer = posted.popleft()
+                t = time.perf_counter()
+                timeout_ms = 15000
+                if timeout is not None:
+                    remaining = start_time + timeout - t
+                    if remaining <= 0:
+                        raise InstrIOError('Timeout while waiting for the '
+                                           'Alazar buffers.')
+                    timeout_ms = max(1, int(remaining*1000))
+                board.waitAsyncBufferComplete(buffer.addr,
+                                              timeout_ms=timeout_ms)
+                stats.wait_time += time.perf_counter() - t
+
+                # making sure we only grab the number of records we asked for
+                if buffers_completed < buffers_per_acquisition-1:
+                    valid_records = records_per_buffer
                 else:
-                    data[i][start:stop] = rbuf[i*records_per_buffer:
-                                               (i+1)*records_per_buffer -
-                                               records_to_ignore_val]
-
-            buffers_completed += 1
-
-            # Add the buffer to the end of the list of available buffers.
-            board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
-
-        # Abort transfer.
-        board.abortAsyncRead()
-
-        # Check card is not saturated
-        maxADC = 2**16-100
-        minADC = 100
-        if any(np.max(data[i]) > maxADC or np.min(data[i]) < minADC for i in
-               range(channel_count)):
-            mes = '''Channel A or B are saturated: increase input range or
-            decrease amplification'''
-            raise InstrIOError(mes)
+                    valid_records = records_per_buffer - records_to_ignore
+
+                start = buffers_completed*records_per_buffer
+                future = pipeline.submit(_reduce_buffer, reducer, monitor,
+                                         buffer, channel_count,
+                                         records_per_buffer,
+                                         samples_per_record, valid_records,
+                                         start)
+                pending.append((buffer, future))
+
+                buffers_completed += 1
+                stats.buffers += 1
+                stats.bytes += buffer.size_bytes
+
+            for _, future in pending:
+                future.result()
+
+        finally:
+            # Abort transfer.
+            board.abortAsyncRead()
+            pipeline.shutdown()
+            stats.elapsed = time.perf_counter() - start_time
+            self.saturation_report = monitor.report()
+
+        data = [reducer.result(i) for i in range(channel_count)]
+
+        if (average and callback is None and on_saturation == 'raise' and
+                any(np.max(d) > maxADC or np.min(d) < minADC for d in data)):
+            msg = ('Saturation detected: increase input range or decrease '
+                   'amplification.\n%s')
+            raise InstrIOError(msg % self.saturation_report)
 
         # XXX convert to volt
+        if output == 'raw' and not average and callback is None:
+            data = [ScaledArray(d) if k is None else d
+                    for d, k in zip(data, kernels)]
 
         data_f = []
-        for i, c in enumerate(channels_tuple):
+        active = iter(data)
+        for c in channels_tuple:
             if c:
-                if average:
-                    data_f.append(np.array(data[i]))
-                else:
-                    data_f.append(data[i])
+                data_f.append(next(active))
             else:
                 data_f.append(np.zeros(1))
 
         return data_f
+
+
+def _reduce_buffer(reducer, monitor, buffer, channel_count,
+                   records_per_buffer, samples_per_record, valid_records,
+                   start):
+    """Check for saturation and reduce the content of a DMA buffer.
+
+    The records of the different channels are stored one after the other in
+    the buffer.
+
+    """
+    rbuf = np.reshape(buffer.buffer,
+                      (channel_count, records_per_buffer, samples_per_record))
+    for i in range(channel_count):
+        records = rbuf[i, :valid_records]
+        monitor.check(i, records, start)
+        reducer.reduce(i, records, start)
@@ -18,6 +18,10 @@ import numpy as np
 from pyclibrary import CLibrary
 
 from ..dll_tools import DllInstrument
+from ..driver_tools import InstrIOError
+from ..acquisition_tools import (AcquisitionStats, AverageReducer,
+                                 DemodReducer, BufferPipeline, WaitStrategy,
+                                 ScaledArray, SaturationMonitor)
 
 
 class ADQControlUnit(object):
@@ -149,7 +153,10 @@ class SPADQ14(DllInstrument):
         self._dll.SetTriggerEdge(self._cu_id, self._id, 2, 1)
 
     def get_traces(self, channels, duration, delay, records_per_capture,
-                   retry=1, average=False):
+                   retry=1, average=False, buffer_count=4, buffer_size=1e6,
+                   workers=2, demod_kernels=None, wait_strategy=None,
+                   output=None, on_saturation='report', on_armed=None,
+                   timeout=None):
         """Acquire the average signal on both channels.
 
         Parameters
@@ -173,6 +180,57 @@ class SPADQ14(DllInstrument):
         average : bool, optional
             Should traces be averaged.
 
+        buffer_count : int, optional
+            Number of host buffers in the ring used to retrieve the records
+            of the averaged or demodulated channels.
+
+        buffer_size : int, optional
+            Maximal size of a host buffer in bytes. The records are retrieved
+            by batches fitting in a buffer so that the memory used when
+            averaging or demodulating does not depend on the number of
+            records.
+
+        workers : int, optional
+            Number of threads used to reduce the batches. If zero the
+            reduction happens in the acquisition thread.
+
+        demod_kernels : tuple, optional
+            Demodulation kernel to apply to each record of each channel as
+            soon as the records are retrieved from the card. A kernel is an
+            array of shape (samples, 2) whose columns are the weights of the
+            two quadratures. The corresponding entry in the returned data is
+            then the array of shape (records_per_capture, 2) of the
+            quadratures of each record. None means no demodulation for that
+            channel. Cannot be used when averaging.
+
+        wait_strategy : WaitStrategy, optional
+            Strategy used to wait for the card to be armed and for the
+            records to be acquired. Its timeout is the overall time allowed
+            for the acquisition. By default a WaitStrategy using `timeout` is
+            used.
+
+        output : {None, 'float32', 'float64', 'raw'}, optional
+            Format of the records when not averaging. By default they are
+            returned as float32 arrays in volts. 'raw' returns `ScaledArray`
+            wrapping the raw samples without any copy.
+
+        on_saturation : {'report', 'raise'}, optional
+            Behaviour when clipped samples are found in a batch. 'report'
+            (default) only records them, 'raise' stops the acquisition with an
+            InstrIOError. In both cases the `saturation_report` attribute
+            holds the result of the check once the acquisition is over.
+
+        on_armed : callable, optional
+            Called without argument once the board is armed and before any
+            record is retrieved. Used to synchronize several boards (see
+            `ParallelAcquisition`), an exception raised by it aborts the
+            acquisition.
+
+        timeout : float, optional
+            Overall time in seconds allowed for the acquisition when no
+            `wait_strategy` is given, after which an InstrIOError is raised.
+            None means no limit.
+
         Returns
         -------
         data : list
@@ -180,14 +238,25 @@ class SPADQ14(DllInstrument):
             on the average parameter.
 
         """
+        # Validate the arguments before touching the board.
+        if output not in (None, 'float32', 'float64', 'raw'):
+            raise ValueError('Unsupported output format %s' % output)
+        if on_saturation not in ('raise', 'report'):
+            raise ValueError('Unsupported saturation policy %s' %
+                             on_saturation)
+        kernels = [k if c else None
+                   for k, c in zip(demod_kernels or (None, None), channels)]
+        if average and any(k is not None for k in kernels):
+            raise ValueError('Demodulation kernels cannot be used when '
+                             'averaging the traces.')
+
         # Set trigger delay
         n = int(round(delay/2e-9))
         assert 0 <= n < 62, 'Delay must be at most 61 cycles (%d)' % n
         assert self._dll.SetTriggerHoldOffSamples(self._cu_id, self._id, n)()
 
         # Number of samples per record.
-        samples_per_sec = 500e6
-        samples_per_record = int(round(samples_per_sec*duration))
+        samples_per_record = self.samples_per_record(duration)
 
         mask = (0x01 if channels[0] else 0) + (0x02 if channels[1] else 0)
         assert self._dll.MultiRecordSetChannelMask(self._cu_id, self._id, mask)
@@ -195,91 +264,166 @@ class SPADQ14(DllInstrument):
                                           records_per_capture,
                                           samples_per_record)()
 
-        # Alloc memory for both channels (using numpy arrays)
-        buffer_size = samples_per_record*records_per_capture
+        cu = self._cu_id
+        id_ = self._id
+        bytes_per_sample = self._dll.GetNofBytesPerSample(cu, id_)[2]
+
+        chs = tuple([i for i, c in enumerate(channels) if c])
+        # Channels whose records are stored at their final position in the
+        # output buffers, the other ones are retrieved by batches in a ring
+        # of small buffers and reduced by the workers.
+        stored = tuple(i for i in chs if kernels[i] is None and not average)
+        reduced = tuple(i for i in chs if i not in stored)
+
+        batch = int(buffer_size // (bytes_per_sample*samples_per_record))
+        batch = max(1, min(batch, records_per_capture))
+        batch_size = samples_per_record*batch
+        ring = [[np.empty(batch_size, dtype=np.int16) if i in reduced else None
+                 for i in range(2)]
+                for _ in range(max(1, buffer_count))]
+
+        # Alloc memory for the channels stored in full (using numpy arrays)
+        capture_size = samples_per_record*records_per_capture
         buffers = []
-        avg = []
-        for c in channels:
-            buf = (np.ascontiguousarray(np.empty(buffer_size, dtype=np.int16))
-                   if c else np.zeros(1, dtype=np.uint16))
+        for i in range(2):
+            buf = (np.ascontiguousarray(np.empty(capture_size, dtype=np.int16))
+                   if i in stored else np.zeros(1, dtype=np.uint16))
             buffers.append(buf)
-            avg.append(np.zeros(samples_per_record) if c else np.zeros(1))
 
-        chs = tuple([i for i, c in enumerate(channels) if c])
-        buffers_ptr = (ctypes.c_void_p*2)(*(b.ctypes.data_as(ctypes.c_void_p)
-                                            for b in buffers))
+        # Get the offset in volt for each channel is ignored.
+        # The range is 1.9 Vpp according to the data sheet 2**16 = 65536
+        scale = 1.9/65535
+        if average:
+            reducer = AverageReducer(2, samples_per_record, scale)
+        else:
+            reducer = DemodReducer(kernels, records_per_capture)
 
-        cu = self._cu_id
-        id_ = self._id
-        bytes_per_sample = self._dll.GetNofBytesPerSample(cu, id_)[2]
+        # The samples are signed 16 bits integers.
+        monitor = SaturationMonitor(2, records_per_capture, -2**15 + 100,
+                                    2**15 - 101, on_saturation == 'raise',
+                                    ['1', '2'])
 
-        assert self._dll.DisarmTrigger(self._cu_id, self._id)()
-        while not self._dll.ArmTrigger(self._cu_id, self._id)():
-            time.sleep(0.0001)
+        stats = AcquisitionStats()
+        pipeline = BufferPipeline(workers, stats)
+        self.acquisition_stats = stats
+        # Reduction pending on each slot of the ring.
+        pending = [None]*len(ring)
+
+        waiter = wait_strategy or WaitStrategy(timeout)
+        waiter.start()
+        start_time = time.perf_counter()
 
-        # Wait for all records to be acquired.
         acq_records = self._dll.GetAcquiredRecords.func
         get_data = self._dll.GetData.func
         retrieved_records = 0
-        while retrieved_records < records_per_capture:
-            # Wait for a record to be acquired.
-            n_records = (acq_records(cu, id_) - retrieved_records)
-
-            # If we are not averaging we wait for all records to be acquired.
-            if not n_records or (not average and
-                                 n_records < records_per_capture):
-                time.sleep(1e-6)
-                continue
-            if not get_data(cu, id_, buffers_ptr,
-                            n_records*samples_per_record,
-                            bytes_per_sample,
-                            retrieved_records,
-                            n_records,
-                            mask,
-                            0,
-                            samples_per_record,
-                            0x00):
-                del avg, buffers
-                self._dll.DisarmTrigger(self._cu_id, self._id)
-                self._dll.MultiRecordClose(self._cu_id, self._id)
-                self.close_connection()
-                self._setup_library()
-                self.open_connection()
-                self.configure_board()
-                if retry:
-                    return self.get_traces(channels, duration, delay,
-                                           records_per_capture, retry-1, average)
-                else:
-                    msg = 'Failed to retrieve data from ADQ14'
-                    raise RuntimeError(msg)
-
-            if average:
-                for c in chs:
-                    avg[c] += np.sum(
-                        np.reshape(buffers[c],
-                                   (-1, samples_per_record))[:n_records], 0)
-
-            retrieved_records += n_records
-
-        if average:
-            for c in chs:
-                avg[c] /= records_per_capture
-
-        self._dll.DisarmTrigger(self._cu_id, self._id)
-        self._dll.MultiRecordClose(self._cu_id, self._id)
+        batches = 0
+        failed = False
+        assert self._dll.DisarmTrigger(self._cu_id, self._id)()
+        # Whatever happens the board is disarmed once done.
+        try:
+            waiter.wait(lambda: self._dll.ArmTrigger(cu, id_)(), stats,
+                        'the ADQ14 trigger to be armed')
+
+            if on_armed is not None:
+                on_armed()
+
+            while retrieved_records < records_per_capture:
+                # Wait for a record to be acquired.
+                n_records = waiter.wait(
+                    lambda: acq_records(cu, id_) - retrieved_records, stats,
+                    'the ADQ14 records')
+                n_records = min(n_records, batch)
+
+                # Wait for the workers to be done with the slot.
+                slot = batches % len(ring)
+                if pending[slot] is not None:
+                    if not pending[slot].done():
+                        stats.overruns += 1
+                    pending[slot].result()
+                    pending[slot] = None
+
+                offset = retrieved_records*samples_per_record
+                targets = [ring[slot][i] if i in reduced else buffers[i]
+                           for i in range(2)]
+                buffers_ptr = (ctypes.c_void_p*2)(
+                    *(b.ctypes.data + (offset*b.itemsize if i in stored else 0)
+                      for i, b in enumerate(targets)))
+                t = time.perf_counter()
+                if not get_data(cu, id_, buffers_ptr,
+                                n_records*samples_per_record,
+                                bytes_per_sample,
+                                retrieved_records,
+                                n_records,
+                                mask,
+                                0,
+                                samples_per_record,
+                                0x00):
+                    failed = True
+                    break
+                stats.transfer_time += time.perf_counter() - t
+
+                views = [buffers[i][offset:offset +
+                                    n_records*samples_per_record]
+                         if i in stored else ring[slot][i] for i in range(2)]
+                pending[slot] = pipeline.submit(_reduce_batch, reducer,
+                                                monitor, views, chs, reduced,
+                                                n_records, samples_per_record,
+                                                retrieved_records)
+
+                retrieved_records += n_records
+                batches += 1
+                stats.buffers += 1
+                stats.bytes += (n_records*samples_per_record *
+                                bytes_per_sample*len(chs))
+
+            for future in pending:
+                if future is not None:
+                    future.result()
+
+        finally:
+            pipeline.shutdown()
+            stats.elapsed = time.perf_counter() - start_time
+            self.saturation_report = monitor.report()
+            self._dll.DisarmTrigger(self._cu_id, self._id)
+            self._dll.MultiRecordClose(self._cu_id, self._id)
+
+        if failed:
+            del buffers, ring, reducer
+            self.close_connection()
+            self._setup_library()
+            self.open_connection()
+            self.configure_board()
+            if retry:
+                return self.get_traces(channels, duration, delay,
+                                       records_per_capture, retry-1, average,
+                                       buffer_count, buffer_size, workers,
+                                       demod_kernels, wait_strategy, output,
+                                       on_saturation, on_armed, timeout)
+            else:
+                msg = 'Failed to retrieve data from ADQ14'
+                raise RuntimeError(msg)
 
-        # Get the offset in volt for each channel is ignored.
-        # The range is 1.9 Vpp according to the data sheet 2**16 = 65536
         if average:
-            for c in chs:
-                avg[c] *= 1.9/65535
+            return [reducer.result(i) if i in chs else np.zeros(1)
+                    for i in range(2)]
         else:
             for i, c in enumerate(channels):
-                if c:
-                    buffers[i] = np.reshape(buffers[i].astype(np.float32),
-                                  (-1, samples_per_record)) * 1.9/65535
+                if kernels[i] is not None:
+                    buffers[i] = reducer.result(i)*scale
+                elif c:
+                    raw = ScaledArray(np.reshape(buffers[i],
+                                                 (-1, samples_per_record)),
+                                      scale, dtype=np.float32)
+                    buffers[i] = (raw if output == 'raw' else
+                                  raw.astype(output or np.float32))
+
+            return buffers
 
-        return avg if average else buffers
+    def samples_per_record(self, duration):
+        """Number of samples acquired per record for a given duration.
+
+        """
+        return int(round(500e6*duration))
 
     def _setup_library(self):
         """Load and initialize the dll.
@@ -294,3 +438,15 @@ class SPADQ14(DllInstrument):
 
         self._dll = CLibrary(library_dir, [header_dir], cache=cache_path,
                              prefix=['ADQ',  'ADQ_'], convention='cdll')
+
+
+def _reduce_batch(reducer, monitor, buffers, channels, reduced, n_records,
+                  samples_per_record, start):
+    """Check and reduce the records retrieved in a batch.
+
+    """
+    for c in channels:
+        records = np.reshape(buffers[c], (-1, samples_per_record))[:n_records]
+        monitor.check(c, records, start)
+        if c in reduced:
+            reducer.reduce(c, records, start)
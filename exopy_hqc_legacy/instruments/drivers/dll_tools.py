@@ -15,6 +15,7 @@ from contextlib import contextmanager
 from threading import Lock
 
 from .driver_tools import BaseInstrument, InstrIOError
+from .io_tracing import TRACER
 
 
 class DllInstrument(BaseInstrument):
@@ -27,10 +28,37 @@ class DllInstrument(BaseInstrument):
         under the instruments/dll directory it will be automatically
         found by the DllForm.
 
+    timeout : float
+        Timeout to use when attempting to acquire the lock of the board.
+
     """
 
     library = ''
 
+    timeout = 5.0
+
+    def __init__(self, connection_info, caching_allowed=True,
+                 caching_permissions={}, auto_open=True):
+        super(DllInstrument, self).__init__(connection_info, caching_allowed,
+                                            caching_permissions, auto_open)
+        self.lock = Lock()
+
+    @contextmanager
+    def secure(self):
+        """ Lock acquire and release method for the board.
+
+        Contrary to the lock of the DllLibrary which protects all the calls to
+        the dll, this lock is specific to the board so that different boards
+        relying on the same library can be used in parallel.
+
+        """
+        if not self.lock.acquire(timeout=self.timeout):
+            raise InstrIOError('Timeout in trying to acquire board lock.')
+        try:
+            yield
+        finally:
+            self.lock.release()
+
 
 class DllLibrary(object):
     """ Singleton class used to call a dll.
@@ -55,6 +83,10 @@ class DllLibrary(object):
 
     _instance = None
 
+    #: Proxy tracing the calls to the dll, built the first time the calls are
+    #: traced.
+    _traced = None
+
     def __new__(cls, *args, **kwargs):
         if cls._instance is not None:
             return cls._instance
@@ -64,16 +96,32 @@ class DllLibrary(object):
     def __init__(self, path, **kwargs):
 
         if kwargs.get('type') == 'windll':
-            self.dll = ctypes.windll.LoadLibrary(path)
+            self._dll = ctypes.windll.LoadLibrary(path)
         elif kwargs.get('type') == 'oledll':
-            self.dll = ctypes.windll.LoadLibrary(path)
+            self._dll = ctypes.windll.LoadLibrary(path)
         else:
-            self.dll = ctypes.cdll.LoadLibrary(path)
+            self._dll = ctypes.cdll.LoadLibrary(path)
 
         self.timeout = kwargs.get('timeout', 5.0)
 
         self.lock = Lock()
 
+    @property
+    def dll(self):
+        """Loaded library.
+
+        When the communications are traced, the calls made to the functions
+        of the library are recorded. Only the libraries accessed through this
+        property are traced: the digitizers loading their library by other
+        means (SPADQ14 through pyclibrary, Alazar935x through atsapi) are not.
+
+        """
+        if TRACER.enabled:
+            if self._traced is None:
+                self._traced = _TracedLibrary(self)
+            return self._traced
+        return self._dll
+
     @contextmanager
     def secure(self):
         """ Lock acquire and release method.
@@ -89,3 +137,57 @@ class DllLibrary(object):
             yield
         finally:
             self.lock.release()
+
+
+class _TracedLibrary(object):
+    """Proxy of a dll recording the calls made to its functions.
+
+    Setting an attribute (such as the restype of a function) affects the
+    underlying dll.
+
+    """
+    __slots__ = ('_library',)
+
+    def __init__(self, library):
+        object.__setattr__(self, '_library', library)
+
+    def __getattr__(self, name):
+        func = getattr(self._library._dll, name)
+        if not callable(func):
+            return func
+        return _TracedFunction(self._library, name, func)
+
+    def __setattr__(self, name, value):
+        setattr(self._library._dll, name, value)
+
+
+class _TracedFunction(object):
+    """Proxy of a function of a dll recording its calls.
+
+    The other attributes (restype, argtypes, errcheck, ...) are read from
+    and written to the underlying function.
+
+    """
+    __slots__ = ('_library', '_name', '_func')
+
+    def __init__(self, library, name, func):
+        object.__setattr__(self, '_library', library)
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_func', func)
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try:
+            result = self._func(*args)
+        except Exception as e:
+            TRACER.record(self._library, 'dll', self._name, start,
+                          error=repr(e))
+            raise
+        TRACER.record(self._library, 'dll', self._name, start)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._func, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._func, name, value)
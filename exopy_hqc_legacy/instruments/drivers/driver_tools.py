@@ -25,18 +25,23 @@ the VISA library.
     instrument_properties :
         subclass of property allowing to cache a property on certain condition,
         and to reset the cache.
+    make_instrument_property :
+        decorator building an instrument property with options.
     secure_communication :
         decorator making sure that a communication error cannot simply be
         resolved by attempting again to send a message.
 
 """
 import logging
-import inspect
 import time
+from collections import Counter
+from contextlib import contextmanager
 from inspect import cleandoc
 from textwrap import fill
 from functools import wraps
 
+from .io_tracing import TRACER
+
 
 class InstrError(Exception):
     """Generic error raised when an instrument does not behave as expected
@@ -50,13 +55,30 @@ class InstrIOError(InstrError):
     pass
 
 
+#: Marker of the absence of a cached value.
+_MISSING = object()
+
+
 class instrument_property(property):
     """Property allowing to cache the result of a get operation and return it
     on the next get. The cache can be cleared.
 
+    Options can be given to the property using `make_instrument_property`.
+
+    Parameters
+    ----------
+    ttl : float, optional
+        Time in seconds after which a cached value is considered outdated and
+        read again from the instrument (for values drifting with time).
+
+    invalidates : iterable of str, optional
+        Names of the properties whose cached values should be discarded when
+        this property is set.
+
     """
 
-    def __init__(self, fget=None, fset=None, fdel=None, doc=None):
+    def __init__(self, fget=None, fset=None, fdel=None, doc=None, ttl=None,
+                 invalidates=()):
         super(instrument_property, self).__init__(fget, fset, fdel, doc)
         if fget is not None:
             self.name = fget.__name__
@@ -66,22 +88,40 @@ class instrument_property(property):
             err = 'Need either a setter or getter for an instrument_property.'
             raise ValueError(err)
 
+        self.ttl = ttl
+        self.invalidates = tuple(invalidates)
         self.type = None
         self.valid_values = []
 
+    def getter(self, fget):
+        return self._copy_options(super(instrument_property,
+                                        self).getter(fget))
+
+    def setter(self, fset):
+        return self._copy_options(super(instrument_property,
+                                        self).setter(fset))
+
+    def deleter(self, fdel):
+        return self._copy_options(super(instrument_property,
+                                        self).deleter(fdel))
+
     def __get__(self, obj, objtype=None):
         """
         """
         if obj is not None:
             name = self.name
             if name in obj._caching_permissions:
-                try:
-                    return obj._cache[name]
-                except KeyError:
-                    aux = super(instrument_property, self).__get__(obj,
-                                                                   objtype)
-                    obj._cache[name] = aux
-                    return aux
+                cached = self.cached_value(obj)
+                if cached is not _MISSING:
+                    _driver_state(obj, '_cache_hits', Counter)[name] += 1
+                    return cached
+                _driver_state(obj, '_cache_misses', Counter)[name] += 1
+                aux = super(instrument_property, self).__get__(obj, objtype)
+                obj._cache[name] = aux
+                if self.ttl is not None:
+                    expiry = _driver_state(obj, '_cache_expiry', dict)
+                    expiry[name] = time.monotonic() + self.ttl
+                return aux
             else:
                 return super(instrument_property, self).__get__(obj, objtype)
 
@@ -93,15 +133,72 @@ class instrument_property(property):
         """
         name = self.name
         if name in obj._caching_permissions:
-            try:
-                if obj._cache[name] == value:
-                    return
-            except KeyError:
-                pass
+            cached = self.cached_value(obj)
+            if cached is not _MISSING and cached == value:
+                return
             super(instrument_property, self).__set__(obj, value)
             obj._cache[name] = value
+            if self.ttl is not None:
+                expiry = _driver_state(obj, '_cache_expiry', dict)
+                expiry[name] = time.monotonic() + self.ttl
         else:
             super(instrument_property, self).__set__(obj, value)
+        for dependent in self.invalidates:
+            obj._cache.pop(dependent, None)
+
+    def cached_value(self, obj):
+        """Value of the property in the cache of a driver.
+
+        Returns
+        -------
+        value :
+            Cached value or _MISSING if the value is not cached or outdated.
+
+        """
+        value = obj._cache.get(self.name, _MISSING)
+        if value is not _MISSING and self.ttl is not None:
+            expiry = _driver_state(obj, '_cache_expiry', dict)
+            if time.monotonic() >= expiry.get(self.name, 0):
+                return _MISSING
+        return value
+
+    def _copy_options(self, prop):
+        """Copy the options of this property to a new one.
+
+        """
+        prop.ttl = self.ttl
+        prop.invalidates = self.invalidates
+        prop.type = self.type
+        prop.valid_values = self.valid_values
+        return prop
+
+
+def make_instrument_property(ttl=None, invalidates=()):
+    """Decorator building an instrument_property with options::
+
+        @make_instrument_property(ttl=1.0, invalidates=('sweep_x_axis',))
+        def sweep_type(self):
+            ...
+
+    See `instrument_property` for the meaning of the parameters.
+
+    """
+    def decorator(fget):
+        return instrument_property(fget, ttl=ttl, invalidates=invalidates)
+
+    return decorator
+
+
+def _driver_state(obj, name, factory):
+    """Attribute of a driver used by the instrument properties, created on
+    first use for the drivers which do not call BaseInstrument.__init__.
+
+    """
+    value = getattr(obj, name, None)
+    if value is None:
+        value = factory()
+        setattr(obj, name, value)
+    return value
 
 
 def secure_communication(max_iter=2):
@@ -119,15 +216,24 @@ def secure_communication(max_iter=2):
         @wraps(method)
         def wrapper(self, *args, **kwargs):
 
+            # Record the call and the number of attempts when tracing.
+            start = time.perf_counter() if TRACER.enabled else None
             i = 0
             # Try at most `max_iter` times to excute method
             while i < max_iter + 1:
                 try:
-                    return method(self, *args, **kwargs)
+                    result = method(self, *args, **kwargs)
+                    if start is not None:
+                        TRACER.record(self, 'call', method.__name__, start,
+                                      retries=i)
+                    return result
 
                 # Catch all the exception specified by the driver
-                except self.secure_com_except:
+                except self.secure_com_except as e:
                     if i == max_iter:
+                        if start is not None:
+                            TRACER.record(self, 'call', method.__name__,
+                                          start, retries=i, error=repr(e))
                         raise
                     else:
                         log = logging.getLogger(__name__)
@@ -264,6 +370,27 @@ class BaseInstrument(object):
     secure_com_except = (InstrIOError)
     owner = ''
 
+    #: Whether `batch` groups several commands in a single message. When
+    #: False `apply` does not use it.
+    scpi_batching = False
+
+    #: Instrument properties of the class by name, built once per class.
+    _instrument_properties = {}
+
+    def __init_subclass__(cls, **kwargs):
+        """Build the registry of the instrument properties of the class.
+
+        """
+        super(BaseInstrument, cls).__init_subclass__(**kwargs)
+        props = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, instrument_property):
+                    props[name] = value
+                else:
+                    props.pop(name, None)
+        cls._instrument_properties = props
+
     def __init__(self, connection_info, caching_allowed=True,
                  caching_permissions={}, auto_open=True):
         super(BaseInstrument, self).__init__()
@@ -276,6 +403,9 @@ class BaseInstrument(object):
         else:
             self._caching_permissions = set([])
         self._cache = {}
+        self._cache_expiry = {}
+        self._cache_hits = Counter()
+        self._cache_misses = Counter()
 
     def open_connection(self):
         """Open a connection to an instrument
@@ -327,6 +457,75 @@ class BaseInstrument(object):
             80)
         raise NotImplementedError(message)
 
+    @contextmanager
+    def batch(self, **kwargs):
+        """Group the commands sent to the instrument in a few messages.
+
+        The base implementation does nothing, drivers whose transport allows
+        it override this method.
+
+        """
+        yield
+
+    def apply(self, read_uncached=False, **settings):
+        """Set several settings sending only the ones which differ from the
+        known state of the instrument.
+
+        The settings are compared to the values cached by the instrument
+        properties (or to the current value of plain attributes) and only the
+        different ones are set, in the order in which they are given. For the
+        drivers supporting it (`scpi_batching`) they are set inside a `batch`
+        block, otherwise the setters are simply called one after the other.
+
+        Parameters
+        ----------
+        read_uncached : bool, optional
+            Read the current value of the instrument properties which are not
+            cached to compare them to the requested ones. By default these
+            properties are always set.
+
+        **settings :
+            Values of the properties or attributes to set.
+
+        Returns
+        -------
+        changed : dict
+            Settings which were actually set.
+
+        """
+        if self.scpi_batching:
+            with self.batch():
+                return self._apply(settings, read_uncached)
+        return self._apply(settings, read_uncached)
+
+    def _apply(self, settings, read_uncached):
+        """Set the settings differing from the known state.
+
+        """
+        changed = {}
+        props = self._instrument_properties
+        for name, value in settings.items():
+            prop = props.get(name)
+            if prop is None:
+                if not hasattr(self, name):
+                    msg = '{} has no attribute {}'
+                    raise AttributeError(msg.format(type(self).__name__,
+                                                    name))
+                current = getattr(self, name)
+            elif name in self._caching_permissions:
+                current = prop.cached_value(self)
+            elif read_uncached:
+                current = getattr(self, name)
+            else:
+                current = _MISSING
+
+            if current is not _MISSING and current == value:
+                continue
+            setattr(self, name, value)
+            changed[name] = value
+
+        return changed
+
     def clear_cache(self, properties=None):
         """ Clear the cache of all the properties or only the one of specified
         ones.
@@ -338,12 +537,12 @@ class BaseInstrument(object):
             will be cleared if not specified.
 
         """
-        test = lambda obj: isinstance(obj, instrument_property)
-        cache = self._cache
         if properties:
-            for name, instr_prop in inspect.getmembers(self.__class__, test):
-                if name in properties and name in cache:
-                    del cache[name]
+            cache = self._cache
+            props = self._instrument_properties
+            for name in properties:
+                if name in props:
+                    cache.pop(name, None)
         else:
             self._cache = {}
 
@@ -363,13 +562,21 @@ class BaseInstrument(object):
             None will be returned for the field with no cached value.
 
         """
-        test = lambda obj: isinstance(obj, instrument_property)
-        cache = {}
         if properties:
-            for name, instr_prop in inspect.getmembers(self.__class__, test):
-                if name in properties:
-                    cache[name] = self._cache.get(name)
+            props = self._instrument_properties
+            cache = {name: self._cache.get(name) for name in properties
+                     if name in props}
         else:
             cache = self._cache.copy()
 
         return cache
+
+    @property
+    def cache_stats(self):
+        """Number of cache hits and misses of each cached property.
+
+        """
+        hits = _driver_state(self, '_cache_hits', Counter)
+        misses = _driver_state(self, '_cache_misses', Counter)
+        return {name: {'hits': hits[name], 'misses': misses[name]}
+                for name in set(hits) | set(misses)}
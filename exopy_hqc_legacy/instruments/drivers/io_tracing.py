@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Opt-in tracing of the communications of the drivers.
+
+When enabled, the tracer records every message exchanged by the VISA drivers,
+every call made to a dll through DllLibrary.dll and every call of a method
+decorated by `secure_communication` (along with the number of times it had to
+be attempted again). The digitizers which do not rely on a DllLibrary
+(SPADQ14 and Alazar935x) are not traced. The latencies are aggregated in per
+driver and per command histograms and the events can be dumped as a Chrome
+trace (JSON timeline readable by chrome://tracing or Perfetto). When disabled
+the drivers only pay for the check of the `enabled` flag.
+
+:Contains:
+    LatencyHistogram :
+        Histogram of latencies using logarithmic bins.
+    IOTracer :
+        Recorder of the communications.
+    TRACER :
+        Tracer used by all the drivers.
+
+"""
+import os
+import json
+import time
+import threading
+from math import frexp
+from collections import deque, defaultdict, OrderedDict
+from contextlib import contextmanager
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies using logarithmic bins.
+
+    The bin i contains the latencies larger than `resolution*2**(i-1)` and
+    smaller or equal to `resolution*2**i` (the first one containing all the
+    latencies up to `resolution`).
+
+    Parameters
+    ----------
+    resolution : float, optional
+        Upper edge in seconds of the first bin.
+
+    bins : int, optional
+        Number of bins, the last one containing all the latencies larger than
+        its lower edge.
+
+    """
+    def __init__(self, resolution=1e-5, bins=24):
+        self.resolution = resolution
+        self.counts = [0]*bins
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    @property
+    def edges(self):
+        """Upper edges in seconds of the bins.
+
+        """
+        return [self.resolution*2**i for i in range(len(self.counts))]
+
+    @property
+    def mean(self):
+        """Mean latency in seconds.
+
+        """
+        return self.total/self.count if self.count else 0.
+
+    def add(self, latency):
+        """Add a latency (in seconds) to the histogram.
+
+        """
+        index = 0
+        if latency > self.resolution:
+            mantissa, exp = frexp(latency/self.resolution)
+            # A latency on an upper edge belongs to the lower bin.
+            if mantissa == 0.5:
+                exp -= 1
+            index = min(exp, len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += latency
+        if latency < self.min:
+            self.min = latency
+        if latency > self.max:
+            self.max = latency
+
+    def percentile(self, q):
+        """Estimate a percentile of the latencies.
+
+        The estimate is the upper edge of the bin containing the percentile
+        (bounded by the largest latency).
+
+        Parameters
+        ----------
+        q : float
+            Percentile to estimate, between 0 and 100.
+
+        """
+        if not self.count:
+            return 0.
+        threshold = q/100*self.count
+        cumulated = 0
+        # The last bin has no upper edge.
+        edges = self.edges[:-1] + [self.max]
+        for count, edge in zip(self.counts, edges):
+            cumulated += count
+            if count and cumulated >= threshold:
+                return min(edge, self.max)
+        return self.max
+
+    def as_dict(self):
+        """Summary of the histogram.
+
+        """
+        return OrderedDict([('count', self.count), ('total', self.total),
+                            ('mean', self.mean),
+                            ('min', self.min if self.count else 0.),
+                            ('max', self.max),
+                            ('p50', self.percentile(50)),
+                            ('p99', self.percentile(99)),
+                            ('counts', list(self.counts))])
+
+
+class IOTracer(object):
+    """Recorder of the communications of the drivers.
+
+    Parameters
+    ----------
+    max_events : int, optional
+        Maximal number of events kept for the timeline, the oldest events are
+        discarded first. The histograms are not affected by this limit.
+
+    """
+    def __init__(self, max_events=100000):
+        self.enabled = False
+        self.events = deque(maxlen=max_events)
+        self._histograms = defaultdict(dict)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        """Start recording the communications.
+
+        """
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording the communications.
+
+        """
+        self.enabled = False
+
+    def clear(self):
+        """Forget all the recorded events and histograms.
+
+        """
+        with self._lock:
+            self.events.clear()
+            self._histograms.clear()
+
+    @contextmanager
+    def tracing(self, path=None, clear=True):
+        """Record the communications made inside the block.
+
+        Parameters
+        ----------
+        path : str, optional
+            Path of a file in which to dump the Chrome trace on exit.
+
+        clear : bool, optional
+            Forget the previously recorded events before starting.
+
+        """
+        if clear:
+            self.clear()
+        previous = self.enabled
+        self.enabled = True
+        try:
+            yield self
+        finally:
+            self.enabled = previous
+            if path:
+                self.dump(path)
+
+    def call(self, driver, kind, command, func, *args, **kwargs):
+        """Call a function performing a communication and record it.
+
+        Parameters
+        ----------
+        driver : object
+            Driver performing the communication.
+
+        kind : str
+            Kind of communication (write, query, dll, ...).
+
+        command : str
+            Message sent or name of the function called.
+
+        func : callable
+            Function performing the communication.
+
+        *args, **kwargs :
+            Arguments passed to the function.
+
+        """
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record(driver, kind, command, start,
+                        nbytes=_size(command), error=repr(e))
+            raise
+        self.record(driver, kind, command, start,
+                    nbytes=_size(command) + _size(result))
+        return result
+
+    def record(self, driver, kind, command, start, nbytes=0, retries=0,
+               error=None):
+        """Record a communication which ended now.
+
+        Parameters
+        ----------
+        driver : object
+            Driver performing the communication.
+
+        kind : str
+            Kind of communication.
+
+        command : str
+            Message sent or name of the function called.
+
+        start : float
+            Value of time.perf_counter() at the beginning of the
+            communication.
+
+        nbytes : int, optional
+            Number of bytes exchanged.
+
+        retries : int, optional
+            Number of times the communication was attempted again.
+
+        error : str, optional
+            Error which interrupted the communication.
+
+        """
+        duration = time.perf_counter() - start
+        name = driver_name(driver)
+        event = (name, kind, str(command), start, duration, nbytes, retries,
+                 error, threading.get_ident())
+        key = (kind, command_header(command))
+        with self._lock:
+            self.events.append(event)
+            histograms = self._histograms[name]
+            if key not in histograms:
+                histograms[key] = LatencyHistogram()
+            histograms[key].add(duration)
+
+    def histograms(self):
+        """Copy of the latency histograms.
+
+        Returns
+        -------
+        histograms : dict
+            Histograms indexed by driver name and then by (kind, command
+            header) where the header is the command stripped from its
+            arguments.
+
+        """
+        with self._lock:
+            return {name: dict(histograms)
+                    for name, histograms in self._histograms.items()}
+
+    def summary(self):
+        """Summary of the latencies, the most time consuming commands first.
+
+        Returns
+        -------
+        summary : list
+            List of (driver name, kind, command header, histogram summary).
+
+        """
+        summary = [(name, kind, header, h.as_dict())
+                   for name, histograms in self.histograms().items()
+                   for (kind, header), h in histograms.items()]
+        summary.sort(key=lambda s: s[3]['total'], reverse=True)
+        return summary
+
+    def chrome_trace(self):
+        """Events formatted as a Chrome trace.
+
+        Each driver appears as a process and each thread as a thread of it.
+
+        """
+        with self._lock:
+            events = list(self.events)
+        pids = OrderedDict()
+        trace = []
+        for name, kind, command, start, duration, nbytes, retries, error,\
+                tid in events:
+            if name not in pids:
+                pids[name] = len(pids) + 1
+            args = {'bytes': nbytes, 'retries': retries}
+            if error:
+                args['error'] = error
+            trace.append({'name': command, 'cat': kind, 'ph': 'X',
+                          'ts': (start - self._origin)*1e6,
+                          'dur': duration*1e6, 'pid': pids[name], 'tid': tid,
+                          'args': args})
+        for name, pid in pids.items():
+            trace.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                          'args': {'name': name}})
+
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms',
+                'otherData': {'pid': os.getpid()}}
+
+    def dump(self, path):
+        """Write the Chrome trace and the latency summary in a JSON file.
+
+        """
+        trace = self.chrome_trace()
+        trace['otherData']['summary'] = [
+            OrderedDict([('driver', name), ('kind', kind),
+                         ('command', header)] + list(h.items()))
+            for name, kind, header, h in self.summary()]
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+
+
+#: Tracer used by all the drivers.
+TRACER = IOTracer()
+
+
+def driver_name(driver):
+    """Name under which the communications of a driver are recorded.
+
+    """
+    if isinstance(driver, str):
+        return driver
+    name = type(driver).__name__
+    connection = getattr(driver, 'connection_str', None)
+    if connection:
+        name += ' ({})'.format(connection)
+    return name
+
+
+def command_header(command):
+    """Strip the arguments of a command.
+
+    """
+    command = str(command)
+    return command.split(None, 1)[0] if command.strip() else command
+
+
+def _size(value):
+    """Estimate the number of bytes of a message or of an answer.
+
+    """
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    if isinstance(value, (list, tuple)):
+        return 8*len(value)
+    return 0
+
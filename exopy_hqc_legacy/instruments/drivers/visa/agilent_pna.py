@@ -16,7 +16,8 @@ import numpy as np
 from visa import VisaIOError, constants
 
 from ..driver_tools import (BaseInstrument, InstrIOError, InstrError,
-                            secure_communication, instrument_property)
+                            secure_communication, instrument_property,
+                            make_instrument_property)
 from ..visa_tools import VisaInstrument
 
 
@@ -46,6 +47,8 @@ class AgilentPNAChannel(BaseInstrument):
                            'average_count': True,
                            'average_mode': True}
 
+    scpi_batching = True
+
     def __init__(self, pna, channel_num, caching_allowed=True,
                  caching_permissions={}):
         super(AgilentPNAChannel, self).__init__(None, caching_allowed,
@@ -59,6 +62,12 @@ class AgilentPNAChannel(BaseInstrument):
         """
         self._pna.reopen_connection()
 
+    def batch(self, **kwargs):
+        """Group the commands sent through the PNA driver.
+
+        """
+        return self._pna.batch(**kwargs)
+
     @secure_communication()
     def read_formatted_data(self, meas_name=''):
         """ Read formatted data for a measure.
@@ -304,26 +313,29 @@ class AgilentPNAChannel(BaseInstrument):
     def prepare_sweep(self, sweep_type, start, stop, sweep_points):
         """
         """
+        self.clear_cache(['sweep_x_axis'])
         if sweep_type == 'FREQUENCY':
             self.sweep_type = 'LIN'
             self.sweep_points = sweep_points
-            self._pna.write('SENSe{}:FREQuency:STARt {}'.format(self._channel,
-                                                                start))
-            self._pna.write('SENSe{}:FREQuency:STOP {}'.format(self._channel,
-                                                               stop))
+            with self._pna.batch():
+                self._pna.write('SENSe{}:FREQuency:STARt {}'.format(
+                    self._channel, start))
+                self._pna.write('SENSe{}:FREQuency:STOP {}'.format(
+                    self._channel, stop))
         elif sweep_type == 'POWER':
             self.sweep_type = 'POW'
             self.sweep_points = sweep_points
-            self._pna.write('SOURce{}:POWer:STARt {}'.format(self._channel,
-                                                             start))
-            self._pna.write('SOURce{}:POWer:STOP {}'.format(self._channel,
-                                                            stop))
+            with self._pna.batch():
+                self._pna.write('SOURce{}:POWer:STARt {}'.format(
+                    self._channel, start))
+                self._pna.write('SOURce{}:POWer:STOP {}'.format(
+                    self._channel, stop))
         else:
             raise AgilentPNAChannelError(cleandoc('''Unsupported type of sweep
             : {} was specified for channel {}'''.format(sweep_type,
                                                      self._channel)))
 
-    @instrument_property
+    @make_instrument_property(invalidates=('sweep_x_axis',))
     @secure_communication()
     def frequency(self):
         """Frequency getter method
@@ -525,7 +537,7 @@ class AgilentPNAChannel(BaseInstrument):
             raise InstrIOError(cleandoc('''PNA did not set correctly the
                 channel {} sweep mode'''.format(self._channel)))
 
-    @instrument_property
+    @make_instrument_property(invalidates=('sweep_x_axis',))
     @secure_communication()
     def sweep_type(self):
         """
@@ -549,7 +561,7 @@ class AgilentPNAChannel(BaseInstrument):
             raise InstrIOError(cleandoc('''PNA did not set correctly the
                 channel {} sweep type'''.format(self._channel)))
 
-    @instrument_property
+    @make_instrument_property(invalidates=('sweep_x_axis',))
     @secure_communication()
     def sweep_points(self):
         """
@@ -707,6 +719,8 @@ class AgilentPNA(VisaInstrument):
                            'trigger_scope': True,
                            'data_format': True}
 
+    scpi_batching = True
+
     def __init__(self, connection_info, caching_allowed=True,
                  caching_permissions={}, auto_open=True):
         super(AgilentPNA, self).__init__(connection_info, caching_allowed,
@@ -51,6 +51,8 @@ class AgilentPSA(VisaInstrument):
                            'stop_frequency_SA': False,
                            'mode': False}
 
+    scpi_batching = True
+
     def __init__(self, connection_info, caching_allowed=True,
                  caching_permissions={}, auto_open=True):
         super(AgilentPSA, self).__init__(connection_info,
@@ -100,14 +102,15 @@ class AgilentPSA(VisaInstrument):
                        'mag vs freq in Vrms', 'average of mag vs freq in Vrms']
         if self.mode == 'SA':
 
-            # must be read in ASCii format
-            self.write("FORM:DATA ASCii")
-            # stop all the measurements
-            self.write(":ABORT")
-            # go to the "Single sweep" mode
-            self.write(":INIT:CONT OFF")
-            # initiate measurement
-            self.write(":INIT")
+            with self.batch():
+                # must be read in ASCii format
+                self.write("FORM:DATA ASCii")
+                # stop all the measurements
+                self.write(":ABORT")
+                # go to the "Single sweep" mode
+                self.write(":INIT:CONT OFF")
+                # initiate measurement
+                self.write(":INIT")
 
             #
             self.query("SWEEP:TIME?")
@@ -437,6 +437,8 @@ class AWG(VisaInstrument):
     """
     caching_permissions = {'defined_channels': True}
 
+    scpi_batching = True
+
     def __init__(self, connection_info, caching_allowed=True,
                  caching_permissions={}, auto_open=True):
         super(AWG, self).__init__(connection_info, caching_allowed,
@@ -510,9 +512,10 @@ class AWG(VisaInstrument):
         """Sets the goto value at position to goto
 
         """
-        self.write('SEQuence:ELEMent' + str(position) + ':GOTO:STATe 1')
-        self.write('SEQuence:ELEMent' + str(position) + ':GOTO:INDex ' +
-                   str(goto))
+        with self.batch():
+            self.write('SEQuence:ELEMent' + str(position) + ':GOTO:STATe 1')
+            self.write('SEQuence:ELEMent' + str(position) + ':GOTO:INDex ' +
+                       str(goto))
 
     @secure_communication()
     def set_repeat(self, position, repeat):
@@ -8,7 +8,24 @@
 # -----------------------------------------------------------------------------
 """Base classes for instrument relying on the VISA protocol.
 
+:Contains:
+    VisaSessionPool :
+        Process wide pool of VISA sessions sharing a single ResourceManager.
+    SESSION_ATTRIBUTES :
+        Attributes of the sessions restored when they are given back.
+    SESSION_POOL :
+        Pool used by default by the VisaInstrument.
+    VisaInstrument :
+        Base class for drivers using the VISA library.
+
 """
+import time
+import atexit
+import logging
+from threading import Lock
+from contextlib import contextmanager
+from collections import defaultdict
+
 try:
     from pyvisa.highlevel import ResourceManager
     from pyvisa import errors
@@ -17,6 +34,226 @@ except ImportError as e:
     raise ImportError(msg) from e
 
 from .driver_tools import BaseInstrument, InstrIOError
+from .io_tracing import TRACER
+
+
+#: Attributes of the sessions restored to their initial value when a session
+#: is given back to the pool.
+SESSION_ATTRIBUTES = ('timeout', 'query_delay', 'write_termination',
+                      'read_termination', 'chunk_size')
+
+
+class VisaSessionPool(object):
+    """Pool of VISA sessions shared by the drivers of a process.
+
+    All the sessions are opened by the same ResourceManager. A session is
+    used by a single driver at a time : when a driver closes its connection
+    the session is kept idle in the pool so that the next driver (or starter
+    check) connecting to the same resource can borrow it instead of opening
+    a new one. When a session is given back, the attributes listed in
+    SESSION_ATTRIBUTES are restored to the value they had when the session
+    was opened so that the settings of a driver do not leak to the next one.
+    Idle sessions are checked before being lent and are closed once they
+    have been idle for more than `idle_timeout` seconds.
+
+    Parameters
+    ----------
+    resource_manager : ResourceManager, optional
+        Manager used to open the sessions. By default a ResourceManager is
+        created on first use.
+
+    idle_timeout : float, optional
+        Time in seconds after which an idle session is closed.
+
+    max_idle : int, optional
+        Maximal number of idle sessions kept per resource.
+
+    """
+    def __init__(self, resource_manager=None, idle_timeout=60.,
+                 max_idle=1):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._rm = resource_manager
+        self._lock = Lock()
+        self._idle = defaultdict(list)
+        self._in_use = {}
+        self._defaults = {}
+        self._stats = dict.fromkeys(('opened', 'reused', 'released',
+                                     'closed', 'evicted', 'unhealthy'), 0)
+
+    @property
+    def resource_manager(self):
+        """ResourceManager used to open the sessions.
+
+        """
+        with self._lock:
+            if self._rm is None:
+                self._rm = ResourceManager()
+            return self._rm
+
+    @property
+    def stats(self):
+        """Counters of the pool operations along with the number of sessions
+        currently in use and idle.
+
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_use'] = len(self._in_use)
+            stats['idle'] = sum(len(s) for s in self._idle.values())
+        return stats
+
+    def acquire(self, resource_name, **para):
+        """Borrow a session to a resource, opening one if none is idle.
+
+        Parameters
+        ----------
+        resource_name : str
+            VISA resource name.
+
+        **para :
+            Attributes of the session (timeout, terminations, ...).
+
+        Returns
+        -------
+        session : pyvisa.resources.Resource
+            Open session to the resource.
+
+        """
+        self.evict_idle()
+        while True:
+            with self._lock:
+                idle = self._idle.get(resource_name)
+                if not idle:
+                    break
+                session, _ = idle.pop()
+            if self._check(session):
+                try:
+                    self._set_attributes(session, para)
+                except Exception:
+                    self._close(session, 'unhealthy')
+                    raise
+                with self._lock:
+                    self._stats['reused'] += 1
+                    self._in_use[id(session)] = resource_name
+                return session
+            self._close(session, 'unhealthy')
+
+        session = self.resource_manager.open_resource(resource_name,
+                                                      open_timeout=1000)
+        defaults = {}
+        for key in SESSION_ATTRIBUTES:
+            try:
+                defaults[key] = getattr(session, key)
+            except Exception:
+                pass
+        with self._lock:
+            self._stats['opened'] += 1
+            self._in_use[id(session)] = resource_name
+            self._defaults[id(session)] = defaults
+        try:
+            self._set_attributes(session, para)
+        except Exception:
+            self.discard(session)
+            raise
+        return session
+
+    def release(self, session):
+        """Give back a session to the pool.
+
+        """
+        with self._lock:
+            resource_name = self._in_use.pop(id(session), None)
+            self._stats['released'] += 1
+            keep = (resource_name is not None and self.idle_timeout > 0 and
+                    len(self._idle[resource_name]) < self.max_idle)
+            defaults = self._defaults.get(id(session), {})
+        if keep:
+            try:
+                self._set_attributes(session, defaults)
+            except Exception:
+                keep = False
+        if keep:
+            with self._lock:
+                self._idle[resource_name].append((session, time.monotonic()))
+        else:
+            self._close(session, 'closed')
+        self.evict_idle()
+
+    def discard(self, session):
+        """Close a session whose state is suspect instead of giving it back.
+
+        """
+        with self._lock:
+            self._in_use.pop(id(session), None)
+        self._close(session, 'closed')
+
+    def evict_idle(self):
+        """Close the sessions idle for more than `idle_timeout`.
+
+        """
+        limit = time.monotonic() - self.idle_timeout
+        evicted = []
+        with self._lock:
+            for name, idle in list(self._idle.items()):
+                evicted.extend(s for s, t in idle if t <= limit)
+                idle[:] = [(s, t) for s, t in idle if t > limit]
+                if not idle:
+                    del self._idle[name]
+        for session in evicted:
+            self._close(session, 'evicted')
+
+    def close_idle(self):
+        """Close all the idle sessions.
+
+        """
+        with self._lock:
+            idle = [s for sessions in self._idle.values()
+                    for s, _ in sessions]
+            self._idle.clear()
+        for session in idle:
+            self._close(session, 'evicted')
+
+    def _check(self, session):
+        """Check that an idle session can still be used.
+
+        This is only a local check : it reads an attribute of the session,
+        which fails if the VISA library closed the session, but it does not
+        communicate with the instrument.
+
+        """
+        try:
+            session.timeout
+        except Exception:
+            return False
+        return True
+
+    def _set_attributes(self, session, attributes):
+        """Set the attributes of a session.
+
+        """
+        for key, value in attributes.items():
+            setattr(session, key, value)
+
+    def _close(self, session, counter):
+        """Close a session, logging failures.
+
+        """
+        with self._lock:
+            self._stats[counter] += 1
+            self._defaults.pop(id(session), None)
+        try:
+            session.close()
+        except Exception:
+            logger = logging.getLogger(__name__)
+            logger.debug('Failed to close VISA session %s', session,
+                         exc_info=True)
+
+
+#: Pool used by default by the VisaInstrument.
+SESSION_POOL = VisaSessionPool()
+
+atexit.register(SESSION_POOL.close_idle)
 
 
 class VisaInstrument(BaseInstrument):
@@ -81,6 +318,18 @@ class VisaInstrument(BaseInstrument):
     """
     secure_com_except = (InstrIOError, errors.VisaIOError)
 
+    #: Pool from which the sessions are borrowed.
+    session_pool = SESSION_POOL
+
+    #: Maximal number of commands sent in a single message by `batch`.
+    batch_max_commands = 20
+
+    #: Maximal length in characters of a message sent by `batch`.
+    batch_max_length = 512
+
+    #: Query returning the oldest error of the instrument error queue.
+    error_query = 'SYST:ERR?'
+
     def __init__(self, connection_info, caching_allowed=True,
                  caching_permissions={}, auto_open=True):
         super(VisaInstrument, self).__init__(connection_info, caching_allowed,
@@ -88,6 +337,7 @@ class VisaInstrument(BaseInstrument):
         self.connection_str = connection_info['resource_name']
 
         self._driver = None
+        self._batch = None
         if auto_open:
             self.open_connection()
 
@@ -95,10 +345,9 @@ class VisaInstrument(BaseInstrument):
         """Open the connection to the instr using the `connection_str`.
 
         """
-        rm = ResourceManager()
         try:
-            self._driver = rm.open_resource(self.connection_str,
-                                            open_timeout=1000, **para)
+            self._driver = self.session_pool.acquire(self.connection_str,
+                                                     **para)
         except errors.VisaIOError as er:
             self._driver = None
             raise InstrIOError(str(er))
@@ -106,9 +355,11 @@ class VisaInstrument(BaseInstrument):
     def close_connection(self):
         """Close the connection to the instr.
 
+        The session is given back to the pool which may re-use it.
+
         """
         if self._driver:
-            self._driver.close()
+            self.session_pool.release(self._driver)
         self._driver = None
         return True
 
@@ -116,13 +367,15 @@ class VisaInstrument(BaseInstrument):
         """Reopen the connection with the instrument with the same parameters
         as previously.
 
+        The previous session being suspect it is closed and not re-used.
+
         """
         para = {'timeout': self._driver.timeout,
                 'query_delay': self._driver.query_delay,
                 'write_termination': self._driver.write_termination,
                 'read_termination': self._driver.read_termination,
                 }
-        self._driver.close()
+        self.session_pool.discard(self._driver)
         self.open_connection(**para)
 
     def connected(self):
@@ -134,9 +387,144 @@ class VisaInstrument(BaseInstrument):
         """Send the specified message to the instrument.
 
         Simply call the `write` method of the `Instrument` object stored in
-        the attribute `_driver`
+        the attribute `_driver`. Inside a `batch` block the message is only
+        queued.
+        """
+        if self._batch is not None:
+            self._batch.append(message)
+            return
+        self._traced('write', message, self._driver.write, message)
+
+    @contextmanager
+    def batch(self, opc=False, check_errors=False, max_commands=None,
+              max_length=None):
+        """Queue the writes and send them as a few `;` joined SCPI messages.
+
+        This only applies to the drivers setting `scpi_batching` to True
+        (whose instrument accepts several SCPI commands in a message),
+        for the others the commands are sent one by one as they are written
+        and only the `opc` and `check_errors` options are honoured.
+
+        The queued commands are sent when the block exits, or before any
+        read or query made inside the block so that the instrument answers
+        in a consistent state. Each command is made absolute (prefixed by
+        ':') unless it is a common command ('*...'), so that the SCPI path of
+        a command does not depend on the previous one. If the block raises,
+        the queued commands are not sent. Nested blocks are merged into the
+        outermost one.
+
+        Parameters
+        ----------
+        opc : bool, optional
+            Wait for the commands to be executed by querying '*OPC?' once
+            after sending them.
+
+        check_errors : bool, optional
+            Drain the error queue of the instrument (using `error_query`)
+            after sending the commands and raise an InstrIOError listing the
+            errors.
+
+        max_commands : int, optional
+            Maximal number of commands per message, `batch_max_commands` by
+            default.
+
+        max_length : int, optional
+            Maximal length of a message, `batch_max_length` by default.
+
+        """
+        if self._batch is not None:
+            yield
+            return
+
+        if not self.scpi_batching:
+            yield
+            commands = None
+        else:
+            self._batch = []
+            self._batch_limits = (max_commands or self.batch_max_commands,
+                                  max_length or self.batch_max_length)
+            try:
+                yield
+            except Exception:
+                self._batch = None
+                raise
+
+            commands = list(self._batch)
+            self._flush_batch()
+            self._batch = None
+
+        if opc:
+            self._traced('query', '*OPC?', self._driver.query, '*OPC?')
+        if check_errors:
+            errs = self.drain_errors()
+            if errs:
+                if commands is None:
+                    msg = 'Errors raised by the instrument :\n{}'
+                    raise InstrIOError(msg.format('\n'.join(errs)))
+                msg = 'Errors raised by the commands {} :\n{}'
+                raise InstrIOError(msg.format(commands, '\n'.join(errs)))
+
+    def drain_errors(self, max_errors=50):
+        """Read the errors stored in the error queue of the instrument.
+
+        Returns
+        -------
+        errors : list
+            Messages of the errors, oldest first.
+
+        """
+        errs = []
+        for _ in range(max_errors):
+            answer = self._traced('query', self.error_query,
+                                  self._driver.query,
+                                  self.error_query).strip()
+            try:
+                code = int(answer.split(',')[0])
+            except ValueError:
+                code = -1
+            if code == 0:
+                break
+            errs.append(answer)
+        return errs
+
+    def _flush_batch(self):
+        """Send the commands queued by `batch`.
+
+        """
+        if not self._batch:
+            return
+        max_commands, max_length = self._batch_limits
+        commands = [c if c.startswith((':', '*')) else ':' + c
+                    for c in self._batch]
+        # Empty the queue before sending so that the commands are not sent
+        # twice if the communication fails.
+        self._batch[:] = []
+        message = []
+        length = 0
+        for command in commands:
+            if message and (len(message) == max_commands or
+                            length + 1 + len(command) > max_length):
+                self._write_batch(message)
+                message = []
+                length = 0
+            length += len(command) + bool(message)
+            message.append(command)
+        self._write_batch(message)
+
+    def _write_batch(self, commands):
+        """Send a message made of several commands.
+
+        """
+        message = ';'.join(commands)
+        self._traced('write', message, self._driver.write, message)
+
+    def _traced(self, kind, command, method, *args):
+        """Call a method of the session, recording it if tracing is enabled.
+
         """
-        self._driver.write(message)
+        if TRACER.enabled:
+            return TRACER.call(self, kind, command, method, *args)
+        return method(*args)
 
     def read(self):
         """Read one line of the instrument's buffer.
@@ -144,7 +532,8 @@ class VisaInstrument(BaseInstrument):
         Simply call the `read` method of the `Instrument` object stored in
         the attribute `_driver`
         """
-        return self._driver.read()
+        self._flush_batch()
+        return self._traced('read', 'read', self._driver.read)
 
     def read_values(self, format=0):
         """Read one line of the instrument's buffer and convert to values.
@@ -152,6 +541,7 @@ class VisaInstrument(BaseInstrument):
         Simply call the `read_values` method of the `Instrument` object
         stored in the attribute `_driver`
         """
+        self._flush_batch()
         return self._driver.read_values(format=0)
 
     def read_ascii_values(self, converter='f', separator=','):
@@ -162,6 +552,7 @@ class VisaInstrument(BaseInstrument):
         Simply call the `read_ascii_values` method of the `Instrument` object
         stored in the attribute `_driver`
         """
+        self._flush_batch()
         return self._driver.read_ascii_values(converter, separator)
 
     def read_binary_values(self, datatype='f', is_big_endian=False):
@@ -172,6 +563,7 @@ class VisaInstrument(BaseInstrument):
         Simply call the `read_binary_values` method of the `Instrument` object
         stored in the attribute `_driver`
         """
+        self._flush_batch()
         return self._driver.read_binary_values(datatype, is_big_endian)
 
     def query(self, message):
@@ -180,7 +572,8 @@ class VisaInstrument(BaseInstrument):
         Simply call the `query` method of the `Instrument` object stored in
         the attribute `_driver`
         """
-        return self._driver.query(message)
+        self._flush_batch()
+        return self._traced('query', message, self._driver.query, message)
 
     def query_ascii_values(self, message, converter='f', separator=','):
         """Send the specified message to the instrument and convert its answer
@@ -192,7 +585,10 @@ class VisaInstrument(BaseInstrument):
         stored in the attribute `_driver`
 
         """
-        return self._driver.query_ascii_values(message, converter, separator)
+        self._flush_batch()
+        return self._traced('query', message,
+                            self._driver.query_ascii_values, message,
+                            converter, separator)
 
     def query_binary_values(self, message, datatype='f', is_big_endian=False):
         """Send the specified message to the instrument and convert its answer
@@ -204,7 +600,10 @@ class VisaInstrument(BaseInstrument):
         stored in the attribute `_driver`
 
         """
-        return self._driver.query_binary_values(message, datatype, is_big_endian)
+        self._flush_batch()
+        return self._traced('query', message,
+                            self._driver.query_binary_values, message,
+                            datatype, is_big_endian)
 
     def clear(self):
         """Resets the device (highly bus dependent).
@@ -212,6 +611,7 @@ class VisaInstrument(BaseInstrument):
         Simply call the `clear` method of the `Instrument` object stored in
         the attribute `_driver`
         """
+        self._flush_batch()
         return self._driver.clear()
 
     def trigger(self):
@@ -220,6 +620,7 @@ class VisaInstrument(BaseInstrument):
         Simply call the `trigger` method of the `Instrument` object stored
         in the attribute `_driver`
         """
+        self._flush_batch()
         return self._driver.assert_trigger()
 
     def read_raw(self):
@@ -229,7 +630,8 @@ class VisaInstrument(BaseInstrument):
         Simply call the `read_raw` method of the `Instrument` object stored
         in the attribute `_driver`
         """
-        return self._driver.read_raw()
+        self._flush_batch()
+        return self._traced('read', 'read_raw', self._driver.read_raw)
 
     def _timeout(self):
         return self._driver.timeout
@@ -192,24 +192,20 @@ class PNASinglePointMeasureTask(SingleChannelPNATask):
         if self.driver.owner != self.name:
             self.driver.owner = self.name
             self.driver.set_all_chanel_to_hold()
-            self.driver.trigger_scope = 'CURRent'
-            if self.if_bandwidth >= 5:
-                self.driver.trigger_source = 'IMMediate'
-            else:
-                self.driver.trigger_source = 'MANual'
+            source = 'IMMediate' if self.if_bandwidth >= 5 else 'MANual'
+            self.driver.apply(trigger_scope='CURRent', trigger_source=source)
 
         meas_names = ['Ch{}:'.format(self.channel) + ':'.join(measure)
                       for measure in self.measures]
 
         if self.channel_driver.owner != self.name:
             self.channel_driver.owner = self.name
-            self.channel_driver.if_bandwidth = self.if_bandwidth
             # Avoid the PNA doing stupid things if it was doing a sweep
             # previously
             freq = self.channel_driver.frequency
             power = self.channel_driver.power
-            self.channel_driver.sweep_type = 'LIN'
-            self.channel_driver.sweep_points = 1
+            self.channel_driver.apply(if_bandwidth=self.if_bandwidth,
+                                      sweep_type='LIN', sweep_points=1)
             self.channel_driver.clear_cache(['frequency', 'power'])
             self.channel_driver.frequency = freq
             self.channel_driver.power = power
@@ -323,8 +319,7 @@ class PNASweepTask(SingleChannelPNATask):
         if self.driver.owner != self.name:
             self.driver.owner = self.name
             self.driver.set_all_chanel_to_hold()
-            self.driver.trigger_scope = 'CURRent'
-            self.driver.trigger_source = 'MANual'
+            self.driver.apply(trigger_scope='CURRent', trigger_source='MANual')
 
         meas_names = ['Ch{}:'.format(self.channel) + ':'.join(measure)
                       for measure in self.measures]
@@ -10,11 +10,17 @@
 
 """
 import numbers
+import logging
+
 import numpy as np
 from atom.api import (Bool, Str, Enum, set_default)
 
 from exopy.tasks.api import InstrumentTask, validators
 
+from exopy_hqc_legacy.utils.demodulation import (demodulation_kernel,
+                                                demodulate,
+                                                demodulate_periods)
+
 VAL_REAL = validators.Feval(types=numbers.Real)
 
 VAL_INT = validators.Feval(types=numbers.Integral)
@@ -72,6 +78,22 @@ class DemodSPTask(InstrumentTask):
     #: Sampling rate in samples per second
     sampling_rate = Str('500000000').tag(pref=True, feval=VAL_INT)
 
+    #: Number of host buffers used to transfer the data from the card.
+    buffer_count = Str('4').tag(pref=True, feval=VAL_INT)
+
+    #: Maximal size of a host buffer (MB).
+    buffer_size = Str('1').tag(pref=True, feval=VAL_REAL)
+
+    #: Maximal time (s) allowed for an acquisition, after which the
+    #: measurement stops (for example because the triggers are missing).
+    timeout = Str('60').tag(pref=True, feval=VAL_REAL)
+
+    #: Behaviour when clipped samples are acquired: stop the measurement or
+    #: only log a warning describing the clipped records. By default the
+    #: historical behaviour of the driver is kept (the Alazar stops the
+    #: measurement, the ADQ14 only warns).
+    on_saturation = Enum('Default', 'Stop', 'Warn').tag(pref=True)
+
     database_entries = set_default({'Ch1_I': 1.0, 'Ch1_Q': 1.0,
                                     'Ch2_I': 1.0, 'Ch2_Q': 1.0})
 
@@ -117,6 +139,11 @@ class DemodSPTask(InstrumentTask):
             phi2 = np.linspace(0, 2*np.pi*locs['freq_2']*locs['duration'], p2)
             self.write_in_database('Ch2_trace', np.sin(phi2))
 
+        if self.format_and_eval_string(self.timeout) <= 0:
+            test = False
+            traceback[self.get_error_path() + '-timeout'] = \
+                'The timeout must be positive.'
+
         if ((self.ref2 and self.average == 'Avg before demod') or
                 (self.ref2 and not (self.ch1_enabled and self.ch2_enabled))):
             test = False
@@ -144,11 +171,51 @@ class DemodSPTask(InstrumentTask):
         delay = self.format_and_eval_string(self.delay)*1e-9
         duration = self.format_and_eval_string(self.duration)*1e-9
         sampling_rate = self.format_and_eval_string(self.sampling_rate)
+        buffer_count = self.format_and_eval_string(self.buffer_count)
+        buffer_size = self.format_and_eval_string(self.buffer_size)*1e6
+        timeout = self.format_and_eval_string(self.timeout)
 
         channels = (self.ch1_enabled, self.ch2_enabled)
 
+        # When the raw traces of a channel are not needed, the driver
+        # demodulates the records as they are acquired so that the full
+        # records are never kept in memory. Otherwise the records are
+        # returned as raw samples and converted by chunks when demodulating.
+        kernels = [None, None]
+        if not avg_bef_demod:
+            samples_per_trace = self.driver.samples_per_record(duration)
+            for index in (1, 2):
+                if (not channels[index-1] or
+                        getattr(self, 'ch%d_trace' % index) or
+                        (index == 1 and self.ref2 and self.ch1_trace)):
+                    continue
+                freq = self.format_and_eval_string(getattr(self, 'freq_%d' %
+                                                           index))*1e6
+                samples_per_period = int(sampling_rate/freq)
+                nsamples = (samples_per_trace -
+                            samples_per_trace % samples_per_period)
+                # View the complex kernel as the (cos, sin) pairs expected by
+                # the driver.
+                kernel = demodulation_kernel(freq, sampling_rate, nsamples)
+                kernels[index-1] = kernel.view(np.float64).reshape(-1, 2)
+
+        options = {}
+        if self.on_saturation != 'Default':
+            options['on_saturation'] = ('raise' if self.on_saturation ==
+                                        'Stop' else 'report')
         traces = self.driver.get_traces(channels, duration, delay,
-                                        records_number, average=avg_bef_demod)
+                                        records_number, average=avg_bef_demod,
+                                        buffer_count=buffer_count,
+                                        buffer_size=int(buffer_size),
+                                        demod_kernels=kernels,
+                                        output=('raw' if not avg_bef_demod
+                                                else None),
+                                        timeout=timeout, **options)
+        report = self.driver.saturation_report
+        if report.saturated:
+            log = logging.getLogger()
+            log.warning('In {}, the acquired signal is clipped:\n{}'
+                        .format(self.name, report))
 
         def treat_channel_data(index):
             """Treat the data of a channel.
@@ -158,53 +225,50 @@ class DemodSPTask(InstrumentTask):
             freq = self.format_and_eval_string(getattr(self,
                                                        'freq_%d' % index))*1e6
 
-            # Remove points that do not belong to a full period.
-            samples_per_period = int(sampling_rate/freq)
-            samples_per_trace = int(ch.shape[-1])
-            if (samples_per_trace % samples_per_period) != 0:
-                extra = samples_per_trace % samples_per_period
-                ch = ch.T[:-extra].T
+            # The driver already computed the quadratures of each record.
+            kernel = kernels[index-1]
+            if kernel is not None:
+                ch_c = ch.view(np.complex128).reshape(-1, num_loop)
+                ch_c *= 2/len(kernel)
 
-            if not avg_bef_demod:
-                ntraces, nsamples = np.shape(ch)
-                ch = ch.reshape(int(ntraces/num_loop), num_loop, nsamples)
             else:
-                nsamples = np.shape(ch)[0]
-            phi = np.linspace(0, 2*np.pi*freq*((nsamples-1)*2e-9), nsamples)
-            cosin = np.cos(phi)
-            sinus = np.sin(phi)
-            # The mean value of cos^2 is 0.5 hence the factor 2 to get the
-            # amplitude.
+                # Remove points that do not belong to a full period.
+                samples_per_period = int(sampling_rate/freq)
+                samples_per_trace = int(ch.shape[-1])
+                nsamples = (samples_per_trace -
+                            samples_per_trace % samples_per_period)
+                kernel = demodulation_kernel(freq, sampling_rate, nsamples)
+
+                if not avg_bef_demod:
+                    ch_c = demodulate(ch, kernel, num_loop)
+                else:
+                    ch_c = None
+                    ch_av = demodulate(ch[np.newaxis], kernel)[0, 0]
+
             if not avg_bef_demod:
-                ch_i = 2*np.mean(ch*cosin, axis=2)
-                ch_q = 2*np.mean(ch*sinus, axis=2)
-                ch_i_av = ch_i.T[0] if not avg_aft_demod else np.mean(ch_i,
-                                                                      axis=0)
-                ch_q_av = ch_q.T[0] if not avg_aft_demod else np.mean(ch_q,
-                                                                      axis=0)
-            else:
-                ch_i = None
-                ch_q = None
-                ch_i_av = 2*np.mean(ch*cosin)
-                ch_q_av = 2*np.mean(ch*sinus)
-            self.write_in_database('Ch%d_I' % index, ch_i_av)
-            self.write_in_database('Ch%d_Q' % index, ch_q_av)
+                ch_av = ch_c.T[0] if not avg_aft_demod else np.mean(ch_c,
+                                                                     axis=0)
+            self.write_in_database('Ch%d_I' % index, np.real(ch_av))
+            self.write_in_database('Ch%d_Q' % index, np.imag(ch_av))
 
             if getattr(self, 'ch%d_trace' % index):
+                # Raw records are converted only here (once).
+                ch = ch[..., :nsamples]
+                if not avg_bef_demod:
+                    ch = ch.reshape(-1, num_loop, nsamples)
                 ch_av = ch if not avg_aft_demod else np.mean(ch, axis=0)
                 self.write_in_database('Ch%d_trace' % index, ch_av)
 
-            return freq, cosin, sinus, ch_i, ch_q
+            return freq, kernel, ch_c
 
         if self.ch1_enabled:
-            freq, cosin, sinus, ch1_i, ch1_q = treat_channel_data(1)
+            freq, kernel, ch1_c = treat_channel_data(1)
 
         if self.ch2_enabled:
-            _, _, _, ch2_i, ch2_q = treat_channel_data(2)
+            _, _, ch2_c = treat_channel_data(2)
 
         if self.ref2:
-            ch2_c = ch2_i + 1j*ch2_q
-            normed = (ch1_i + 1j*ch1_q)/ch2_c
+            normed = ch1_c/ch2_c
             chc_i = np.real(normed)
             chc_q = np.imag(normed)
             # TODO ZL RL: quick fix for single shot data, need to do this
@@ -214,38 +278,20 @@ class DemodSPTask(InstrumentTask):
             self.write_in_database('Chc_I', chc_i_av)
             self.write_in_database('Chc_Q', chc_q_av)
             if self.ch1_trace:
-                ch1 = traces[0]
-                ntraces1, _ = np.shape(ch1)
+                # Compute I and Q per period and normalize them by the
+                # reference of the record.
                 samples_per_period = int(sampling_rate/freq)
-
-                samples_per_trace = int(ch1.shape[-1])
-                ch1_c1 = ch1*cosin
-                ch1_s1 = ch1*sinus
-
-                # We crunch a single dimension to compute I and Q per period
-                shape = (int(ntraces1/num_loop), num_loop,
-                         samples_per_trace//(samples_per_period),
-                         samples_per_period)
-
-                ch1_c1 = ch1_c1.reshape(shape)
-                ch1_i_t = 2*np.mean(ch1_c1, axis=3)
-                ch1_s1 = ch1_s1.reshape(shape)
-                ch1_q_t = 2*np.mean(ch1_s1, axis=3)
-
-                ch1_c_t = ch1_i_t + 1j*ch1_q_t
-                chc_c_t = np.swapaxes(np.swapaxes(ch1_c_t, 0, 2)/ch2_c.T, 0, 2)
-                chc_i_t = np.real(chc_c_t)
-                chc_q_t = np.imag(chc_c_t)
+                chc_c_t = demodulate_periods(traces[0], kernel,
+                                             samples_per_period, num_loop)
+                chc_c_t /= ch2_c[..., np.newaxis]
 
                 if not avg_aft_demod:
-                    chc_i_t_av = np.swapaxes(chc_i_t, 0, 1)[0]
-                    chc_q_t_av = np.swapaxes(chc_q_t, 0, 1)[0]
+                    chc_c_t_av = chc_c_t[:, 0]
                 else:
-                    chc_i_t_av = np.mean(chc_i_t, axis=0)
-                    chc_q_t_av = np.mean(chc_q_t, axis=0)
+                    chc_c_t_av = np.mean(chc_c_t, axis=0)
 
-                self.write_in_database('Chc_I_trace', chc_i_t_av)
-                self.write_in_database('Chc_Q_trace', chc_q_t_av)
+                self.write_in_database('Chc_I_trace', np.real(chc_c_t_av))
+                self.write_in_database('Chc_Q_trace', np.imag(chc_c_t_av))
 
     def _post_setattr_ch1_enabled(self, old, new):
         """Update the database entries based on the enabled channels.
@@ -9,13 +9,242 @@
 """Tasks to operate on numpy.arrays.
 
 """
+from weakref import ref
+from collections import OrderedDict
+
 import numpy as np
-from atom.api import (Enum, Str, set_default)
+from atom.api import (Bool, Enum, Str, Typed, Value, set_default)
 from exopy.tasks.api import SimpleTask, validators
+from exopy.utils.atom_util import ordered_dict_from_pref, ordered_dict_to_pref
 
 
 ARR_VAL = validators.Feval(types=np.ndarray)
 
+#: Approximate size in bytes of the blocks of an array processed at once.
+CHUNK_BYTES = 2**20
+
+#: Tolerance used when looking for a value in an array.
+MATCH_TOLERANCE = 1e-12
+
+#: Operations supported by reduce_array and whether they need a value.
+REDUCE_OPERATIONS = OrderedDict([('max', False), ('min', False),
+                                 ('argmax', False), ('argmin', False),
+                                 ('first', True), ('nearest', True),
+                                 ('nearest_sorted', True)])
+
+
+def reduce_array(array, operations):
+    """Apply several reductions to the columns of an array in a single pass.
+
+    The array is processed by blocks of about `CHUNK_BYTES` and all the
+    operations are applied to a block before moving to the next one. The
+    'first' operations stop as soon as a match is found, and the
+    'nearest_sorted' operations use a binary search and do not need to look
+    at the whole column.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        Structured array or 1D array.
+
+    operations : list
+        List of (column, operation, value) tuples. The column should be empty
+        for a 1D array. The supported operations are:
+
+        - 'max', 'min': extremum of the column
+        - 'argmax', 'argmin': index of the first extremum of the column
+        - 'first': index of the first element equal to value
+        - 'nearest': index of the element closest to value
+        - 'nearest_sorted': same as 'nearest' for a column sorted in
+          increasing order, which is not checked
+
+    Returns
+    -------
+    results : list
+        Result of each operation.
+
+    """
+    results = [None]*len(operations)
+    best = {}
+    pending = []
+    for i, (column, op, value) in enumerate(operations):
+        if op not in REDUCE_OPERATIONS:
+            raise ValueError('Unknown operation {}'.format(op))
+        if op == 'nearest_sorted':
+            data = array[column] if column else array
+            results[i] = _nearest_sorted(data, value)
+            continue
+        pending.append(i)
+
+    rows = max(1, CHUNK_BYTES//max(1, array.itemsize))
+    for start in range(0, len(array), rows):
+        if not pending:
+            break
+        block = array[start:start+rows]
+        for i in list(pending):
+            column, op, value = operations[i]
+            data = block[column] if column else block
+            if op in ('max', 'argmax'):
+                j = np.argmax(data)
+                _keep_best(best, i, start + j, data[j], greater=True)
+            elif op in ('min', 'argmin'):
+                j = np.argmin(data)
+                _keep_best(best, i, start + j, data[j], greater=False)
+            elif op == 'nearest':
+                distances = np.abs(data - value)
+                j = np.argmin(distances)
+                _keep_best(best, i, start + j, distances[j], greater=False)
+            else:
+                hits = np.flatnonzero(np.abs(data - value) < MATCH_TOLERANCE)
+                if hits.size:
+                    results[i] = start + int(hits[0])
+                    pending.remove(i)
+
+    for i in pending:
+        column, op, value = operations[i]
+        if op == 'first':
+            msg = 'Could not find {} in column {!r} of the array'
+            raise ValueError(msg.format(value, column))
+        if i not in best:
+            raise ValueError('Cannot apply {} to an empty array'.format(op))
+        index, extremum = best[i]
+        results[i] = extremum if op in ('max', 'min') else index
+
+    return results
+
+
+def as_reduce_operation(spec):
+    """Convert the description of an operation to a (column, op, value) tuple.
+
+    Empty descriptions (such as the ones of the entries newly added in the
+    editor) are converted to a 'max' operation.
+
+    """
+    if not spec:
+        return ('', 'max', '')
+    column, op, value = spec
+    return (column, op, value)
+
+
+def find_first(array, value):
+    """Find the index of the first element of a 1D array equal to value.
+
+    The array is scanned by blocks so that only the part of the array
+    preceding the match is looked at.
+
+    Returns
+    -------
+    index : int or None
+        Index of the first match, None if there is none.
+
+    """
+    rows = max(1, CHUNK_BYTES//max(1, array.itemsize))
+    for start in range(0, len(array), rows):
+        block = array[start:start+rows]
+        hits = np.flatnonzero(np.abs(block - value) < MATCH_TOLERANCE)
+        if hits.size:
+            return start + int(hits[0])
+    return None
+
+
+class SortedIndex(object):
+    """Sorted copy of a 1D array used to find values by binary search.
+
+    Building the index costs a sort of the array, after which looking for a
+    value costs O(log n) instead of O(n).
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        1D array to index.
+
+    """
+    def __init__(self, data):
+        # A stable sort keeps the equal values in their original order.
+        self.order = np.argsort(data, kind='stable')
+        self.values = data[self.order]
+
+    def find_first(self, value, tolerance=MATCH_TOLERANCE):
+        """Find the index of the first element equal to value.
+
+        Returns
+        -------
+        index : int or None
+            Index in the original array of the first match, None if there is
+            none.
+
+        """
+        start = np.searchsorted(self.values, value - tolerance, 'right')
+        stop = np.searchsorted(self.values, value + tolerance, 'left')
+        if start >= stop:
+            return None
+        return int(self.order[start:stop].min())
+
+
+def _is_frozen(data):
+    """Check that neither an array nor the arrays it is a view of can be
+    modified.
+
+    """
+    while isinstance(data, np.ndarray):
+        if data.flags.writeable:
+            return False
+        data = data.base
+    return True
+
+
+def _keep_best(best, key, index, value, greater):
+    """Keep the first of the largest (or smallest) values seen so far.
+
+    NaN are considered larger (or smaller) than everything as for argmax.
+
+    """
+    if key in best:
+        old = best[key][1]
+        if np.isnan(old) or (value <= old if greater else value >= old):
+            return
+    best[key] = (index, value)
+
+
+def _nearest_sorted(data, value):
+    """Index of the element of a sorted 1D array closest to value.
+
+    """
+    if not len(data):
+        raise ValueError('Cannot apply nearest to an empty array')
+    i = int(np.searchsorted(data, value))
+    if i == len(data) or (i and value - data[i-1] <= data[i] - value):
+        return i - 1
+    return i
+
+
+def _check_column(array, column_name):
+    """Check that a column can be extracted from an array.
+
+    Returns
+    -------
+    msg : str
+        Error message, empty if the column is valid.
+
+    """
+    if column_name:
+        if array.dtype.names:
+            names = array.dtype.names
+            if column_name not in names:
+                msg = 'No column named {} in array. (column are : {})'
+                return msg.format(column_name, names)
+        else:
+            return 'Array has no named columns'
+
+    else:
+        if array.dtype.names:
+            msg = 'The target array has names columns : {}. Choose one'
+            return msg.format(array.dtype.names)
+        elif len(array.shape) > 1:
+            return 'Must use 1d array when using non record arrays.'
+
+    return ''
+
 
 class ArrayExtremaTask(SimpleTask):
     """ Store the pair(s) of index/value for the extrema(s) of an array.
@@ -66,26 +295,10 @@ class ArrayExtremaTask(SimpleTask):
         array = self.format_and_eval_string(self.target_array)
         err_path = self.get_error_path()
 
-        if self.column_name:
-            if array.dtype.names:
-                names = array.dtype.names
-                if self.column_name not in names:
-                    msg = 'No column named {} in array. (column are : {})'
-                    traceback[err_path] = msg.format(self.column_name, names)
-                    return False, traceback
-            else:
-                traceback[err_path] = 'Array has no named columns'
-                return False, traceback
-
-        else:
-            if array.dtype.names:
-                msg = 'The target array has names columns : {}. Choose one'
-                traceback[err_path] = msg.format(array.dtype.names)
-                return False, traceback
-            elif len(array.shape) > 1:
-                msg = 'Must use 1d array when using non record arrays.'
-                traceback[err_path] = msg
-                return False, traceback
+        msg = _check_column(array, self.column_name)
+        if msg:
+            traceback[err_path] = msg
+            return False, traceback
 
         return test, traceback
 
@@ -117,6 +330,11 @@ class ArrayFindValueTask(SimpleTask):
     #: Value which should be looked for in the array.
     value = Str().tag(pref=True, feval=validators.Feval())
 
+    #: Whether the target array is never modified in place (it is only ever
+    #: replaced by another array in the database). This allows to index it
+    #: even if it is writable.
+    static_array = Bool(False).tag(pref=True)
+
     database_entries = set_default({'index': 0})
 
     wait = set_default({'activated': True})  # Wait on all pools by default.
@@ -124,20 +342,51 @@ class ArrayFindValueTask(SimpleTask):
     def perform(self):
         """ Find index of value array and store index in database.
 
+        When the same array is searched again a sorted index of the column is
+        built and used for the following searches, provided the array cannot
+        change (it is read-only or declared static).
+
         """
         array = self.format_and_eval_string(self.target_array)
-        if self.column_name:
-            array = array[self.column_name]
-
         val = self.format_and_eval_string(self.value)
 
-        try:
-            ind = np.where(np.abs(array - val) < 1e-12)[0][0]
-        except IndexError as e:
+        ind = self._find(array, val)
+        if ind is None:
+            if self.column_name:
+                array = array[self.column_name]
             msg = 'Could not find {} in array {} ({})'
-            raise ValueError(msg.format(val, self.target_array, array)) from e
+            raise ValueError(msg.format(val, self.target_array, array))
         self.write_in_database('index', ind)
 
+    #: Weak reference to the last searched array, name of the searched column
+    #: and sorted index of the column (built when the array is searched again).
+    _index = Value()
+
+    def _find(self, array, value):
+        """Find the first occurrence of a value using the index if possible.
+
+        Modifying an array in place (as a SaveTask does for example) does not
+        rewrite it in the database and cannot be detected. The index is hence
+        only used for read-only arrays and for the arrays declared static.
+
+        """
+        column = self.column_name
+        data = array[column] if column else array
+        if not (self.static_array or _is_frozen(data)):
+            self._index = None
+            return find_first(data, value)
+
+        if self._index is not None:
+            array_ref, col, index = self._index
+            if array_ref() is array and col == column:
+                if index is None:
+                    index = SortedIndex(data)
+                    self._index = (array_ref, col, index)
+                return index.find_first(value)
+
+        self._index = (ref(array), column, None)
+        return find_first(data, value)
+
     def check(self, *args, **kwargs):
         """ Check the target array can be found and has the right column.
 
@@ -152,25 +401,91 @@ class ArrayFindValueTask(SimpleTask):
 
         array = self.format_and_eval_string(self.target_array)
 
-        if self.column_name:
-            if array.dtype.names:
-                names = array.dtype.names
-                if self.column_name not in names:
-                    msg = 'No column named {} in array. (column are : {})'
-                    traceback[err_path] = msg.format(self.column_name, names)
-                    return False, traceback
-            else:
-                traceback[err_path] = 'Array has no named columns'
-                return False, traceback
+        msg = _check_column(array, self.column_name)
+        if msg:
+            traceback[err_path] = msg
+            return False, traceback
 
-        else:
-            if array.dtype.names:
-                msg = 'The target array has names columns : {}. Choose one'
-                traceback[err_path] = msg.format(array.dtype.names)
-                return False, traceback
-            elif len(array.shape) > 1:
-                msg = 'Must use 1d array when using non record arrays.'
-                traceback[err_path] = msg
-                return False, traceback
+        return test, traceback
+
+
+class ArrayReduceTask(SimpleTask):
+    """ Apply several reductions to the columns of an array in a single pass.
+
+    Each operation is described by a (column, operation, value) tuple and
+    its result is stored in the database under the associated name. The
+    value is only used by the 'first' and 'nearest' operations.
+
+    Wait for any parallel operation before execution.
+
+    """
+    #: Name of the target in the database.
+    target_array = Str().tag(pref=True, feval=ARR_VAL)
+
+    #: Operations to perform as a mapping between the names of the entries
+    #: in the database and (column, operation, value) tuples.
+    operations = Typed(OrderedDict, ()).tag(pref=(ordered_dict_to_pref,
+                                                  ordered_dict_from_pref))
+
+    wait = set_default({'activated': True})  # Wait on all pools by default.
+
+    def perform(self):
+        """ Compute the reductions and store them in the database.
+
+        """
+        array = self.format_and_eval_string(self.target_array)
+        operations = []
+        for spec in self.operations.values():
+            column, op, value = as_reduce_operation(spec)
+            if REDUCE_OPERATIONS[op]:
+                value = self.format_and_eval_string(value)
+            operations.append((column, op, value))
+
+        results = reduce_array(array, operations)
+        for name, result in zip(self.operations, results):
+            self.write_in_database(name, result)
+
+    def check(self, *args, **kwargs):
+        """ Check the target array can be found and has the right columns.
+
+        """
+        test, traceback = super(ArrayReduceTask, self).check(*args, **kwargs)
+
+        if not test:
+            return test, traceback
+
+        array = self.format_and_eval_string(self.target_array)
+        err_path = self.get_error_path()
+
+        for name, spec in self.operations.items():
+            column, op, value = as_reduce_operation(spec)
+            if op not in REDUCE_OPERATIONS:
+                msg = 'Unknown operation {} (supported are {})'
+                traceback[err_path + '-' + name] = \
+                    msg.format(op, list(REDUCE_OPERATIONS))
+                test = False
+                continue
+            msg = _check_column(array, column)
+            if msg:
+                traceback[err_path + '-' + name] = msg
+                test = False
+                continue
+            if REDUCE_OPERATIONS[op]:
+                try:
+                    self.format_and_eval_string(value)
+                except Exception as e:
+                    msg = 'Failed to evaluate the value {} : {}'
+                    traceback[err_path + '-' + name] = msg.format(value, e)
+                    test = False
 
         return test, traceback
+
+    def _post_setattr_operations(self, old, new):
+        """ Update the database entries according to the operations.
+
+        """
+        entries = {}
+        for name, spec in new.items():
+            op = as_reduce_operation(spec)[1]
+            entries[name] = 1.0 if op in ('max', 'min') else 0
+        self.database_entries = entries
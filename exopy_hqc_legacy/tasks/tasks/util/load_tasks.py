@@ -9,11 +9,14 @@
 """Tasks to used to load a file in memory.
 
 """
+import io
 import os
+import numbers
+from collections import OrderedDict
 
 import numpy as np
 import h5py
-from atom.api import (Bool, Str, List, set_default)
+from atom.api import (Bool, Str, List, Dict, set_default)
 from past.builtins import basestring
 
 from exopy.tasks.api import SimpleTask, InterfaceableTaskMixin, TaskInterface
@@ -27,6 +30,452 @@ def _make_array(names, dtypes='f8'):
     return np.ones((5,), dtype=dtype)
 
 
+#: Maximal number of parsed CSV files kept in memory.
+CSV_CACHE_SIZE = 8
+
+#: Maximal number of bytes used by the parsed CSV files kept in memory. Files
+#: larger than this limit are never cached.
+CSV_CACHE_BYTES = 128*2**20
+
+#: Arrays parsed by load_csv, stored by path and parsing options along with
+#: the modification time and size of the file.
+_CSV_CACHE = OrderedDict()
+
+
+def load_csv(path, delimiter='\t', comments='#', names=True):
+    """Load a CSV file, re-using the result of the last parsing if the file
+    did not change.
+
+    The file is considered unchanged if its modification time and size did
+    not change. The cached array is read-only and a writable copy of it is
+    returned so that it can be safely modified.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+
+    delimiter : str, optional
+        Delimiter of the columns.
+
+    comments : str, optional
+        Character starting a comment line.
+
+    names : bool, optional
+        Whether to use the first line which is not a comment as the names of
+        the columns.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        Array (structured if names is True) of the file content as returned
+        by numpy.genfromtxt.
+
+    """
+    stat = os.stat(path)
+    key = (path, delimiter, comments, names)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _CSV_CACHE.pop(key, None)
+    if cached is not None and cached[0] == stamp:
+        _CSV_CACHE[key] = cached
+        return cached[1].copy()
+
+    data = _parse_csv(path, delimiter, comments, names)
+    if data.nbytes <= CSV_CACHE_BYTES:
+        cached = data.copy()
+        cached.flags.writeable = False
+        _CSV_CACHE[key] = (stamp, cached)
+        total = sum(d.nbytes for _, d in _CSV_CACHE.values())
+        while (len(_CSV_CACHE) > CSV_CACHE_SIZE or
+               total > CSV_CACHE_BYTES):
+            _, (_, evicted) = _CSV_CACHE.popitem(last=False)
+            total -= evicted.nbytes
+    return data
+
+
+def _parse_csv(path, delimiter, comments, names):
+    """Parse a CSV file.
+
+    The header is read once and the numeric block is parsed by the C parser
+    of numpy.loadtxt. Files it cannot handle (missing values, complex
+    numbers, ...) are parsed by numpy.genfromtxt.
+
+    """
+    names = names or None
+    with open(path) as f:
+        comment_lines, row, start = _read_csv_header(f, delimiter,
+                                                     comments, names)
+        if row is not None:
+            f.seek(start)
+            try:
+                return np.loadtxt(f, dtype=row.dtype, comments=comments,
+                                  delimiter=delimiter)
+            except ValueError:
+                pass
+
+    return np.genfromtxt(path, comments=comments, delimiter=delimiter,
+                         names=names, skip_header=comment_lines)
+
+
+def _read_csv_header(f, delimiter, comments, names):
+    """Read the comment lines and the names at the top of a CSV file.
+
+    Returns
+    -------
+    comment_lines : int
+        Number of comment lines preceding the names or the data.
+
+    row : numpy.ndarray or None
+        First row of the data as parsed by genfromtxt, which is used to build
+        the dtype (and sanitize the names), None if the file contains no
+        data.
+
+    start : int
+        Position of the first row in the file.
+
+    """
+    def readline():
+        line = f.readline()
+        return line.decode('utf-8') if isinstance(line, bytes) else line
+
+    comment_lines = 0
+    start = f.tell()
+    line = readline()
+    while comments and line.startswith(comments):
+        comment_lines += 1
+        start = f.tell()
+        line = readline()
+
+    header = []
+    if names:
+        header = [line]
+        start = f.tell()
+        line = readline()
+
+    row = None
+    if line.strip():
+        row = np.genfromtxt(header + [line], comments=comments,
+                            delimiter=delimiter, names=names)
+
+    return comment_lines, row, start
+
+
+class CSVTail(object):
+    """Incremental reader of a CSV file which is still being written.
+
+    Each call to `read` only parses the complete lines appended since the
+    previous call and appends them to a growable array, so that the cost of
+    a read does not depend on the size of the file. If the file is replaced
+    or truncated it is read again from its beginning.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+
+    delimiter : str, optional
+        Delimiter of the columns.
+
+    comments : str, optional
+        Character starting a comment line.
+
+    names : bool, optional
+        Whether to use the first line which is not a comment as the names of
+        the columns.
+
+    """
+    def __init__(self, path, delimiter='\t', comments='#', names=True):
+        self.path = path
+        self.delimiter = delimiter
+        self.comments = comments
+        self.names = names
+        self._reset()
+
+    @property
+    def options(self):
+        """Delimiter, comments and names options of the reader.
+
+        """
+        return (self.delimiter, self.comments, self.names)
+
+    def read(self):
+        """Parse the new lines of the file.
+
+        Returns
+        -------
+        data : numpy.ndarray
+            Array of all the rows read so far. It shares its memory with the
+            buffer of the reader and should hence not be modified.
+
+        """
+        stat = os.stat(self.path)
+        if stat.st_ino != self._inode or stat.st_size < self.offset:
+            self._reset()
+            self._inode = stat.st_ino
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            block = f.read()
+
+        # Only parse complete lines, the last one may be being written.
+        end = block.rfind(b'\n') + 1
+        if self._row is None:
+            # The dtype is built from the first complete row, the header is
+            # read again on the next call if there is none yet.
+            _, self._row, start = _read_csv_header(
+                io.BytesIO(block[:end]), self.delimiter, self.comments,
+                self.names or None)
+            if self._row is None:
+                return self._output()
+            block = block[start:]
+            end -= start
+            self.offset += start
+
+        if end:
+            self._append(self._parse(block[:end].decode('utf-8')))
+            self.offset += end
+
+        return self._output()
+
+    def _parse(self, text):
+        """Parse a block of complete lines.
+
+        """
+        dtype = self._row.dtype
+        # Structured rows are scalars, other rows are 1D arrays.
+        shape = (-1,) if dtype.names else (-1, self._row.size)
+        try:
+            rows = np.loadtxt(io.StringIO(text), dtype=dtype,
+                              comments=self.comments,
+                              delimiter=self.delimiter)
+        except ValueError:
+            rows = np.genfromtxt(io.StringIO(text), dtype=dtype,
+                                 comments=self.comments,
+                                 delimiter=self.delimiter)
+        return rows.reshape(shape)
+
+    def _append(self, rows):
+        """Append rows to the buffer, doubling its capacity if needed.
+
+        """
+        count = self.count + len(rows)
+        if self._buffer is None or len(self._buffer) < count:
+            capacity = max(count, 2*self.count)
+            buffer = np.empty((capacity,) + rows.shape[1:], rows.dtype)
+            if self.count:
+                buffer[:self.count] = self._buffer[:self.count]
+            self._buffer = buffer
+        self._buffer[self.count:count] = rows
+        self.count = count
+
+    def _output(self):
+        """View on the rows read so far.
+
+        """
+        if self._buffer is None:
+            return np.empty(0, np.float64 if self._row is None else
+                            self._row.dtype)
+        data = self._buffer[:self.count]
+        # A single column file is loaded as a 1D array.
+        if not data.dtype.names and data.shape[1] == 1:
+            data = data[:, 0]
+        return data
+
+    def _reset(self):
+        """Forget about the data read so far.
+
+        """
+        self.offset = 0
+        self.count = 0
+        self._inode = None
+        self._row = None
+        self._buffer = None
+
+
+class H5PYLazyData(object):
+    """Read-only mapping giving lazy access to the datasets of an HDF5 file.
+
+    Each dataset is represented by a proxy exposing its shape and dtype and
+    reading from the file only the rows which are accessed. When the file
+    is still written by a SaveFileHDF5Task the datasets are truncated to the
+    number of calls stored in the 'count_calls' attribute and `refresh` can
+    be used to follow the file as it grows.
+
+    Parameters
+    ----------
+    path : str
+        Path of the HDF5 file.
+
+    swmr : bool, optional
+        Whether to open the file in SWMR mode.
+
+    """
+    def __init__(self, path, swmr=True):
+        self.path = path
+        self.swmr = swmr
+        self._file = None
+        self._counts = {}
+        self._datasets = {}
+        self.refresh()
+
+    @property
+    def closed(self):
+        """Whether the underlying file is closed.
+
+        """
+        return self._file is None
+
+    def refresh(self):
+        """Update the number of rows available in each dataset.
+
+        The file is re-opened so that the data and attributes written since
+        the last refresh become visible, the rows already loaded are kept.
+
+        """
+        self.close()
+        self._file = f = h5py.File(self.path, 'r', swmr=self.swmr)
+        count = f.attrs.get('count_calls')
+        self._counts = {}
+        for key, dataset in f.items():
+            # Only the arrays can be loaded by rows.
+            if not isinstance(dataset, h5py.Dataset) or not dataset.shape:
+                continue
+            length = len(dataset)
+            self._counts[key] = (length if count is None
+                                 else min(int(count), length))
+            if key not in self._datasets:
+                self._datasets[key] = _LazyDataset(self, key)
+        for key in list(self._datasets):
+            if key not in self._counts:
+                del self._datasets[key]
+            else:
+                self._datasets[key]._reset()
+
+    def close(self):
+        """Close the underlying file.
+
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def keys(self):
+        return self._datasets.keys()
+
+    def values(self):
+        return self._datasets.values()
+
+    def items(self):
+        return self._datasets.items()
+
+    def __getitem__(self, key):
+        return self._datasets[key]
+
+    def __contains__(self, key):
+        return key in self._datasets
+
+    def __iter__(self):
+        return iter(self._datasets)
+
+    def __len__(self):
+        return len(self._datasets)
+
+
+class _LazyDataset(object):
+    """Proxy to a dataset of a H5PYLazyData.
+
+    Integer and slice indexing on the first axis only read the requested
+    rows. Converting the proxy to an array loads all the rows in a cache
+    which is extended by only the new rows after each refresh.
+
+    """
+    def __init__(self, data, name):
+        self._data = data
+        self.name = name
+        self._cache = None
+        self._cached = 0
+
+    @property
+    def shape(self):
+        return (len(self),) + self._dataset.shape[1:]
+
+    @property
+    def dtype(self):
+        return self._dataset.dtype
+
+    @property
+    def ndim(self):
+        return len(self._dataset.shape)
+
+    def __len__(self):
+        return self._data._counts[self.name]
+
+    def __getitem__(self, key):
+        first, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key,
+                                                                         ())
+        if isinstance(first, numbers.Integral):
+            index = first + len(self) if first < 0 else first
+            if not 0 <= index < len(self):
+                raise IndexError('Index %s out of range for %s rows.' %
+                                 (first, len(self)))
+            if index < self._cached:
+                return self._cache[(index,) + rest]
+            return self._dataset[(index,) + rest]
+
+        if isinstance(first, slice) and (first.step or 1) > 0:
+            start, stop, step = first.indices(len(self))
+            stop = max(start, stop)
+            if stop <= self._cached:
+                return self._cache[(slice(start, stop, step),) + rest]
+            return self._dataset[(slice(start, stop, step),) + rest]
+
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        self.load()
+        array = self._cache[:len(self)]
+        return array if dtype is None else array.astype(dtype)
+
+    def load(self):
+        """Read the rows which are not yet in the cache.
+
+        """
+        count = len(self)
+        if count <= self._cached:
+            return
+        dataset = self._dataset
+        if self._cache is None or len(self._cache) < count:
+            capacity = max(count, 2*self._cached)
+            cache = np.empty((capacity,) + dataset.shape[1:], dataset.dtype)
+            if self._cached:
+                cache[:self._cached] = self._cache[:self._cached]
+            self._cache = cache
+        self._cache[self._cached:count] = dataset[self._cached:count]
+        self._cached = count
+
+    def __repr__(self):
+        return '<Lazy HDF5 dataset %r: shape %s, type %s>' % (
+            self.name, self.shape, self.dtype)
+
+    @property
+    def _dataset(self):
+        if self._data.closed:
+            raise ValueError('The file %s is closed.' % self._data.path)
+        return self._data._file[self.name]
+
+    def _reset(self):
+        """Discard the cache if the dataset shrunk or changed type.
+
+        """
+        dataset = self._dataset
+        if self._cache is not None and (
+                len(self) < self._cached or
+                self._cache.dtype != dataset.dtype or
+                self._cache.shape[1:] != dataset.shape[1:]):
+            self._cache = None
+            self._cached = 0
+
+
 class LoadArrayTask(InterfaceableTaskMixin, SimpleTask):
     """ Load an array from the disc into the database.
 
@@ -40,6 +489,10 @@ class LoadArrayTask(InterfaceableTaskMixin, SimpleTask):
     #: Kind of file to load.
     selected_format = Str().tag(pref=True)
 
+    #: Whether to only read the data appended to the file since the previous
+    #: execution of the task (for files still being written).
+    incremental = Bool(False).tag(pref=True)
+
     database_entries = set_default({'array': _make_array(['var1', 'var2'])})
 
     def check(self, *args, **kwargs):
@@ -84,6 +537,9 @@ class CSVLoadInterface(TaskInterface):
     #: Class attr used in the UI.
     file_formats = ['CSV']
 
+    #: Incremental readers of the loaded files.
+    _tails = Dict()
+
     def perform(self):
         """Load a file stored in csv format.
 
@@ -93,17 +549,16 @@ class CSVLoadInterface(TaskInterface):
         filename = task.format_string(task.filename)
         full_path = os.path.join(folder, filename)
 
-        comment_lines = 0
-        with open(full_path) as f:
-            while True:
-                if f.readline().startswith(self.comments):
-                    comment_lines += 1
-                else:
-                    break
-
-        data = np.genfromtxt(full_path, comments=self.comments,
-                             delimiter=self.delimiter, names=self.names,
-                             skip_header=comment_lines)
+        if task.incremental:
+            options = (self.delimiter, self.comments, self.names)
+            tail = self._tails.get(full_path)
+            if tail is None or tail.options != options:
+                tail = CSVTail(full_path, *options)
+                self._tails[full_path] = tail
+            data = tail.read()
+        else:
+            data = load_csv(full_path, self.delimiter, self.comments,
+                            self.names)
 
         task.write_in_database('array', data)
 
@@ -159,24 +614,49 @@ class H5PYLoadInterface(TaskInterface):
     #: Whether or not the HDF5 file supports SWMR
     swmr = Bool(True).tag(pref=True)
 
+    #: Whether to store in the database a H5PYLazyData reading the rows only
+    #: when they are accessed instead of loading the whole datasets.
+    lazy = Bool(False).tag(pref=True)
+
+    #: Lazy data of the loaded files.
+    _data = Dict()
+
     def perform(self):
         """Load a file stored in h5py format.
 
         Can also handle a file currently opened by a SaveFileHDF5Task.
-        For more reliability, both tasks should use the SWMR mode.
+        For more reliability, both tasks should use the SWMR mode. In lazy
+        and incremental modes, performing the task again on the same file
+        only reads the rows added in between.
+
         """
         task = self.task
         folder = task.format_string(task.folder)
         filename = task.format_string(task.filename)
         full_path = os.path.join(folder, filename)
 
-        with h5py.File(full_path,'r', swmr=self.swmr) as f:
+        if self.lazy or task.incremental:
+            data = self._data.get(full_path)
+            if data is None or data.closed:
+                data = H5PYLazyData(full_path, self.swmr)
+                task.root.resources['files']['lazy:' + full_path] = data
+                self._data[full_path] = data
+            else:
+                data.refresh()
+            if not self.lazy:
+                data = {k: np.asarray(v) for k, v in data.items()}
+            task.write_in_database('array', data)
+            return
+
+        with h5py.File(full_path, 'r', swmr=self.swmr) as f:
             data_dict = {}
             # If the file is still opened by a saveFileHDF5Task,
             # we need to truncate the data
-            if 'count_calls' in f.attrs:
-                count_calls = f.attrs['count_calls']
-                for key in f:
+            count_calls = f.attrs.get('count_calls')
+            for key in f:
+                if count_calls is None:
+                    data_dict[key] = f[key][()]
+                else:
                     data_dict[key] = np.array(f[key][:count_calls])
 
         task.write_in_database('array', data_dict)
@@ -185,6 +665,7 @@ class H5PYLoadInterface(TaskInterface):
         """Try to find the names of the keys
 
         """
+        task = self.task
         try:
             full_folder_path = task.format_string(task.folder)
             filename = task.format_string(task.filename)
@@ -194,8 +675,7 @@ class H5PYLoadInterface(TaskInterface):
         full_path = os.path.join(full_folder_path, filename)
 
         if os.path.isfile(full_path):
-            with h5py.File(full_path,'r', swmr=self.swmr) as f:
-                self.task.write_in_database('array',
-                                            {k: np.ones(5) for k in f})
+            with h5py.File(full_path, 'r', swmr=self.swmr) as f:
+                task.write_in_database('array', {k: np.ones(5) for k in f})
 
         return True, {}
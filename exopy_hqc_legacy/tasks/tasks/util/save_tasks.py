@@ -10,24 +10,181 @@
 
 """
 import os
+import time
 import errno
 import logging
 import numbers
 import warnings
 from inspect import cleandoc
 from collections import OrderedDict
+from queue import Queue, Empty
+from threading import Thread, Lock
 
 #: Protection against numpy deprecation message in h5py
 warnings.filterwarnings("ignore", category=FutureWarning, module="h5py")
 
 import numpy
 import h5py
+from numpy.lib.format import open_memmap, dtype_to_descr, read_magic
 from atom.api import Enum, Value, Bool, Int, Typed, List, set_default, Str
 
 from exopy.tasks.api import SimpleTask, validators
 from exopy.utils.atom_util import ordered_dict_from_pref, ordered_dict_to_pref
 from exopy.utils.traceback import format_exc
 
+from exopy_hqc_legacy.utils.binary_records import write_header
+
+
+class _BufferedFile(object):
+    """File wrapper coalescing the written lines in memory.
+
+    The buffered data are written in a single operation and flushed to the
+    disk every `lines` lines, when the last flush is older than `interval`
+    (checked on each write) and on close. The data are also written (without
+    flushing) once the buffer exceeds `max_bytes`.
+
+    Parameters
+    ----------
+    file : file
+        File object opened in binary mode.
+
+    lines : int, optional
+        Number of lines between two flushes, 0 meaning no limit.
+
+    interval : float, optional
+        Time in seconds between two flushes, 0 meaning no limit.
+
+    max_bytes : int, optional
+        Maximal size of the data kept in memory.
+
+    """
+    def __init__(self, file, lines=0, interval=0, max_bytes=2**16):
+        self.file = file
+        self.lines = lines
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._buffer = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def write(self, data):
+        """Buffer some data and flush them if required by the policy.
+
+        """
+        self._buffer.append(data)
+        self._size += len(data)
+        if ((self.lines and len(self._buffer) >= self.lines) or
+                (self.interval and
+                 time.monotonic() - self._last_flush >= self.interval)):
+            self.flush()
+        elif self._size >= self.max_bytes:
+            self._write()
+
+    def flush(self):
+        """Write all the buffered data and flush the file.
+
+        """
+        self._write()
+        self.file.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Write all the buffered data and close the file.
+
+        """
+        # The file may be closed by the task and then by the root task.
+        if self.file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+    def _write(self):
+        """Write the buffered data to the underlying file.
+
+        """
+        if self._buffer:
+            self.file.write(b''.join(self._buffer))
+            self._buffer = []
+            self._size = 0
+
+
+def _flush_parameters(task):
+    """Number of lines and interval between two flushes of a _BufferedFile
+    according to the flush policy of a task.
+
+    """
+    lines = interval = 0
+    if task.flush_policy == 'Every N lines':
+        lines = int(task.format_and_eval_string(task.flush_period))
+    elif task.flush_policy == 'Every T seconds':
+        interval = task.format_and_eval_string(task.flush_period)
+    return lines, interval
+
+
+class _NpyMemmap(object):
+    """Finalise the .npy file backing the memory mapped array of a SaveTask.
+
+    When closed, the data are flushed to the disk and, if the measure stopped
+    before all the lines were written, the header of the file is updated to
+    the number of written lines and the unused end of the file is truncated.
+    The array published in the database is then replaced by a view on the
+    written lines, as the mapped memory beyond the end of the file cannot be
+    accessed anymore.
+
+    Parameters
+    ----------
+    task : SaveTask
+        Task whose array is backed by the file.
+
+    path : str
+        Path of the .npy file.
+
+    """
+    def __init__(self, task, path):
+        self.task = task
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        """Flush the data and truncate the file to the written lines.
+
+        """
+        if self.closed:
+            return
+        self.closed = True
+        task = self.task
+        array = task.array
+        rows = task.line_index
+        array.flush()
+        if rows >= len(array):
+            return
+
+        with open(self.path, 'r+b') as f:
+            major, _ = read_magic(f)
+            prefix = f.tell() + (2 if major == 1 else 4)
+            # Pad the header to its previous length so that the data do not
+            # move.
+            header = repr({'descr': dtype_to_descr(array.dtype),
+                           'fortran_order': False, 'shape': (rows,)})
+            header = header.ljust(array.offset - prefix - 1) + '\n'
+            f.seek(prefix)
+            f.write(header.encode('latin1'))
+
+        task.array = array[:rows]
+        task.write_in_database('array', task.array)
+        try:
+            os.truncate(self.path, array.offset + rows*array.dtype.itemsize)
+        except OSError:
+            # The file cannot be truncated while mapped on some platforms,
+            # the header being up to date the file remains valid.
+            pass
+
 
 class SaveTask(SimpleTask):
     """ Save the specified entries either in a CSV file or an array. The file
@@ -39,9 +196,21 @@ class SaveTask(SimpleTask):
     -----
     Currently only support saving floats.
 
+    In 'Mmap' mode the array is stored in a .npy file mapped in memory, so
+    that the array in the database and the file share the same data. The
+    file is always created anew and is truncated to the written lines if the
+    measure stops early.
+
+    In file mode the lines are buffered in memory and written according to
+    the flush policy. All the buffered lines are written when the file is
+    closed, which happens when the last line is reached or when the measure
+    stops (normally, on user request or because of an error). Only a crash
+    of the process can lose the lines written since the last flush.
+
     """
     #: Kind of object in which to save the data.
-    saving_target = Enum('File', 'Array', 'File and array').tag(pref=True)
+    saving_target = Enum('File', 'Array', 'File and array',
+                         'Mmap').tag(pref=True)
 
     #: Folder in which to save the data.
     folder = Str('{default_path}').tag(pref=True)
@@ -58,6 +227,14 @@ class SaveTask(SimpleTask):
     #: Header to write at the top of the file.
     header = Str().tag(pref=True)
 
+    #: When to write the lines to the disk.
+    flush_policy = Enum('Every N lines', 'Every T seconds',
+                        'On close').tag(pref=True)
+
+    #: Number of lines (N) or time in seconds (T) between two flushes.
+    flush_period = Str('1').tag(pref=True,
+                                feval=validators.Feval(types=numbers.Real))
+
     #: Numpy array in which data are stored (Array mode)
     array = Value()  # Array
 
@@ -100,10 +277,14 @@ class SaveTask(SimpleTask):
                 full_folder_path = self.format_string(self.folder)
                 filename = self.format_string(self.filename)
                 full_path = os.path.join(full_folder_path, filename)
+
+            if self.saving_target in ('File', 'File and array'):
                 mode = 'wb' if self.file_mode == 'New' else 'ab'
 
+                lines, interval = _flush_parameters(self)
                 try:
-                    self.file_object = open(full_path, mode)
+                    self.file_object = _BufferedFile(open(full_path, mode),
+                                                     lines, interval)
                 except IOError as e:
                     log = logging.getLogger()
                     mes = ('In {}, failed to open the specified '
@@ -128,18 +309,31 @@ class SaveTask(SimpleTask):
                 dtype = numpy.dtype({'names': [self.format_string(s)
                                                for s in self.saved_values],
                                      'formats': ['f8']*len(self.saved_values)})
-                self.array = numpy.empty((self.array_length,),
-                                         dtype=dtype)
+                if self.saving_target == 'Mmap':
+                    try:
+                        self.array = open_memmap(full_path, 'w+', dtype,
+                                                 (self.array_length,))
+                    except IOError as e:
+                        log = logging.getLogger()
+                        mes = ('In {}, failed to open the specified '
+                               'file {}').format(self.name, e)
+                        log.error(mes)
+                        self.root.should_stop.set()
+                        return
+                    self.file_object = _NpyMemmap(self, full_path)
+                    self.root.resources['files'][full_path] = self.file_object
+                else:
+                    self.array = numpy.empty((self.array_length,),
+                                             dtype=dtype)
                 self.write_in_database('array', self.array)
             self.initialized = True
 
         # Writing
         values = tuple(self.format_and_eval_string(s)
                        for s in self.saved_values.values())
-        if self.saving_target != 'Array':
+        if self.saving_target in ('File', 'File and array'):
             new_line = '\t'.join([str(val) for val in values]) + '\n'
             self.file_object.write(new_line.encode('utf-8'))
-            self.file_object.flush()
         if self.saving_target != 'File':
             self.array[self.line_index] = tuple(values)
 
@@ -175,8 +369,10 @@ class SaveTask(SimpleTask):
 
             full_path = os.path.join(full_folder_path, filename)
 
+            # The memory mapped file is always created anew.
+            new = self.file_mode == 'New' or self.saving_target == 'Mmap'
             overwrite = False
-            if self.file_mode == 'New' and os.path.isfile(full_path):
+            if new and os.path.isfile(full_path):
                 overwrite = True
                 traceback[err_path + '-file'] = \
                     ('File already exists, running the measure will '
@@ -185,7 +381,7 @@ class SaveTask(SimpleTask):
             try:
                 f = open(full_path, 'ab')
                 f.close()
-                if self.file_mode == 'New' and not overwrite:
+                if new and not overwrite:
                     os.remove(full_path)
             except Exception as e:
                 mess = 'Failed to open the specified file : {}'.format(e)
@@ -262,6 +458,12 @@ class SaveFileTask(SimpleTask):
     Currently only support saving floats and arrays of floats (record arrays
     or simple arrays).
 
+    In binary format the rows are appended as raw records after a JSON
+    header (see exopy_hqc_legacy.utils.binary_records), which can be
+    converted to the text layout using `binary_records.to_text`. The records
+    are buffered in memory and written according to the flush policy, as
+    the lines of SaveTask.
+
     """
     #: Folder in which to save the data.
     folder = Str('{default_path}').tag(pref=True, fmt=True)
@@ -269,6 +471,9 @@ class SaveFileTask(SimpleTask):
     #: Name of the file in which to write the data.
     filename = Str().tag(pref=True, fmt=True)
 
+    #: Format of the file: tab separated text or binary records.
+    file_format = Enum('Text', 'Binary').tag(pref=True)
+
     #: Currently opened file object. (File mode)
     file_object = Value()
 
@@ -289,6 +494,20 @@ class SaveFileTask(SimpleTask):
     #: Shapes of identified arrays.
     array_dims = Value()
 
+    #: When to write the records to the disk (binary format).
+    flush_policy = Enum('Every N lines', 'Every T seconds',
+                        'On close').tag(pref=True)
+
+    #: Number of calls (N) or time in seconds (T) between two flushes.
+    flush_period = Str('1').tag(pref=True,
+                                feval=validators.Feval(types=numbers.Real))
+
+    #: Dtype of the records written in binary format.
+    _record_dtype = Value()
+
+    #: Buffer in which the records are prepared before being written.
+    _records = Value()
+
     database_entries = set_default({'file': None})
 
     wait = set_default({'activated': True})  # Wait on all pools by default.
@@ -305,6 +524,10 @@ class SaveFileTask(SimpleTask):
             full_path = os.path.join(full_folder_path, filename)
             try:
                 self.file_object = open(full_path, 'wb')
+                if self.file_format == 'Binary':
+                    lines, interval = _flush_parameters(self)
+                    self.file_object = _BufferedFile(self.file_object,
+                                                     lines, interval)
             except IOError:
                 log = logging.getLogger()
                 msg = "In {}, failed to open the specified file."
@@ -313,13 +536,14 @@ class SaveFileTask(SimpleTask):
 
             self.root.resources['files'][full_path] = self.file_object
 
-            if self.header:
+            if self.header and self.file_format == 'Text':
                 h = self.format_string(self.header)
                 for line in h.split('\n'):
                     self.file_object.write(('# ' + line +
                                             '\n').encode('utf-8'))
 
             labels = []
+            formats = []
             self.array_values = list()
             self.array_dims = list()
             for i, (l, v) in enumerate(self.saved_values.items()):
@@ -331,11 +555,28 @@ class SaveFileTask(SimpleTask):
                     self.array_dims.append(value.ndim)
                     if names:
                         labels.extend([label + '_' + m for m in names])
+                        formats.extend([value.dtype[m] for m in names])
                     else:
                         labels.append(label)
+                        formats.append(value.dtype)
                 else:
                     labels.append(label)
-            self.file_object.write(('\t'.join(labels) + '\n').encode('utf-8'))
+                    formats.append(_scalar_format(value))
+
+            if self.file_format == 'Binary':
+                for label, fmt in zip(labels, formats):
+                    if fmt.kind not in 'biufc':
+                        msg = ('In {}, the binary format can only save '
+                               'numbers, {} is of type {}.')
+                        raise ValueError(msg.format(self.name, label, fmt))
+                self._record_dtype = numpy.dtype({'names': labels,
+                                                  'formats': formats})
+                self._records = None
+                h = self.format_string(self.header) if self.header else ''
+                write_header(self.file_object, self._record_dtype, h)
+            else:
+                self.file_object.write(('\t'.join(labels) +
+                                        '\n').encode('utf-8'))
             self.file_object.flush()
 
             self.initialized = True
@@ -387,7 +628,16 @@ class SaveFileTask(SimpleTask):
             else:
                 shape = shapes_2D.pop()
 
-        if not self.array_values:
+        if self.file_format == 'Binary':
+            if not self.array_values:
+                rows, repeat = 1, 1
+            elif 2 in self.array_dims:
+                rows, repeat = shape[0]*shape[1], shape[1]
+            else:
+                rows, repeat = length[0], 1
+            self._write_records(values, rows, repeat)
+
+        elif not self.array_values:
             new_line = '\t'.join([str(val) for val in values]) + '\n'
             self.file_object.write(new_line.encode('utf-8'))
             self.file_object.flush()
@@ -471,32 +721,287 @@ class SaveFileTask(SimpleTask):
 
         return test, traceback
 
+    def _write_records(self, values, rows, repeat):
+        """Append the values to the file as binary records.
+
+        Parameters
+        ----------
+        values : list
+            Values of the entries.
+
+        rows : int
+            Number of records to write.
+
+        repeat : int
+            Number of times each element of the 1D arrays must be repeated
+            when saving 2D arrays.
+
+        """
+        records = self._records
+        if records is None or len(records) != rows:
+            records = self._records = numpy.empty(rows,
+                                                  dtype=self._record_dtype)
+        columns = []
+        for i, val in enumerate(values):
+            if i not in self.array_values:
+                columns.append(val)
+            elif val.dtype.names and val.ndim == 1:
+                columns.extend(val[m] for m in val.dtype.names)
+            elif val.ndim == 1 and repeat > 1:
+                columns.append(numpy.repeat(val, repeat))
+            else:
+                columns.append(val.ravel())
+
+        dtype = records.dtype
+        for name, column in zip(dtype.names, columns):
+            # Refuse the values which would be silently truncated.
+            if not numpy.can_cast(numpy.asarray(column).dtype, dtype[name],
+                                  'same_kind'):
+                msg = 'In {}, the value {} of {} cannot be saved as {}.'
+                raise ValueError(msg.format(self.name, column, name,
+                                            dtype[name]))
+            records[name] = column
+        # The buffer is re-used, hence the copy of the records.
+        self.file_object.write(records.tobytes())
+
+
+def _scalar_format(value):
+    """Type of the column used to save a scalar value in binary format.
+
+    Numbers are saved as float64 (complex128 for complex numbers) whatever
+    the type of the first value so that later values are not truncated.
+
+    """
+    dtype = numpy.asarray(value).dtype
+    if dtype.kind in 'biuf':
+        return numpy.dtype('f8')
+    if dtype.kind == 'c':
+        return numpy.dtype('c16')
+    return dtype
+
 
 class _HDF5File(h5py.File):
     """Resize the datasets before closing the file
 
-    Sets the compression with a boolean
+    Sets the compression, the chunks and the shuffle filter of the datasets.
+
+    Data staged by a writer attached to the file are written before closing.
 
     """
+    #: Writer staging the data written in this file.
+    writer = None
 
     def close(self):
-        for dataset in self.keys():
-            oldshape = self[dataset].shape
-            newshape = (self.attrs['count_calls'], ) + oldshape[1:]
-            self[dataset].resize(newshape)
-        super(_HDF5File, self).close()
-
-    def create_dataset(self, name, shape, maximumshape, datatype, compress):
+        try:
+            if self.writer is not None:
+                self.writer.close()
+        finally:
+            for dataset in self.keys():
+                oldshape = self[dataset].shape
+                newshape = (self.attrs['count_calls'], ) + oldshape[1:]
+                self[dataset].resize(newshape)
+            super(_HDF5File, self).close()
+
+    def create_dataset(self, name, shape, maximumshape, datatype, compress,
+                       chunks=True, shuffle=False):
         f = super(_HDF5File, self)
         if compress != 'None':
             f.create_dataset(name, shape, maxshape=maximumshape,
-                             dtype=datatype, compression=compress)
+                             dtype=datatype, compression=compress,
+                             chunks=chunks, shuffle=shuffle)
         else:
             f.create_dataset(name, shape, maxshape=maximumshape,
-                             dtype=datatype)
+                             dtype=datatype, chunks=chunks, shuffle=shuffle)
+
+
+#: Target size in bytes of the chunks of the HDF5 datasets. Chunks should stay
+#: smaller than the HDF5 chunk cache (1 MiB by default).
+HDF5_CHUNK_BYTES = 2**18
+
+#: Factor by which the HDF5 datasets are extended when they are full.
+HDF5_GROWTH = 1.5
+
+
+def _chunk_shape(row_shape, itemsize, calls, target=HDF5_CHUNK_BYTES):
+    """Chunk shape of a dataset whose rows are appended one after the other.
+
+    A chunk groups as many rows as possible, up to `calls`, while staying
+    close to `target` bytes. Rows larger than the target are split along
+    their first axes.
+
+    Parameters
+    ----------
+    row_shape : tuple
+        Shape of a row of the dataset.
+
+    itemsize : int
+        Size in bytes of an element of the dataset.
+
+    calls : int
+        Maximal number of rows in a chunk, usually the number of rows
+        written at once.
+
+    target : int, optional
+        Targeted size of a chunk in bytes.
+
+    """
+    row_bytes = int(numpy.prod(row_shape, dtype=numpy.int64))*itemsize
+    rows = int(max(1, min(calls, target // max(row_bytes, 1))))
+    chunk = [rows] + list(row_shape)
+    for i in range(1, len(chunk)):
+        size = int(numpy.prod(chunk, dtype=numpy.int64))*itemsize
+        if size <= target:
+            break
+        chunk[i] = max(1, chunk[i]*target // size)
+    return tuple(chunk)
+
+
+class _HDF5BatchWriter(object):
+    """Stage the rows to write in a HDF5 file and write them by slices.
+
+    The rows are accumulated in memory and handed to a background thread
+    which writes them in a single slice per dataset, once `rows` rows are
+    staged or when the oldest staged row is older than `interval`. The
+    'count_calls' attribute of the file is updated only once the data have
+    been written so that SWMR readers always see consistent data.
+
+    Parameters
+    ----------
+    file : _HDF5File
+        File in which to write. All the datasets must exist and the file must
+        not be accessed by anything else while the writer is running.
+
+    shapes : OrderedDict
+        Shape of a row for each dataset.
+
+    dtype : str
+        Data type of the datasets.
+
+    rows : int
+        Number of rows to stage before writing them.
+
+    interval : float
+        Maximal time in seconds during which a row can stay staged. If it is
+        not positive the rows are only written by batches of `rows` rows and
+        when closing.
+
+    growth : float, optional
+        Factor by which to extend the datasets when they are full.
+
+    """
+    def __init__(self, file, shapes, dtype, rows, interval,
+                 growth=HDF5_GROWTH):
+        self.file = file
+        self.shapes = shapes
+        self.dtype = dtype
+        self.rows = max(1, rows)
+        self.interval = interval if interval > 0 else None
+        self.growth = growth
+        self.written = int(file.attrs['count_calls'])
+        self._lock = Lock()
+        self._queue = Queue()
+        self._error = None
+        self._staged_time = time.monotonic()
+        self._new_stage()
+        self._thread = Thread(target=self._run, name='HDF5 writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, row):
+        """Stage a row, given as a dict of the value of each dataset.
+
+        """
+        if self._error is not None:
+            raise self._error
+        with self._lock:
+            index = self._staged
+            if not index:
+                self._staged_time = time.monotonic()
+            for name, value in row.items():
+                self._stage[name][index] = value
+            self._staged += 1
+            if self._staged == self.rows:
+                self._hand_over()
+
+    def close(self):
+        """Write all the staged rows and stop the background thread.
+
+        """
+        with self._lock:
+            self._hand_over()
+            self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _new_stage(self):
+        """Allocate the arrays in which to stage the rows.
+
+        """
+        self._stage = {name: numpy.empty((self.rows,) + shape, self.dtype)
+                       for name, shape in self.shapes.items()}
+        self._staged = 0
+
+    def _hand_over(self):
+        """Queue the staged rows for writing (must be called under the lock).
+
+        """
+        if self._staged:
+            self._queue.put((self._stage, self._staged))
+            self._new_stage()
+
+    def _run(self):
+        """Write the queued rows until closed.
+
+        Any error is stored to be raised by the next call to append or
+        close.
+
+        """
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.interval)
+                except Empty:
+                    with self._lock:
+                        if (time.monotonic() - self._staged_time >=
+                                self.interval):
+                            self._hand_over()
+                    continue
+                if item is None:
+                    return
+                # Keep on emptying the queue after an error so that close
+                # does not block.
+                if self._error is None:
+                    try:
+                        self._write(*item)
+                    except Exception as e:
+                        self._error = e
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+
+    def _write(self, stage, count):
+        """Write a batch of rows after the rows already written.
+
+        """
+        f = self.file
+        start = self.written
+        stop = start + count
+        for name in self.shapes:
+            dataset = f[name]
+            if dataset.shape[0] < stop:
+                length = max(stop, int(dataset.shape[0]*self.growth))
+                dataset.resize((length,) + dataset.shape[1:])
+            dataset[start:stop] = stage[name][:count]
+        f.attrs['count_calls'] = stop
+        f.flush()
+        self.written = stop
+
 
 VAL_REAL = validators.Feval(types=numbers.Real)
 
+VAL_INT = validators.Feval(types=numbers.Integral)
+
 
 class SaveFileHDF5Task(SimpleTask):
     """ Save the specified entries in a HDF5 file.
@@ -524,15 +1029,33 @@ class SaveFileHDF5Task(SimpleTask):
     datatype = Enum('float16', 'float32', 'float64').tag(pref=True)
 
     #: Compression type of the data in the HDF5 file
-    compression = Enum('None', 'gzip').tag(pref=True)
+    compression = Enum('None', 'gzip', 'lzf').tag(pref=True)
+
+    #: Flag indicating whether or not to apply the shuffle filter before
+    #: compressing, which usually improves the compression of numbers.
+    shuffle = Bool(False).tag(pref=True)
 
     #: Estimation of the number of calls of this task during the measure.
     #: This helps h5py to chunk the file appropriately
     calls_estimation = Str('1').tag(pref=True, feval=VAL_REAL)
 
+    #: Number of calls whose data are stored in a single chunk of the file.
+    #: If empty it is determined from the size of the data and the number of
+    #: calls written at once.
+    chunk_calls = Str().tag(pref=True,
+                            feval=validators.SkipEmpty(types=numbers.Integral))
+
     #: Flag indicating whether or not the data should be saved in swmr mode
     swmr = Bool(True).tag(pref=True)
 
+    #: Number of calls whose data are kept in memory before being written to
+    #: the file in a single operation.
+    buffer_rows = Str('100').tag(pref=True, feval=VAL_INT)
+
+    #: Maximal time (in s) during which data are kept in memory before being
+    #: written to the file.
+    flush_interval = Str('1').tag(pref=True, feval=VAL_REAL)
+
     #: Flag indicating whether or not initialisation has been performed.
     initialized = Bool(False)
 
@@ -541,15 +1064,19 @@ class SaveFileHDF5Task(SimpleTask):
     wait = set_default({'activated': True})  # Wait on all pools by default.
 
     def perform(self):
-        """ Collect all data and write them to file.
-
-        """
+        """ Collect all data and stage them for writing.
 
-        calls_estimation = self.format_and_eval_string(self.calls_estimation)
+        The data are written to the file by a background thread, by batches
+        of `buffer_rows` calls or every `flush_interval`. All the staged data
+        are written when the file is closed at the end of the measure, be it
+        because the measure stopped or because an error occured.
 
+        """
         # Initialisation.
         if not self.initialized:
 
+            calls_estimation = int(self.format_and_eval_string(
+                self.calls_estimation))
             self._formatted_labels = []
             full_folder_path = self.format_string(self.folder)
             filename = self.format_string(self.filename)
@@ -569,6 +1096,7 @@ class SaveFileHDF5Task(SimpleTask):
             self.root.resources['files'][full_path] = self.file_object
 
             f = self.file_object
+            shapes = OrderedDict()
             for l, v in self.saved_values.items():
                 label = self.format_string(l)
                 self._formatted_labels.append(label)
@@ -577,52 +1105,51 @@ class SaveFileHDF5Task(SimpleTask):
                     names = value.dtype.names
                     if names:
                         for m in names:
-                            f.create_dataset(label + '_' + m,
-                                             (calls_estimation,) + value.shape,
-                                             (None, ) + value.shape,
-                                             self.datatype,
-                                             self.compression)
+                            shapes[label + '_' + m] = value.shape
                     else:
-                        f.create_dataset(label,
-                                         (calls_estimation,) + value.shape,
-                                         (None, ) + value.shape,
-                                         self.datatype,
-                                         self.compression)
+                        shapes[label] = value.shape
+                else:
+                    shapes[label] = ()
+            rows = self.format_and_eval_string(self.buffer_rows)
+            chunk_calls = (self.format_and_eval_string(self.chunk_calls)
+                           if self.chunk_calls else None)
+            itemsize = numpy.dtype(self.datatype).itemsize
+            for name, shape in shapes.items():
+                if chunk_calls:
+                    chunks = (chunk_calls,) + shape
                 else:
-                    f.create_dataset(label, (calls_estimation,), (None,),
-                                     self.datatype, self.compression)
+                    # Chunks are filled by the batches of staged calls.
+                    chunks = _chunk_shape(shape, itemsize, rows)
+                f.create_dataset(name, (max(1, calls_estimation),) + shape,
+                                 (None, ) + shape, self.datatype,
+                                 self.compression, chunks, self.shuffle)
             f.attrs['header'] = self.format_string(self.header)
             f.attrs['count_calls'] = 0
             if self.swmr:
                 f.swmr_mode = True
             f.flush()
 
-            self.initialized = True
-
-        f = self.file_object
-        count_calls = f.attrs['count_calls']
+            interval = self.format_and_eval_string(self.flush_interval)
+            f.writer = _HDF5BatchWriter(f, shapes, self.datatype, rows,
+                                        interval)
 
-        if not (count_calls % calls_estimation):
-            for dataset in f.keys():
-                oldshape = f[dataset].shape
-                newshape = (oldshape[0] + calls_estimation, ) + oldshape[1:]
-                f[dataset].resize(newshape)
+            self.initialized = True
 
         labels = self._formatted_labels
+        row = {}
         for i, v in enumerate(self.saved_values.values()):
             value = self.format_and_eval_string(v)
             if isinstance(value, numpy.ndarray):
                 names = value.dtype.names
                 if names:
                     for m in names:
-                        f[labels[i] + '_' + m][count_calls] = value[m]
+                        row[labels[i] + '_' + m] = value[m]
                 else:
-                    f[labels[i]][count_calls] = value
+                    row[labels[i]] = value
             else:
-                f[labels[i]][count_calls] = value
+                row[labels[i]] = value
 
-        f.attrs['count_calls'] = count_calls + 1
-        f.flush()
+        self.file_object.writer.append(row)
 
     def check(self, *args, **kwargs):
         """Check that all the parameters are correct.
@@ -677,6 +1204,11 @@ class SaveFileHDF5Task(SimpleTask):
             traceback[err_path] = "All labels must be different."
             return False, traceback
 
+        if self.format_and_eval_string(self.flush_interval) <= 0:
+            traceback[err_path + '-flush_interval'] = \
+                'The flush interval must be positive.'
+            return False, traceback
+
         return test, traceback
 
     #: List of the formatted names of the entries.
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Append-only binary files of fixed size records.
+
+A file starts with a single line JSON header describing the records (numpy
+dtype, labels of the columns and free text header) padded with spaces so
+that the records, which follow as raw bytes, are aligned on 64 bytes. The
+records are appended by writing the memory of a structured array so that no
+formatting happens while saving. An incomplete trailing record (interrupted
+write) is ignored when loading.
+
+:Contains:
+    write_header :
+        Write the header describing the records at the top of a file.
+    read_header :
+        Read the header of a file.
+    load_records :
+        Load the records stored in a file.
+    to_text :
+        Convert a file to the tab separated text layout used by SaveFileTask.
+
+"""
+import os
+import json
+
+import numpy as np
+from numpy.lib.format import dtype_to_descr, descr_to_dtype
+
+#: Marker starting the header of a binary records file.
+MAGIC = b'#RECORDS '
+
+#: Alignment in bytes of the first record.
+ALIGNMENT = 64
+
+
+def write_header(file, dtype, header=''):
+    """Write the header describing the records at the top of a file.
+
+    Parameters
+    ----------
+    file : file
+        File object opened in binary mode.
+
+    dtype : numpy.dtype
+        Structured dtype of the records, the field names are used as labels.
+
+    header : str, optional
+        Free text header of the file.
+
+    """
+    dtype = np.dtype(dtype)
+    infos = {'version': 1, 'descr': dtype_to_descr(dtype),
+             'labels': list(dtype.names), 'header': header}
+    line = MAGIC + json.dumps(infos).encode('utf-8')
+    padding = -(len(line) + 1) % ALIGNMENT
+    file.write(line + b' '*padding + b'\n')
+
+
+def read_header(file):
+    """Read the header of a file.
+
+    Parameters
+    ----------
+    file : file
+        File object opened in binary mode and positioned at the beginning of
+        the file.
+
+    Returns
+    -------
+    dtype : numpy.dtype
+        Dtype of the records.
+
+    header : str
+        Free text header of the file.
+
+    offset : int
+        Position in bytes of the first record.
+
+    """
+    line = file.readline()
+    if not line.startswith(MAGIC):
+        raise ValueError('Not a binary records file.')
+    infos = json.loads(line[len(MAGIC):].decode('utf-8'))
+    dtype = descr_to_dtype(_as_descr(infos['descr']))
+    return dtype, infos['header'], len(line)
+
+
+def load_records(path, mmap=False):
+    """Load the records stored in a file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+
+    mmap : bool, optional
+        Map the file in memory instead of reading it.
+
+    Returns
+    -------
+    records : numpy.ndarray
+        Structured array of the complete records of the file.
+
+    """
+    with open(path, 'rb') as f:
+        dtype, _, offset = read_header(f)
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if mmap:
+        if not count:
+            return np.empty(0, dtype)
+        return np.memmap(path, dtype, 'r', offset, (count,))
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return np.fromfile(f, dtype, count)
+
+
+def to_text(path, text_path=None):
+    """Convert a file to the tab separated text layout used by SaveFileTask.
+
+    Parameters
+    ----------
+    path : str
+        Path of the binary file.
+
+    text_path : str, optional
+        Path of the text file to create. By default the extension of the
+        binary file is replaced by '.txt'.
+
+    Returns
+    -------
+    text_path : str
+        Path of the created text file.
+
+    """
+    if text_path is None:
+        text_path = os.path.splitext(path)[0] + '.txt'
+    with open(path, 'rb') as f:
+        _, header, _ = read_header(f)
+    records = load_records(path, mmap=True)
+
+    with open(text_path, 'wb') as f:
+        if header:
+            for line in header.split('\n'):
+                f.write(('# ' + line + '\n').encode('utf-8'))
+        f.write(('\t'.join(records.dtype.names) + '\n').encode('utf-8'))
+        if len(records):
+            # Complex values are written as str would do.
+            fmt = ['%s' if records.dtype[n].kind == 'c' else '%.18e'
+                   for n in records.dtype.names]
+            np.savetxt(f, records, fmt=fmt, delimiter='\t')
+
+    return text_path
+
+
+def _as_descr(descr):
+    """Convert a descr decoded from JSON back to a list of tuples.
+
+    """
+    if isinstance(descr, str):
+        return descr
+    return [tuple(_as_descr(d) if isinstance(d, list) else d
+                  for d in field) for field in descr]
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Digital demodulation of the traces acquired by the digitizers.
+
+The demodulation of a record is the scalar product of the record with a
+complex kernel exp(2i pi f t): the real part is the I quadrature and the
+imaginary part the Q quadrature (up to a factor 2 accounting for the mean
+value of cos^2). The records are processed by chunks and the products are
+computed directly in the preallocated complex output, so that the temporary
+memory is bounded whatever the number of records.
+
+:Contains:
+    demodulation_kernel :
+        Cached complex demodulation kernel.
+    demodulate :
+        Quadratures of each record.
+    demodulate_periods :
+        Quadratures of each period of each record.
+
+"""
+from functools import lru_cache
+
+import numpy as np
+
+#: Approximate size in bytes of the blocks of records processed at once.
+CHUNK_BYTES = 2**20
+
+
+@lru_cache(maxsize=32)
+def demodulation_kernel(freq, sampling_rate, nsamples):
+    """Complex demodulation kernel exp(2i pi f t).
+
+    The kernels are cached as the same demodulation is usually performed many
+    times in a measurement, use `demodulation_kernel.cache_info()` to get the
+    number of hits and misses. The returned array is shared and hence
+    read-only.
+
+    Parameters
+    ----------
+    freq : float
+        Demodulation frequency in Hz.
+
+    sampling_rate : float
+        Sampling rate in samples per second.
+
+    nsamples : int
+        Number of samples of the kernel.
+
+    """
+    phi = 2*np.pi*freq*np.arange(nsamples)/sampling_rate
+    kernel = np.exp(1j*phi)
+    kernel.flags.writeable = False
+    return kernel
+
+
+def demodulate(records, kernel, num_loop=1, out=None, chunk_size=None):
+    """Compute the quadratures of each record.
+
+    Parameters
+    ----------
+    records : array
+        2D array of records (records, samples). Only the first samples
+        matching the length of the kernel are used.
+
+    kernel : array
+        Complex demodulation kernel.
+
+    num_loop : int, optional
+        Number of records per repetition of the pulse sequence. The output is
+        reshaped to (repetitions, num_loop).
+
+    out : array, optional
+        Complex array of shape (records,) in which to write the result.
+
+    chunk_size : int, optional
+        Number of records to process at once. By default the chunks are
+        about `CHUNK_BYTES` large.
+
+    Returns
+    -------
+    quadratures : array
+        Complex array of shape (repetitions, num_loop) whose real part is I
+        and imaginary part Q.
+
+    """
+    nrecords = len(records)
+    nsamples = len(kernel)
+    if out is None:
+        out = np.empty(nrecords, dtype=np.complex128)
+    # Use the (cos, sin) pairs of the kernel and of the output to compute
+    # both quadratures with a single matrix product per chunk.
+    weights = _as_pairs(kernel)
+    pairs = out.view(np.float64).reshape(-1, 2)
+
+    chunk_size = chunk_size or _chunk_size(nsamples)
+    for start in range(0, nrecords, chunk_size):
+        stop = min(start + chunk_size, nrecords)
+        chunk = _as_float(records[start:stop, :nsamples])
+        np.dot(chunk, weights, out=pairs[start:stop])
+
+    out *= 2/nsamples
+    return out.reshape(-1, num_loop)
+
+
+def demodulate_periods(records, kernel, samples_per_period, num_loop=1,
+                       out=None, chunk_size=None):
+    """Compute the quadratures of each period of each record.
+
+    Parameters
+    ----------
+    records : array
+        2D array of records (records, samples). Samples which do not belong
+        to a full period are discarded.
+
+    kernel : array
+        Complex demodulation kernel, at least one period long. As the
+        sampling rate is a multiple of the frequency only its first period is
+        used.
+
+    samples_per_period : int
+        Number of samples in one period of the demodulation frequency.
+
+    num_loop : int, optional
+        Number of records per repetition of the pulse sequence.
+
+    out : array, optional
+        Complex array of shape (records, periods) in which to write the
+        result.
+
+    chunk_size : int, optional
+        Number of records to process at once.
+
+    Returns
+    -------
+    quadratures : array
+        Complex array of shape (repetitions, num_loop, periods).
+
+    """
+    nrecords, nsamples = np.shape(records)
+    periods = nsamples//samples_per_period
+    if out is None:
+        out = np.empty((nrecords, periods), dtype=np.complex128)
+    weights = _as_pairs(kernel[:samples_per_period])
+    pairs = out.view(np.float64).reshape(nrecords, periods, 2)
+
+    chunk_size = chunk_size or _chunk_size(nsamples)
+    for start in range(0, nrecords, chunk_size):
+        stop = min(start + chunk_size, nrecords)
+        chunk = _as_float(records[start:stop, :periods*samples_per_period])
+        chunk = chunk.reshape(stop - start, periods, samples_per_period)
+        np.dot(chunk, weights, out=pairs[start:stop])
+
+    out *= 2/samples_per_period
+    return out.reshape(-1, num_loop, periods)
+
+
+def _as_pairs(kernel):
+    """View a complex kernel as an array of (real, imaginary) pairs.
+
+    """
+    kernel = np.ascontiguousarray(kernel, dtype=np.complex128)
+    return kernel.view(np.float64).reshape(-1, 2)
+
+
+def _as_float(chunk):
+    """Convert a chunk to float64, without copy if possible.
+
+    """
+    return np.asarray(chunk, dtype=np.float64)
+
+
+def _chunk_size(nsamples):
+    """Number of records fitting in a chunk.
+
+    """
+    return max(1, CHUNK_BYTES//(8*nsamples))
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Test the tools used by the digitizer drivers to process the buffers.
+
+"""
+import time
+
+import numpy as np
+import pytest
+
+from exopy_hqc_legacy.instruments.drivers.acquisition_tools import (
+    ScaledArray, AverageReducer, RecordsReducer, DemodReducer, BufferPipeline,
+    SaturationMonitor, ParallelAcquisition)
+from exopy_hqc_legacy.instruments.drivers.driver_tools import InstrIOError
+from exopy_hqc_legacy.instruments.drivers.dll_tools import DllInstrument
+
+
+def test_scaled_array():
+    """Test the lazy conversion of raw samples.
+
+    """
+    raw = np.arange(-10, 10, dtype=np.int16).reshape(4, 5)
+    arr = ScaledArray(raw, 0.5, 1.0, np.float32)
+    assert arr.shape == (4, 5) and len(arr) == 4
+    expected = raw*0.5 + 1.0
+    np.testing.assert_array_equal(np.asarray(arr), expected)
+    assert np.asarray(arr).dtype == np.float32
+    np.testing.assert_array_equal(arr[1:3, :2], expected[1:3, :2])
+    assert arr.astype(np.float64).dtype == np.float64
+    assert np.shares_memory(arr.reshape(20).raw, raw)
+
+
+@pytest.mark.parametrize('dtype, low, high',
+                         [(np.uint16, 0, 2**16), (np.int16, -2**15, 2**15)])
+@pytest.mark.parametrize('workers', [0, 3])
+def test_average_reducer(dtype, low, high, workers):
+    """Test that integer accumulation matches averaging in float.
+
+    """
+    records = np.random.randint(low, high, (1000, 50)).astype(dtype)
+    reducer = AverageReducer(1, 50, scale=1.9/65535, offset=0.1)
+    pipeline = BufferPipeline(workers)
+    futures = [pipeline.submit(reducer.reduce, 0, records[i:i+64], i)
+               for i in range(0, 1000, 64)]
+    for f in futures:
+        f.result()
+    pipeline.shutdown()
+
+    expected = np.mean(records.astype(np.float64), 0)*1.9/65535 + 0.1
+    np.testing.assert_allclose(reducer.result(0), expected, rtol=1e-12)
+
+
+def test_average_reducer_many_records():
+    """Test that summing more than 2**15 saturated records does not overflow.
+
+    """
+    records = np.full((2**15 + 10, 4), 2**16 - 1, dtype=np.uint16)
+    reducer = AverageReducer(1, 4)
+    reducer.reduce(0, records, 0)
+    reducer.reduce(0, records, 0)
+    np.testing.assert_array_equal(reducer.result(0), 2**16 - 1)
+
+
+def test_records_reducer():
+    """Test storing the records at the right position.
+
+    """
+    records = np.arange(40, dtype=np.uint16).reshape(10, 4)
+    reducer = RecordsReducer(2, 10, 4, [False, True])
+    reducer.reduce(1, records[5:], 5)
+    reducer.reduce(1, records[:5], 0)
+    assert reducer.result(0) is None
+    np.testing.assert_array_equal(reducer.result(1), records)
+
+
+def test_demod_reducer():
+    """Test computing the quadratures of the records.
+
+    """
+    records = np.random.randint(0, 2**16, (10, 8)).astype(np.uint16)
+    kernel = np.random.normal(size=(6, 2))
+    reducer = DemodReducer([kernel], 10)
+    reducer.reduce(0, records[:4], 0)
+    reducer.reduce(0, records[4:], 4)
+    np.testing.assert_allclose(reducer.result(0),
+                               records[:, :6].astype(float) @ kernel)
+
+
+@pytest.mark.parametrize('abort', [False, True])
+def test_saturation_monitor(abort):
+    """Test locating the clipped records and aborting on saturation.
+
+    """
+    records = np.full((6, 8), 2**15, dtype=np.uint16)
+    records[2, 1] = 10
+    records[5, 3:6] = 2**16 - 10
+    monitor = SaturationMonitor(2, 6, 100, 2**16 - 100, abort, ['A', 'B'])
+    monitor.check(1, records[:2], 0)
+    if abort:
+        with pytest.raises(InstrIOError):
+            monitor.check(1, records[2:], 2)
+        return
+    monitor.check(0, records[:3], 0)
+    monitor.check(1, records[3:], 3)
+
+    report = monitor.report()
+    assert report.saturated
+    assert report.clipped_samples == [1, 3]
+    assert [list(r) for r in report.clipped_records] == [[2], [5]]
+    assert report.minimum[0] == 10 and report.maximum[1] == 2**16 - 10
+    assert 'Channel B: 3 clipped samples in 1 records (5)' in str(report)
+
+
+class FakeBoard(DllInstrument):
+    """Board recording the steps of its acquisitions.
+
+    """
+    def __init__(self, events, fail=False, hang=0):
+        super(FakeBoard, self).__init__({}, auto_open=False)
+        self.events = events
+        self.fail = fail
+        self.hang = hang
+
+    def get_traces(self, channels, duration, delay, records_per_capture,
+                   retry=True, on_armed=None):
+        assert self.lock.locked() and not retry
+        if self.fail:
+            raise InstrIOError('Board failure')
+        time.sleep(self.hang)
+        self.events.append('armed')
+        on_armed()
+        self.events.append('acquired')
+        return [np.full(records_per_capture, c) for c in channels]
+
+
+def test_parallel_acquisition():
+    """Test that no board acquires before all of them are armed.
+
+    """
+    events = []
+    boards = [FakeBoard(events) for _ in range(3)]
+    acq = ParallelAcquisition(boards, lambda: events.append('trigger'),
+                              timeout=10)
+    data = acq.acquire([{'channels': (i,)} for i in range(3)], duration=1e-6,
+                       delay=0, records_per_capture=4)
+    assert events[:4] == ['armed']*3 + ['trigger']
+    assert events[4:] == ['acquired']*3
+    assert [d[0][0] for d in data] == [0, 1, 2]
+    assert acq.arm_skew >= 0
+    assert not any(b.lock.locked() for b in boards)
+
+
+def test_parallel_acquisition_failure():
+    """Test that a failing board aborts the acquisition on the others.
+
+    """
+    events = []
+    boards = [FakeBoard(events), FakeBoard(events, fail=True)]
+    acq = ParallelAcquisition(boards, lambda: events.append('trigger'))
+    with pytest.raises(InstrIOError) as e:
+        acq.acquire(channels=(1,), duration=1e-6, delay=0,
+                    records_per_capture=4)
+    assert 'Board failure' in str(e.value)
+    assert 'trigger' not in events and 'acquired' not in events
+
+
+def test_parallel_acquisition_timeout():
+    """Test that a board not armed in time releases the other ones.
+
+    """
+    events = []
+    boards = [FakeBoard(events), FakeBoard(events, hang=0.5)]
+    acq = ParallelAcquisition(boards, lambda: events.append('trigger'),
+                              timeout=0.05)
+    assert ParallelAcquisition(boards).timeout == 10
+    acq.start(channels=(1,), duration=1e-6, delay=0, records_per_capture=4)
+    time.sleep(0.3)
+    # The armed board gave up and released its lock.
+    assert not boards[0].lock.locked()
+    with pytest.raises(InstrIOError) as e:
+        acq.wait()
+    assert 'timeout' in str(e.value)
+    assert 'trigger' not in events and 'acquired' not in events
+    assert not any(b.lock.locked() for b in boards)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Test the acquisition of the Alazar driver using a fake board.
+
+"""
+import ctypes
+from collections import deque
+
+import numpy as np
+import pytest
+
+from exopy_hqc_legacy.instruments.drivers.acquisition_tools import ScaledArray
+from exopy_hqc_legacy.instruments.drivers.dll.alazar935x import Alazar935x
+from exopy_hqc_legacy.instruments.drivers.driver_tools import InstrIOError
+
+#: Number of samples of a record for a duration of DURATION.
+SAMPLES = 64
+
+DURATION = SAMPLES/500e6
+
+#: Size in bytes of a record.
+RECORD_BYTES = 2*SAMPLES
+
+
+class FakeBoard(object):
+    """Board filling the posted DMA buffers with predefined records.
+
+    Parameters
+    ----------
+    records : np.ndarray
+        Raw samples acquired on each active channel, of shape (channels,
+        records, samples).
+
+    fail_at : int, optional
+        Index of the buffer whose wait fails.
+
+    """
+    def __init__(self, records, fail_at=None):
+        self.records = records
+        self.fail_at = fail_at
+        self.posted = deque()
+        self.filled = []
+        self.started = False
+        self.aborted = False
+
+    def setTriggerDelay(self, samples):
+        pass
+
+    def getChannelInfo(self):
+        return 2**20, ctypes.c_uint8(16)
+
+    def setRecordSize(self, pre_trigger, post_trigger):
+        pass
+
+    def beforeAsyncRead(self, channels, offset, samples, records_per_buffer,
+                        records_per_acquisition, flags):
+        self.records_per_buffer = records_per_buffer
+        self.records_per_acquisition = records_per_acquisition
+
+    def postAsyncBuffer(self, addr, size):
+        self.posted.append((addr.value, size))
+
+    def startCapture(self):
+        self.started = True
+
+    def waitAsyncBufferComplete(self, addr, timeout_ms):
+        # The board fills the buffers in the order in which they are posted.
+        address, size = self.posted.popleft()
+        assert address == addr.value
+        if len(self.filled) == self.fail_at:
+            raise RuntimeError('Timeout')
+        channels, _, samples = self.records.shape
+        rpb = self.records_per_buffer
+        start = len(self.filled)*rpb
+        chunk = np.zeros((channels, rpb, samples), np.uint16)
+        part = self.records[:, start:start+rpb]
+        chunk[:, :part.shape[1]] = part
+        assert chunk.nbytes <= size
+        ctypes.memmove(address, chunk.ctypes.data, chunk.nbytes)
+        self.filled.append(address)
+
+    def abortAsyncRead(self):
+        self.aborted = True
+
+
+def make_driver(records, **kwargs):
+    """Create a driver using a fake board without opening a connection.
+
+    """
+    driver = Alazar935x.__new__(Alazar935x)
+    driver.board = FakeBoard(records, **kwargs)
+    driver.samples_per_sec = 500e6
+    return driver
+
+
+def make_records(channels, records, low=100, high=2**16 - 100):
+    """Random raw samples which do not saturate the board.
+
+    """
+    rng = np.random.RandomState(0)
+    return rng.randint(low, high, (channels, records, SAMPLES)).astype('u2')
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_get_traces_recycles_buffers(workers):
+    """Test that the buffers are posted again and the records kept in order.
+
+    """
+    records = make_records(2, 10)
+    driver = make_driver(records)
+    data = driver.get_traces((True, True), DURATION, 0, 10, buffer_count=2,
+                             buffer_size=3*2*RECORD_BYTES, workers=workers)
+
+    board = driver.board
+    assert board.records_per_buffer == 3
+    assert board.records_per_acquisition == 12
+    # Four buffers were filled using the two DMA buffers alternatively.
+    assert len(board.filled) == 4
+    assert len(set(board.filled)) == 2
+    assert board.filled[0::2] == [board.filled[0]]*2
+    assert board.aborted
+    for d, r in zip(data, records):
+        assert d.dtype == np.float64
+        np.testing.assert_array_equal(d, r)
+    stats = driver.acquisition_stats
+    assert stats.buffers == 4
+
+
+def test_get_traces_single_channel():
+    """Test that an inactive channel is replaced by a dummy array.
+
+    """
+    records = make_records(1, 5)
+    driver = make_driver(records)
+    data = driver.get_traces((False, True), DURATION, 0, 5)
+    np.testing.assert_array_equal(data[0], np.zeros(1))
+    np.testing.assert_array_equal(data[1], records[0])
+
+
+def test_get_traces_average():
+    """Test averaging the records as the buffers are received.
+
+    """
+    records = make_records(2, 10)
+    driver = make_driver(records)
+    data = driver.get_traces((True, True), DURATION, 0, 10, average=True,
+                             buffer_size=3*2*RECORD_BYTES)
+    for d, r in zip(data, records):
+        np.testing.assert_allclose(d, r.mean(axis=0))
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_get_traces_abort_on_error(workers):
+    """Test that the transfer is aborted when waiting for a buffer fails.
+
+    """
+    driver = make_driver(make_records(2, 10), fail_at=2)
+    with pytest.raises(RuntimeError, match='Timeout'):
+        driver.get_traces((True, True), DURATION, 0, 10, buffer_count=2,
+                          buffer_size=2*RECORD_BYTES, workers=workers)
+    assert driver.board.aborted
+
+
+def test_get_traces_abort_on_armed_error():
+    """Test that the transfer is aborted when the on_armed callback fails.
+
+    """
+    driver = make_driver(make_records(2, 10))
+
+    def on_armed():
+        raise InstrIOError('Other board failed')
+
+    with pytest.raises(InstrIOError):
+        driver.get_traces((True, True), DURATION, 0, 10, on_armed=on_armed)
+    assert driver.board.started and driver.board.aborted
+    assert not driver.board.filled
+
+
+def test_get_traces_invalid_arguments():
+    """Test that invalid arguments are rejected before touching the board.
+
+    """
+    driver = make_driver(make_records(2, 10))
+    with pytest.raises(ValueError):
+        driver.get_traces((True, True), DURATION, 0, 10, output='int8')
+    with pytest.raises(ValueError):
+        driver.get_traces((True, True), DURATION, 0, 10,
+                          on_saturation='ignore')
+    assert not driver.board.posted and not driver.board.started
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_get_traces_demodulation(workers):
+    """Test demodulating the records of a channel as they are received.
+
+    """
+    records = make_records(2, 10)
+    kernel = np.random.RandomState(1).rand(SAMPLES - 4, 2)
+    driver = make_driver(records)
+    data = driver.get_traces((True, True), DURATION, 0, 10,
+                             buffer_size=3*2*RECORD_BYTES, workers=workers,
+                             demod_kernels=(kernel, None))
+    assert data[0].shape == (10, 2)
+    np.testing.assert_allclose(data[0], np.dot(records[0, :, :-4], kernel))
+    np.testing.assert_array_equal(data[1], records[1])
+
+
+def test_get_traces_demodulation_single_channel():
+    """Test that the kernels are matched to the active channels.
+
+    """
+    records = make_records(1, 5)
+    kernel = np.random.RandomState(1).rand(SAMPLES, 2)
+    driver = make_driver(records)
+    data = driver.get_traces((False, True), DURATION, 0, 5,
+                             demod_kernels=(None, kernel))
+    np.testing.assert_allclose(data[1], np.dot(records[0], kernel))
+
+
+def test_get_traces_demodulation_average():
+    """Test that demodulating is refused when averaging.
+
+    """
+    driver = make_driver(make_records(2, 10))
+    with pytest.raises(ValueError):
+        driver.get_traces((True, True), DURATION, 0, 10, average=True,
+                          demod_kernels=(np.ones((SAMPLES, 2)), None))
+    assert not driver.board.started
+
+
+@pytest.mark.parametrize('output, dtype', [(None, np.float64),
+                                           ('float64', np.float64),
+                                           ('float32', np.float32)])
+def test_get_traces_output(output, dtype):
+    """Test the type of the returned records.
+
+    """
+    records = make_records(2, 10)
+    driver = make_driver(records)
+    data = driver.get_traces((True, True), DURATION, 0, 10, output=output,
+                             buffer_size=3*2*RECORD_BYTES)
+    for d, r in zip(data, records):
+        assert isinstance(d, np.ndarray) and d.dtype == dtype
+        np.testing.assert_array_equal(d, r)
+
+
+def test_get_traces_raw_output():
+    """Test returning the raw samples without conversion.
+
+    """
+    records = make_records(2, 10)
+    kernel = np.ones((SAMPLES, 2))
+    driver = make_driver(records)
+    data = driver.get_traces((True, True), DURATION, 0, 10, output='raw',
+                             buffer_size=3*2*RECORD_BYTES,
+                             demod_kernels=(None, kernel))
+    assert isinstance(data[0], ScaledArray)
+    assert data[0].raw.dtype == np.uint16
+    np.testing.assert_array_equal(data[0].raw, records[0])
+    np.testing.assert_array_equal(np.asarray(data[0]), records[0])
+    # The demodulated channels are not wrapped.
+    assert isinstance(data[1], np.ndarray)
+    np.testing.assert_allclose(data[1], np.dot(records[1], kernel))
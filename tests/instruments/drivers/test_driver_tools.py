@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Test the base tools used to write drivers.
+
+"""
+import time
+
+import pytest
+
+from exopy_hqc_legacy.instruments.drivers.driver_tools import (
+    BaseInstrument, instrument_property, make_instrument_property)
+
+
+class FakeDriver(BaseInstrument):
+    """Driver counting the reads of its properties.
+
+    """
+    caching_permissions = {'sweep_type': True, 'axis': True, 'field': True}
+
+    def __init__(self, *args, **kwargs):
+        super(FakeDriver, self).__init__(*args, **kwargs)
+        self.reads = []
+        self.writes = []
+        self.gain = 1
+        self._sweep_type = 'LIN'
+        self._power = 0
+
+    @make_instrument_property(invalidates=('axis',))
+    def sweep_type(self):
+        self.reads.append('sweep_type')
+        return self._sweep_type
+
+    @sweep_type.setter
+    def sweep_type(self, value):
+        self.writes.append('sweep_type')
+        self._sweep_type = value
+
+    @instrument_property
+    def axis(self):
+        self.reads.append('axis')
+        return self._sweep_type.lower()
+
+    @make_instrument_property(ttl=0.05)
+    def field(self):
+        self.reads.append('field')
+        return len(self.reads)
+
+    @instrument_property
+    def power(self):
+        self.reads.append('power')
+        return self._power
+
+    @power.setter
+    def power(self, value):
+        self.writes.append('power')
+        self._power = value
+
+
+class SubDriver(FakeDriver):
+
+    axis = None
+
+
+def test_instrument_property_registry():
+    """Test that the instrument properties are registered per class.
+
+    """
+    assert set(FakeDriver._instrument_properties) == {'sweep_type', 'axis',
+                                                      'field', 'power'}
+    assert 'axis' not in SubDriver._instrument_properties
+    assert FakeDriver.sweep_type.invalidates == ('axis',)
+    assert FakeDriver.sweep_type.fset is not None
+
+
+def test_instrument_property_dependencies():
+    """Test that setting a property invalidates its dependents.
+
+    """
+    driver = FakeDriver(None)
+    assert driver.axis == 'lin'
+    assert driver.axis == 'lin'
+    assert driver.reads == ['axis']
+
+    driver.sweep_type = 'POW'
+    assert driver.axis == 'pow'
+    assert driver.sweep_type == 'POW'
+    assert driver.reads == ['axis', 'axis']
+    assert driver.cache_stats['axis'] == {'hits': 1, 'misses': 2}
+
+    driver.clear_cache(['axis', 'unknown'])
+    assert driver.check_cache(['axis', 'sweep_type']) == {'axis': None,
+                                                          'sweep_type': 'POW'}
+    driver.clear_cache()
+    assert driver.check_cache() == {}
+
+
+def test_instrument_property_ttl():
+    """Test that the values with a time to live are read again.
+
+    """
+    driver = FakeDriver(None)
+    value = driver.field
+    assert driver.field == value
+    time.sleep(0.06)
+    assert driver.field != value
+
+
+def test_instrument_property_partial_init():
+    """Test the caching for drivers not calling BaseInstrument.__init__.
+
+    """
+    class LegacyDriver(FakeDriver):
+
+        def __init__(self):
+            self._caching_permissions = {'axis', 'field'}
+            self._cache = {}
+            self.reads = []
+            self._sweep_type = 'LIN'
+
+    driver = LegacyDriver()
+    assert driver.axis == 'lin'
+    assert driver.axis == 'lin'
+    assert driver.field == driver.field
+    assert driver.reads == ['axis', 'field']
+    assert driver.cache_stats == {'axis': {'hits': 1, 'misses': 1},
+                                  'field': {'hits': 1, 'misses': 1}}
+
+
+def test_instrument_property_requires_function():
+    """Test that an instrument property needs a getter or a setter.
+
+    """
+    with pytest.raises(ValueError):
+        instrument_property()
+    with pytest.raises(ValueError):
+        instrument_property(ttl=1.0)
+
+
+def test_apply():
+    """Test that only the settings differing from the known state are set.
+
+    """
+    driver = FakeDriver(None)
+    assert driver.sweep_type == 'LIN'
+    changed = driver.apply(sweep_type='LIN', power=0, gain=1)
+    assert changed == {'power': 0}
+    assert driver.writes == ['power']
+
+    changed = driver.apply(sweep_type='POW', power=0, gain=2,
+                           read_uncached=True)
+    assert changed == {'sweep_type': 'POW', 'gain': 2}
+    assert driver.writes == ['power', 'sweep_type']
+    assert driver.gain == 2
+
+    # The cache is empty so the value is sent.
+    driver.clear_cache()
+    assert driver.apply(sweep_type='POW') == {'sweep_type': 'POW'}
+
+    with pytest.raises(AttributeError):
+        driver.apply(unknown=1)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Test the tracing of the communications of the drivers.
+
+"""
+import json
+
+import pytest
+
+from exopy_hqc_legacy.instruments.drivers.driver_tools import (
+    BaseInstrument, InstrIOError, secure_communication)
+from exopy_hqc_legacy.instruments.drivers.dll_tools import DllLibrary
+from exopy_hqc_legacy.instruments.drivers.io_tracing import (
+    TRACER, IOTracer, LatencyHistogram, command_header)
+
+
+class FlakyDriver(BaseInstrument):
+    """Driver failing a given number of times before answering.
+
+    """
+    secure_com_except = (InstrIOError,)
+
+    def __init__(self, failures):
+        super(FlakyDriver, self).__init__(None)
+        self.failures = failures
+
+    def reopen_connection(self):
+        pass
+
+    @secure_communication()
+    def measure(self):
+        if self.failures:
+            self.failures -= 1
+            raise InstrIOError('Timeout')
+        return 1
+
+
+def test_latency_histogram():
+    """Test the binning and the summary of the latencies.
+
+    """
+    histogram = LatencyHistogram(resolution=1e-3, bins=4)
+    for latency in (5e-4, 1.5e-3, 3e-3, 1.):
+        histogram.add(latency)
+    assert histogram.counts == [1, 1, 1, 1]
+    assert histogram.count == 4
+    assert histogram.max == 1.
+    assert histogram.percentile(50) == 2e-3
+    assert histogram.as_dict()['p99'] == 1.
+
+
+def test_latency_histogram_edges():
+    """Test that the latencies on an upper edge belong to the lower bin.
+
+    """
+    histogram = LatencyHistogram(resolution=1e-3, bins=4)
+    for latency in (1e-3, 2e-3, 4e-3, 4.001e-3):
+        histogram.add(latency)
+    assert histogram.counts == [1, 1, 1, 1]
+    assert histogram.percentile(75) == 4e-3
+
+
+def test_command_header():
+    """Test stripping the arguments of the commands.
+
+    """
+    assert command_header('SENS1:FREQ 1e9') == 'SENS1:FREQ'
+    assert command_header('FREQ?') == 'FREQ?'
+    assert command_header('') == ''
+
+
+def test_tracer_dump(tmpdir):
+    """Test recording calls and dumping them as a Chrome trace.
+
+    """
+    tracer = IOTracer(max_events=2)
+    assert tracer.call('Driver', 'query', 'FREQ?', lambda m: '1',
+                       'FREQ?') == '1'
+    with pytest.raises(ValueError):
+        tracer.call('Driver', 'write', 'FREQ 1', int, 'a')
+    tracer.call('Other', 'write', 'FREQ 2', lambda: None)
+
+    histograms = tracer.histograms()
+    assert histograms['Driver'][('query', 'FREQ?')].count == 1
+    assert histograms['Driver'][('write', 'FREQ')].count == 1
+    assert len(tracer.events) == 2
+
+    path = str(tmpdir.join('trace.json'))
+    tracer.dump(path)
+    with open(path) as f:
+        trace = json.load(f)
+    events = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    assert [e['name'] for e in events] == ['FREQ 1', 'FREQ 2']
+    assert 'error' in events[0]['args']
+    assert len(trace['otherData']['summary']) == 3
+
+
+def test_secure_communication_tracing():
+    """Test that the number of attempts of a secured call is recorded.
+
+    """
+    driver = FlakyDriver(2)
+    with TRACER.tracing():
+        assert driver.measure() == 1
+        driver.failures = 3
+        with pytest.raises(InstrIOError):
+            driver.measure()
+    assert not TRACER.enabled
+    events = list(TRACER.events)
+    assert [(e[1], e[2], e[6]) for e in events] == [('call', 'measure', 2),
+                                                   ('call', 'measure', 2)]
+    assert events[1][7]
+
+    driver.measure()
+    assert len(TRACER.events) == 2
+    TRACER.clear()
+
+
+def test_dll_library_tracing():
+    """Test that the dll calls are recorded and the attributes forwarded.
+
+    """
+    class FakeFunction(object):
+        restype = None
+
+        def __call__(self, value):
+            return value
+
+    class FakeDll(object):
+        GetValue = FakeFunction()
+
+    library = DllLibrary.__new__(DllLibrary)
+    library._dll = FakeDll()
+    assert library.dll is library._dll
+
+    with TRACER.tracing():
+        dll = library.dll
+        # The proxy is built once.
+        assert library.dll is dll
+        assert dll.GetValue(1) == 1
+        dll.GetValue.restype = int
+        dll.timeout = 2
+    assert library._dll.GetValue.restype is int
+    assert library._dll.timeout == 2
+    assert [(e[1], e[2]) for e in TRACER.events] == [('dll', 'GetValue')]
+    assert library.dll is library._dll
+    TRACER.clear()
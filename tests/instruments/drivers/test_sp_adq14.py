@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Test the acquisition of the ADQ14 driver using a fake dll.
+
+"""
+import ctypes
+
+import numpy as np
+import pytest
+
+from exopy_hqc_legacy.instruments.drivers.acquisition_tools import ScaledArray
+from exopy_hqc_legacy.instruments.drivers.dll.sp_adq14 import SPADQ14
+from exopy_hqc_legacy.instruments.drivers.driver_tools import InstrIOError
+
+#: Number of samples of a record for a duration of DURATION.
+SAMPLES = 64
+
+DURATION = SAMPLES/500e6
+
+#: Size in bytes of a record.
+RECORD_BYTES = 2*SAMPLES
+
+#: Scaling of the raw samples to volts.
+SCALE = 1.9/65535
+
+
+class FakeResult(object):
+    """Result of a call to the dll, as returned by pyclibrary.
+
+    """
+    def __call__(self):
+        return True
+
+    def __getitem__(self, index):
+        # Used to retrieve the number of bytes per sample.
+        return 2
+
+
+class FakeFunction(object):
+    """Function of the dll recording its calls.
+
+    """
+    def __init__(self, dll, name, func=None):
+        self.dll = dll
+        self.name = name
+        self.func = func
+
+    def __call__(self, *args):
+        self.dll.calls.append(self.name)
+        return FakeResult()
+
+
+class FakeDll(object):
+    """Dll acquiring predefined records.
+
+    Parameters
+    ----------
+    records : np.ndarray
+        Raw samples acquired on each channel, of shape (2, records, samples).
+
+    rate : int, optional
+        Number of records acquired each time the number of acquired records
+        is queried.
+
+    fail_at : int, optional
+        Index of the record at which the retrieval of the data fails.
+
+    """
+    def __init__(self, records, rate=4, fail_at=None):
+        self.records = records
+        self.rate = rate
+        self.fail_at = fail_at
+        self.acquired = 0
+        self.calls = []
+        self.targets = []
+        self.batches = []
+        self.GetAcquiredRecords = FakeFunction(self, 'GetAcquiredRecords',
+                                               self._acquired_records)
+        self.GetData = FakeFunction(self, 'GetData', self._get_data)
+
+    def __getattr__(self, name):
+        return FakeFunction(self, name)
+
+    def _acquired_records(self, cu, board):
+        self.acquired = min(self.acquired + self.rate, self.records.shape[1])
+        return self.acquired
+
+    def _get_data(self, cu, board, targets, size, bytes_per_sample, start,
+                  n_records, mask, *args):
+        if self.fail_at is not None and start + n_records > self.fail_at:
+            raise RuntimeError('Transfer failed')
+        assert start + n_records <= self.acquired
+        self.batches.append((start, n_records))
+        self.targets.append(tuple(targets))
+        for c in range(2):
+            if mask & (1 << c):
+                chunk = np.ascontiguousarray(
+                    self.records[c, start:start+n_records])
+                assert chunk.size == size
+                ctypes.memmove(targets[c], chunk.ctypes.data, chunk.nbytes)
+        return True
+
+
+def make_driver(records, **kwargs):
+    """Create a driver using a fake dll without opening a connection.
+
+    """
+    driver = SPADQ14.__new__(SPADQ14)
+    driver._dll = FakeDll(records, **kwargs)
+    driver._cu_id = 1
+    driver._id = 1
+    return driver
+
+
+def make_records(records, low=-2**15 + 100, high=2**15 - 101):
+    """Random raw samples which do not saturate the board.
+
+    """
+    rng = np.random.RandomState(0)
+    return rng.randint(low, high, (2, records, SAMPLES)).astype('i2')
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_get_traces_stored(workers):
+    """Test that the records are retrieved in place as they are acquired.
+
+    """
+    records = make_records(10)
+    driver = make_driver(records)
+    data = driver.get_traces((True, True), DURATION, 0, 10,
+                             buffer_size=3*RECORD_BYTES, workers=workers)
+
+    dll = driver._dll
+    assert dll.batches == [(0, 3), (3, 3), (6, 3), (9, 1)]
+    # The records are written directly at their final position.
+    for c in range(2):
+        starts = [t[c] - dll.targets[0][c] for t in dll.targets]
+        assert starts == [0, 3*RECORD_BYTES, 6*RECORD_BYTES, 9*RECORD_BYTES]
+    for d, r in zip(data, records):
+        assert d.shape == (10, SAMPLES)
+        np.testing.assert_allclose(d, r*SCALE, rtol=1e-6)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_get_traces_average_ring(workers):
+    """Test that the averaged records are retrieved in a ring of buffers.
+
+    """
+    records = make_records(10)
+    driver = make_driver(records, rate=10)
+    data = driver.get_traces((True, True), DURATION, 0, 10, average=True,
+                             buffer_count=2, buffer_size=3*RECORD_BYTES,
+                             workers=workers)
+
+    dll = driver._dll
+    assert dll.batches == [(0, 3), (3, 3), (6, 3), (9, 1)]
+    # Only the two buffers of the ring are used.
+    assert len(set(dll.targets)) == 2
+    assert dll.targets[0::2] == [dll.targets[0]]*2
+    for d, r in zip(data, records):
+        np.testing.assert_allclose(d, r.mean(axis=0)*SCALE)
+    assert driver.acquisition_stats.buffers == 4
+
+
+def test_get_traces_single_channel():
+    """Test that an inactive channel is neither retrieved nor returned.
+
+    """
+    records = make_records(5)
+    driver = make_driver(records)
+    data = driver.get_traces((False, True), DURATION, 0, 5, average=True)
+    np.testing.assert_array_equal(data[0], np.zeros(1))
+    np.testing.assert_allclose(data[1], records[1].mean(axis=0)*SCALE)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_get_traces_disarm_on_error(workers):
+    """Test that the board is disarmed when the retrieval fails.
+
+    """
+    driver = make_driver(make_records(10), fail_at=5)
+    with pytest.raises(RuntimeError, match='Transfer failed'):
+        driver.get_traces((True, True), DURATION, 0, 10, average=True,
+                          buffer_size=2*RECORD_BYTES, workers=workers)
+    calls = driver._dll.calls
+    assert calls.count('DisarmTrigger') == 2
+    assert calls[-2:] == ['DisarmTrigger', 'MultiRecordClose']
+
+
+def test_get_traces_disarm_on_armed_error():
+    """Test that the board is disarmed when the on_armed callback fails.
+
+    """
+    driver = make_driver(make_records(10))
+
+    def on_armed():
+        raise InstrIOError('Other board failed')
+
+    with pytest.raises(InstrIOError):
+        driver.get_traces((True, True), DURATION, 0, 10, on_armed=on_armed)
+    calls = driver._dll.calls
+    assert 'ArmTrigger' in calls
+    assert calls[-2:] == ['DisarmTrigger', 'MultiRecordClose']
+    assert not driver._dll.batches
+
+
+def test_get_traces_invalid_arguments():
+    """Test that invalid arguments are rejected before touching the board.
+
+    """
+    driver = make_driver(make_records(10))
+    with pytest.raises(ValueError):
+        driver.get_traces((True, True), DURATION, 0, 10, output='int8')
+    with pytest.raises(ValueError):
+        driver.get_traces((True, True), DURATION, 0, 10,
+                          on_saturation='ignore')
+    assert not driver._dll.calls
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_get_traces_demodulation(workers):
+    """Test demodulating the records of a channel as they are retrieved.
+
+    """
+    records = make_records(10)
+    kernel = np.random.RandomState(1).rand(SAMPLES - 4, 2)
+    driver = make_driver(records)
+    data = driver.get_traces((True, True), DURATION, 0, 10, buffer_count=2,
+                             buffer_size=3*RECORD_BYTES, workers=workers,
+                             demod_kernels=(kernel, None))
+    # The demodulated channel is retrieved in the ring, the other one in
+    # place.
+    dll = driver._dll
+    assert len(set(t[0] for t in dll.targets)) == 2
+    assert len(set(t[1] for t in dll.targets)) == len(dll.targets)
+    assert data[0].shape == (10, 2)
+    np.testing.assert_allclose(data[0],
+                               np.dot(records[0, :, :-4], kernel)*SCALE)
+    np.testing.assert_allclose(data[1], records[1]*SCALE, rtol=1e-6)
+
+
+def test_get_traces_demodulation_average():
+    """Test that demodulating is refused when averaging.
+
+    """
+    driver = make_driver(make_records(10))
+    with pytest.raises(ValueError):
+        driver.get_traces((True, True), DURATION, 0, 10, average=True,
+                          demod_kernels=(np.ones((SAMPLES, 2)), None))
+    assert not driver._dll.calls
+
+
+@pytest.mark.parametrize('output, dtype', [(None, np.float32),
+                                           ('float32', np.float32),
+                                           ('float64', np.float64)])
+def test_get_traces_output(output, dtype):
+    """Test the type of the returned records.
+
+    """
+    records = make_records(10)
+    driver = make_driver(records)
+    data = driver.get_traces((True, True), DURATION, 0, 10, output=output)
+    for d, r in zip(data, records):
+        assert isinstance(d, np.ndarray) and d.dtype == dtype
+        np.testing.assert_allclose(d, r*SCALE, rtol=1e-6)
+
+
+def test_get_traces_raw_output():
+    """Test returning the retrieved samples without any copy.
+
+    """
+    records = make_records(10)
+    driver = make_driver(records)
+    data = driver.get_traces((True, False), DURATION, 0, 10, output='raw',
+                             buffer_size=3*RECORD_BYTES)
+    raw = data[0]
+    assert isinstance(raw, ScaledArray)
+    assert raw.raw.dtype == np.int16 and raw.shape == (10, SAMPLES)
+    # The samples were retrieved directly in the returned array.
+    assert raw.raw.ctypes.data == driver._dll.targets[0][0]
+    np.testing.assert_array_equal(raw.raw, records[0])
+    np.testing.assert_allclose(np.asarray(raw), records[0]*SCALE, rtol=1e-6)
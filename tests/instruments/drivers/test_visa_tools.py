@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Test the base tools of the VISA drivers.
+
+"""
+import pytest
+
+from exopy_hqc_legacy.instruments.drivers.driver_tools import (
+    InstrIOError, instrument_property)
+from exopy_hqc_legacy.instruments.drivers.io_tracing import TRACER
+from exopy_hqc_legacy.instruments.drivers.visa_tools import (VisaSessionPool,
+                                                             VisaInstrument)
+
+
+class FakeSession(object):
+    """Session recording the attributes set on it.
+
+    """
+    def __init__(self, name, **para):
+        self.name = name
+        self.closed = False
+        self.written = []
+        self.errors = []
+        self.query_delay = 0
+        self.write_termination = '\n'
+        self.read_termination = '\n'
+        self._timeout = 2000
+        for k, v in para.items():
+            setattr(self, k, v)
+
+    @property
+    def timeout(self):
+        if self.closed:
+            raise RuntimeError('Closed session')
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+
+    def close(self):
+        self.closed = True
+
+    def write(self, message):
+        self.written.append(message)
+
+    def query(self, message):
+        self.written.append(message)
+        if message == 'SYST:ERR?':
+            return self.errors.pop(0) if self.errors else '+0,"No error"'
+        return '1'
+
+
+class FakeResourceManager(object):
+    """Resource manager creating fake sessions.
+
+    """
+    def __init__(self):
+        self.opened = []
+
+    def open_resource(self, name, open_timeout, **para):
+        session = FakeSession(name, **para)
+        self.opened.append(session)
+        return session
+
+
+@pytest.fixture
+def pool():
+    return VisaSessionPool(FakeResourceManager())
+
+
+def test_pool_reuse(pool):
+    """Test that a released session is lent again with the new attributes.
+
+    """
+    session = pool.acquire('GPIB::1', timeout=10)
+    assert session.timeout == 10
+    session.read_termination = '\r'
+    pool.release(session)
+    assert not session.closed
+    assert session.timeout == 2000 and session.read_termination == '\n'
+
+    assert pool.acquire('GPIB::1', timeout=20) is session
+    assert session.timeout == 20
+    other = pool.acquire('GPIB::1')
+    assert other is not session
+    pool.release(session)
+    assert pool.acquire('GPIB::1') is session
+    assert session.timeout == 2000
+    pool.release(session)
+    pool.release(other)
+    assert other.closed and not session.closed
+
+    stats = pool.stats
+    assert stats['opened'] == 2 and stats['reused'] == 2
+    assert stats['idle'] == 1 and stats['in_use'] == 0
+
+
+def test_pool_health_check_and_eviction(pool):
+    """Test that broken and too old idle sessions are closed.
+
+    """
+    session = pool.acquire('GPIB::1')
+    pool.release(session)
+    session.closed = True
+    assert pool.acquire('GPIB::1') is not session
+    assert pool.stats['unhealthy'] == 1
+
+    pool.idle_timeout = 0.01
+    session = pool.acquire('GPIB::2')
+    pool.release(session)
+    pool.idle_timeout = 0
+    pool.evict_idle()
+    assert session.closed
+    assert pool.stats['evicted'] == 1
+
+
+def test_visa_instrument_pool(pool):
+    """Test that the drivers borrow their sessions from the pool.
+
+    """
+    class Driver(VisaInstrument):
+        session_pool = pool
+
+    driver = Driver({'resource_name': 'GPIB::1'})
+    session = driver._driver
+    driver.timeout = 50
+    driver.reopen_connection()
+    assert session.closed
+    assert driver._driver.timeout == 50
+    driver.close_connection()
+
+    driver = Driver({'resource_name': 'GPIB::1'})
+    assert pool.stats['reused'] == 1
+    driver.close_connection()
+    assert len(pool.resource_manager.opened) == 2
+
+
+def test_visa_instrument_batch(pool):
+    """Test queuing the writes and sending them as a few messages.
+
+    """
+    class Driver(VisaInstrument):
+        session_pool = pool
+        scpi_batching = True
+        batch_max_commands = 3
+
+    driver = Driver({'resource_name': 'GPIB::1'})
+    session = driver._driver
+    with driver.batch(opc=True):
+        driver.write('FREQ 1')
+        driver.write(':POW 2')
+        with driver.batch():
+            driver.write('*CLS')
+        assert not session.written
+        driver.write('OUTP 1')
+        assert driver.query('FREQ?') == '1'
+        driver.write('OUTP 0')
+    assert session.written == [':FREQ 1;:POW 2;*CLS', ':OUTP 1', 'FREQ?',
+                               ':OUTP 0', '*OPC?']
+
+    session.written = []
+    with driver.batch(max_length=14):
+        for i in range(3):
+            driver.write('A {}'.format(i))
+    assert session.written == [':A 0;:A 1;:A 2']
+    session.written = []
+    with driver.batch(max_length=13):
+        for i in range(3):
+            driver.write('A {}'.format(i))
+    assert session.written == [':A 0;:A 1', ':A 2']
+
+    session.written = []
+    with pytest.raises(RuntimeError):
+        with driver.batch():
+            driver.write('A 0')
+            raise RuntimeError()
+    assert not session.written
+    driver.write('B')
+    assert session.written == ['B']
+
+    session.errors = ['-113,"Undefined header"']
+    with pytest.raises(InstrIOError) as e:
+        with driver.batch(check_errors=True):
+            driver.write('WRONG')
+    assert 'Undefined header' in str(e.value)
+
+
+def test_visa_instrument_no_batching(pool):
+    """Test that the drivers not supporting SCPI batching send the commands
+    one by one.
+
+    """
+    class Driver(VisaInstrument):
+        session_pool = pool
+
+    driver = Driver({'resource_name': 'GPIB::1'})
+    session = driver._driver
+    with driver.batch(opc=True):
+        driver.write('FREQ 1')
+        assert session.written == ['FREQ 1']
+        driver.write('POW 2')
+    assert session.written == ['FREQ 1', 'POW 2', '*OPC?']
+
+    session.written = []
+    session.errors = ['-113,"Undefined header"']
+    with pytest.raises(InstrIOError) as e:
+        with driver.batch(check_errors=True):
+            driver.write('WRONG')
+    assert session.written[0] == 'WRONG'
+    assert 'Undefined header' in str(e.value)
+
+
+@pytest.mark.parametrize('batching, written',
+                         [(False, ['FREQ 1', 'POW 2']),
+                          (True, [':FREQ 1;:POW 2'])])
+def test_visa_instrument_apply(pool, batching, written):
+    """Test that apply only batches the commands when the driver supports it.
+
+    """
+    class Driver(VisaInstrument):
+        session_pool = pool
+        scpi_batching = batching
+
+        @instrument_property
+        def frequency(self):
+            return 0
+
+        @frequency.setter
+        def frequency(self, value):
+            self.write('FREQ {}'.format(value))
+
+        @instrument_property
+        def power(self):
+            return 0
+
+        @power.setter
+        def power(self, value):
+            self.write('POW {}'.format(value))
+
+    driver = Driver({'resource_name': 'GPIB::1'})
+    assert driver.apply(frequency=1, power=2) == {'frequency': 1, 'power': 2}
+    assert driver._driver.written == written
+
+
+def test_visa_instrument_tracing(pool):
+    """Test that the messages are recorded only when tracing is enabled.
+
+    """
+    class Driver(VisaInstrument):
+        session_pool = pool
+        scpi_batching = True
+
+    driver = Driver({'resource_name': 'GPIB::1'})
+    driver.write('FREQ 1')
+    assert not TRACER.events
+
+    with TRACER.tracing():
+        with driver.batch():
+            driver.write('FREQ 2')
+            driver.write('POW 1')
+        driver.query('FREQ?')
+    events = [(e[0], e[1], e[2], e[5]) for e in TRACER.events]
+    assert events == [('Driver (GPIB::1)', 'write', ':FREQ 2;:POW 1', 14),
+                      ('Driver (GPIB::1)', 'query', 'FREQ?', 6)]
+    histograms = TRACER.histograms()['Driver (GPIB::1)']
+    assert set(histograms) == {('write', ':FREQ'), ('query', 'FREQ?')}
+    TRACER.clear()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Tests for the DemodSPTask
+
+"""
+from multiprocessing import Event
+
+import numpy as np
+
+from exopy.tasks.api import RootTask
+from exopy_hqc_legacy.tasks.tasks.instr.spdev_tasks import DemodSPTask
+from exopy_hqc_legacy.instruments.drivers.acquisition_tools import (
+    ScaledArray, SaturationReport)
+
+from .instr_helper import InstrHelper, InstrHelperStarter, PROFILES, DRIVERS
+
+#: Raw records returned by the driver, the records are 210 ns long.
+RECORDS = np.random.RandomState(0).randint(-2**14, 2**14, (6, 105))
+
+
+def get_traces(channels, duration, delay, records, **kwargs):
+    """Mimic the driver by demodulating the channels for which a kernel is
+    given.
+
+    """
+    assert records == len(RECORDS)
+    data = []
+    for c, kernel in zip(channels, kwargs['demod_kernels']):
+        if not c:
+            data.append(np.zeros(1))
+        elif kernel is not None:
+            data.append(np.dot(RECORDS[:, :len(kernel)], kernel))
+        elif kwargs['average']:
+            data.append(RECORDS.mean(axis=0))
+        else:
+            data.append(ScaledArray(RECORDS))
+    return data
+
+
+class TestDemodSPTask(object):
+
+    def setup(self):
+        self.root = RootTask(should_stop=Event(), should_pause=Event())
+        self.task = DemodSPTask(name='Test', duration='210', num_loop='2',
+                                records_number='3')
+        self.root.add_child_task(0, self.task)
+
+        self.root.run_time[DRIVERS] = {'Test': (InstrHelper,
+                                                InstrHelperStarter())}
+        report = SaturationReport([0, 0], [0, 0], [0, 0], [[], []],
+                                  ['1', '2'])
+        self.calls = []
+
+        def record_call(driver, *args, **kwargs):
+            self.calls.append(kwargs)
+            return get_traces(*args, **kwargs)
+
+        self.root.run_time[PROFILES] =\
+            {'Test1': {'connections': {'C': {'owner': '',
+                                             'saturation_report': report}},
+                       'settings': {'S': {'check_connection': [True],
+                                          'configure_board': lambda d: None,
+                                          'get_traces': record_call,
+                                          'samples_per_record':
+                                              lambda d, t: int(round(5e8*t))}}
+                       }
+             }
+
+        # This is set simply to make sure the test of InstrTask pass.
+        self.task.selected_instrument = ('Test1', 'Test', 'C', 'S')
+
+    def perform(self, **members):
+        """Run a new task and return the demodulated quadratures of channel 1
+        and the arguments passed to the driver.
+
+        """
+        self.setup()
+        for name, value in members.items():
+            setattr(self.task, name, value)
+        self.root.prepare()
+        self.task.perform()
+        quadratures = (self.root.get_from_database('Test_Ch1_I') +
+                       1j*self.root.get_from_database('Test_Ch1_Q'))
+        return quadratures, self.calls[-1]
+
+    def test_perform_driver_kernel(self):
+        """Test that the driver demodulates the channels whose trace is not
+        needed and that the result matches the demodulation of the records.
+
+        """
+        quadratures, kwargs = self.perform(ch2_trace=True)
+        kernel, no_kernel = kwargs['demod_kernels']
+        assert kernel.shape == (100, 2)
+        assert no_kernel is None
+        assert kwargs['output'] == 'raw' and not kwargs['average']
+
+        # Demodulating the raw records in the task gives the same result.
+        expected, kwargs = self.perform(ch1_trace=True, ch2_trace=True)
+        assert kwargs['demod_kernels'] == [None, None]
+        assert quadratures.shape == (3,)
+        np.testing.assert_allclose(quadratures, expected)
+        assert self.root.get_from_database('Test_Ch1_trace').shape ==\
+            (3, 2, 100)
+
+    def test_perform_driver_kernel_average(self):
+        """Test averaging the quadratures computed by the driver.
+
+        """
+        quadratures, kwargs = self.perform(average='Avg after demod')
+        assert kwargs['demod_kernels'][0] is not None
+
+        expected, kwargs = self.perform(average='Avg after demod',
+                                        ch1_trace=True)
+        assert kwargs['demod_kernels'][0] is None
+        np.testing.assert_allclose(quadratures, expected)
+
+    def test_perform_average_before_demod(self):
+        """Test that no kernel is used when the driver averages the traces.
+
+        """
+        _, kwargs = self.perform(average='Avg before demod')
+        assert kwargs['demod_kernels'] == [None, None]
+        assert kwargs['average'] and kwargs['output'] is None
@@ -10,6 +10,7 @@
 
 """
 from multiprocessing import Event
+from collections import OrderedDict
 
 import pytest
 import enaml
@@ -18,11 +19,13 @@ from exopy.tasks.api import RootTask
 from exopy.testing.util import show_and_close_widget
 
 from exopy_hqc_legacy.tasks.tasks.util.array_tasks import (ArrayExtremaTask,
-                                                          ArrayFindValueTask)
+                                                          ArrayFindValueTask,
+                                                          ArrayReduceTask,
+                                                          reduce_array)
 
 with enaml.imports():
     from exopy_hqc_legacy.tasks.tasks.util.views.array_views\
-        import ArrayExtremaView, ArrayFindValueView
+        import ArrayExtremaView, ArrayFindValueView, ArrayReduceView
 
 
 class TestArrayExtremaTask(object):
@@ -353,6 +356,84 @@ class TestArrayFindValueTask(object):
 
         assert self.task.get_from_database('Test_index') == 3
 
+    def test_perform_index(self):
+        """Test that searching the same read-only array again uses a sorted
+        index which is discarded when another array is searched.
+
+        """
+        array = self.root.get_from_database('array').copy()
+        array.flags.writeable = False
+        self.root.write_in_database('array', array)
+        self.task.value = '1.6359'
+        self.task.target_array = '{array}'
+        self.task.column_name = 'var1'
+        self.root.prepare()
+
+        self.task.perform()
+        assert self.task._index[2] is None
+        self.task.value = '-1.5'
+        self.task.perform()
+        assert self.task._index[2] is not None
+        assert self.task.get_from_database('Test_index') == 1
+
+        array = array.copy()
+        array['var1'][0] = 1.6359
+        array.flags.writeable = False
+        self.root.write_in_database('array', array)
+        self.task.value = '1.6359'
+        self.task.perform()
+        assert self.task._index[2] is None
+        assert self.task.get_from_database('Test_index') == 0
+
+        self.task.value = '2'
+        with pytest.raises(ValueError):
+            self.task.perform()
+
+    def test_perform_in_place(self):
+        """Test that arrays modified in place are never indexed.
+
+        """
+        self.task.value = '1.6359'
+        self.task.target_array = '{array}'
+        self.task.column_name = 'var1'
+        self.root.prepare()
+
+        self.task.perform()
+        self.task.perform()
+        assert self.task._index is None
+        assert self.task.get_from_database('Test_index') == 3
+
+        array = self.root.get_from_database('array')
+        array['var1'][0] = 1.6359
+        self.task.perform()
+        assert self.task.get_from_database('Test_index') == 0
+
+        # A read-only view of a writable array can still change.
+        view = array.view()
+        view.flags.writeable = False
+        self.root.write_in_database('array', view)
+        self.task.perform()
+        array['var1'][0] = 0
+        self.task.perform()
+        assert self.task._index is None
+        assert self.task.get_from_database('Test_index') == 3
+
+    def test_perform_static(self):
+        """Test that a writable array declared static is indexed.
+
+        """
+        self.task.value = '1.6359'
+        self.task.target_array = '{array}'
+        self.task.column_name = 'var1'
+        self.task.static_array = True
+        self.root.prepare()
+
+        self.task.perform()
+        self.task.value = '-1.5'
+        self.task.perform()
+        assert self.task._index[2] is not None
+        assert self.task.get_from_database('Test_index') == 1
+
 
 @pytest.mark.ui
 def test_array_find_value_view(exopy_qtbot):
@@ -364,3 +445,132 @@ def test_array_find_value_view(exopy_qtbot):
     root.children.append(task)
 
     show_and_close_widget(exopy_qtbot, ArrayFindValueView(task=task))
+
+
+class TestArrayReduceTask(object):
+
+    def setup(self):
+        self.root = RootTask(should_stop=Event(), should_pause=Event())
+        self.task = ArrayReduceTask(name='Test')
+        self.root.add_child_task(0, self.task)
+        array = np.zeros((5,), dtype={'names': ['var1', 'var2'],
+                                      'formats': ['f8', 'f8']})
+        array['var1'] = [0, 1, 2, 3, 4]
+        array['var2'][1] = -1
+        array['var2'][3] = 1
+        self.root.write_in_database('array', array)
+        self.task.target_array = '{array}'
+
+    def test_operations_observation(self):
+        """Check that the database entries follow the operations.
+
+        """
+        self.task.operations = OrderedDict([('m', ('var2', 'max', '')),
+                                            ('i', ('var1', 'first', '2'))])
+        assert self.task.get_from_database('Test_m') == 1.0
+        assert self.task.get_from_database('Test_i') == 0
+
+        self.task.operations = OrderedDict([('new', '')])
+        aux = self.task.list_accessible_database_entries()
+        assert 'Test_new' in aux
+        assert 'Test_m' not in aux
+
+    def test_check1(self):
+        """Test that everything is ok if the columns exist.
+
+        """
+        self.task.operations = OrderedDict([('m', ('var2', 'max', '')),
+                                            ('i', ('var1', 'first', '2'))])
+        test, traceback = self.task.check()
+        assert test
+        assert not traceback
+
+    def test_check2(self):
+        """Test handling wrong columns, operations and values.
+
+        """
+        self.task.operations = OrderedDict([('m', ('var3', 'max', '')),
+                                            ('o', ('var1', 'mean', '')),
+                                            ('i', ('var1', 'first', '*'))])
+        test, traceback = self.task.check()
+        assert not test
+        assert len(traceback) == 3
+        assert 'root/Test-m' in traceback
+
+    def test_perform(self):
+        """Test performing several operations at once.
+
+        """
+        self.task.operations = OrderedDict([
+            ('max', ('var2', 'max', '')), ('argmin', ('var2', 'argmin', '')),
+            ('first', ('var1', 'first', '3')),
+            ('nearest', ('var1', 'nearest', '1.4')),
+            ('nearest2', ('var2', 'nearest', '0.8')),
+            ('nearest3', ('var1', 'nearest_sorted', '2.6'))])
+        self.root.prepare()
+
+        self.task.perform()
+
+        assert self.task.get_from_database('Test_max') == 1.0
+        assert self.task.get_from_database('Test_argmin') == 1
+        assert self.task.get_from_database('Test_first') == 3
+        assert self.task.get_from_database('Test_nearest') == 1
+        assert self.task.get_from_database('Test_nearest2') == 3
+        assert self.task.get_from_database('Test_nearest3') == 3
+
+
+@pytest.mark.parametrize('chunk_bytes', [2**20, 16])
+def test_reduce_array(monkeypatch, chunk_bytes):
+    """Test the reductions when the array is processed by several blocks.
+
+    """
+    from exopy_hqc_legacy.tasks.tasks.util import array_tasks
+    monkeypatch.setattr(array_tasks, 'CHUNK_BYTES', chunk_bytes)
+    array = np.array([3., 1., 5., 5., 0., 2.])
+    results = reduce_array(array, [('', 'max', None), ('', 'argmax', None),
+                                   ('', 'min', None), ('', 'argmin', None),
+                                   ('', 'first', 2.), ('', 'nearest', 4.8)])
+    assert results == [5., 2, 0., 4, 5, 2]
+
+    sorted_array = np.arange(10.)
+    assert reduce_array(sorted_array, [('', 'nearest_sorted', 6.4),
+                                       ('', 'nearest_sorted', 6.6),
+                                       ('', 'nearest_sorted', -1),
+                                       ('', 'nearest_sorted', 20)]) == \
+        [6, 7, 0, 9]
+
+    with pytest.raises(ValueError):
+        reduce_array(array, [('', 'first', 7.)])
+
+
+def test_reduce_array_sorted():
+    """Test that the 'nearest_sorted' operations do not scan the array.
+
+    """
+    class TrackedArray(np.ndarray):
+        blocks = 0
+
+        def __getitem__(self, key):
+            if isinstance(key, slice):
+                TrackedArray.blocks += 1
+            return super(TrackedArray, self).__getitem__(key)
+
+    array = np.arange(100.).view(TrackedArray)
+    assert reduce_array(array, [('', 'nearest_sorted', 41.7)]) == [42]
+    assert TrackedArray.blocks == 0
+
+    assert reduce_array(array, [('', 'nearest', 41.7)]) == [42]
+    assert TrackedArray.blocks > 0
+
+
+@pytest.mark.ui
+def test_array_reduce_view(exopy_qtbot):
+    """Test the array reduce view.
+
+    """
+    root = RootTask(should_stop=Event(), should_pause=Event())
+    task = ArrayReduceTask(name='Test')
+    root.children.append(task)
+    task.operations = OrderedDict([('m', ('var1', 'max', '')), ('n', '')])
+
+    show_and_close_widget(exopy_qtbot, ArrayReduceView(task=task))
@@ -10,6 +10,8 @@
 
 """
 import os
+import shutil
+from collections import OrderedDict
 from multiprocessing import Event
 
 import pytest
@@ -18,8 +20,11 @@ import numpy as np
 
 from exopy.tasks.api import RootTask
 from exopy.testing.util import show_widget
+from exopy_hqc_legacy.tasks.tasks.util import load_tasks
 from exopy_hqc_legacy.tasks.tasks.util.load_tasks import (LoadArrayTask,
-                                                         CSVLoadInterface)
+                                                         CSVLoadInterface,
+                                                         CSVTail,
+                                                         H5PYLoadInterface)
 
 with enaml.imports():
     from exopy_hqc_legacy.tasks.tasks.util.views.load_views import LoadArrayView
@@ -98,6 +103,165 @@ def test_perform1(load_array_task, fake_data):
     np.testing.assert_array_equal(array, fake_data)
 
 
+def test_perform_cache(load_array_task, fake_data):
+    """Test that an unchanged file is not parsed again.
+
+    """
+    load_array_task.perform()
+    array = load_array_task.get_from_database('Test_array')
+    array['Freq'] = 1
+    load_array_task.perform()
+    np.testing.assert_array_equal(
+        load_array_task.get_from_database('Test_array'), fake_data)
+
+    full_path = os.path.join(load_array_task.folder, 'fake.dat')
+    with open(full_path, 'ab') as f:
+        f.write('1\t2\n'.encode('utf-8'))
+    load_array_task.perform()
+    array = load_array_task.get_from_database('Test_array')
+    assert len(array) == 6
+    assert tuple(array[-1]) == (1, 2)
+
+
+def test_perform_cache_bytes(load_array_task, fake_data, monkeypatch):
+    """Test that the cache does not keep more than CSV_CACHE_BYTES.
+
+    """
+    monkeypatch.setattr(load_tasks, 'CSV_CACHE_BYTES', fake_data.nbytes - 1)
+    monkeypatch.setattr(load_tasks, '_CSV_CACHE', OrderedDict())
+    load_array_task.perform()
+    assert not load_tasks._CSV_CACHE
+
+    monkeypatch.setattr(load_tasks, 'CSV_CACHE_BYTES', fake_data.nbytes)
+    load_array_task.perform()
+    assert len(load_tasks._CSV_CACHE) == 1
+
+    folder = load_array_task.folder
+    shutil.copy(os.path.join(folder, 'fake.dat'),
+                os.path.join(folder, 'copy.dat'))
+    load_array_task.filename = 'copy.dat'
+    load_array_task.perform()
+    assert [k[0] for k in load_tasks._CSV_CACHE] == [
+        os.path.join(folder, 'copy.dat')]
+
+
+def test_perform_no_names(load_array_task, fake_data):
+    """Test loading a csv file without using the names of the columns.
+
+    """
+    load_array_task.interface.names = False
+    load_array_task.perform()
+    array = load_array_task.get_from_database('Test_array')
+    assert array.shape == (6, 2)
+    assert np.isnan(array[0]).all()
+
+
+def test_perform_incremental(load_array_task, fake_data):
+    """Test reading only the lines appended to a csv file.
+
+    """
+    load_array_task.incremental = True
+    full_path = os.path.join(load_array_task.folder, 'fake.dat')
+    with open(full_path, 'ab') as f:
+        f.write('1\t2\n3\t'.encode('utf-8'))
+    load_array_task.perform()
+    array = load_array_task.get_from_database('Test_array')
+    assert len(array) == 6
+
+    with open(full_path, 'ab') as f:
+        f.write('4\n5\t6\n'.encode('utf-8'))
+    tail = load_array_task.interface._tails[full_path]
+    offset = tail.offset
+    load_array_task.perform()
+    array = load_array_task.get_from_database('Test_array')
+    assert array.dtype.names == ('Freq', 'Log')
+    np.testing.assert_array_equal(array['Freq'][5:], [1, 3, 5])
+    assert tail.offset == os.path.getsize(full_path) > offset
+
+
+def test_csv_tail_partial_first_row(tmpdir):
+    """Test that the dtype is not built from a partially written row.
+
+    """
+    full_path = str(tmpdir.join('partial.dat'))
+    with open(full_path, 'wb') as f:
+        f.write('# comment\n1\t2'.encode('utf-8'))
+    tail = CSVTail(full_path, names=False)
+    assert len(tail.read()) == 0
+    assert tail.offset == 0
+
+    with open(full_path, 'ab') as f:
+        f.write('\t3\n4\t5\t6\n'.encode('utf-8'))
+    np.testing.assert_array_equal(tail.read(), [[1, 2, 3], [4, 5, 6]])
+
+
+def test_perform_h5py_incremental(load_array_task):
+    """Test reading only the rows added to a HDF5 file.
+
+    """
+    import h5py
+    full_path = os.path.join(load_array_task.folder, 'fake.h5')
+    f = h5py.File(full_path, 'w', libver='latest')
+    f.create_dataset('Freq', data=np.arange(10.), maxshape=(None,))
+    f.attrs['count_calls'] = 4
+    f.swmr_mode = True
+
+    try:
+        load_array_task.filename = 'fake.h5'
+        load_array_task.incremental = True
+        load_array_task.interface = H5PYLoadInterface()
+        load_array_task.perform()
+        data = load_array_task.get_from_database('Test_array')
+        np.testing.assert_array_equal(data['Freq'], np.arange(4.))
+
+        f.attrs['count_calls'] = 6
+        f.flush()
+        load_array_task.perform()
+        data = load_array_task.get_from_database('Test_array')
+        assert isinstance(data['Freq'], np.ndarray)
+        np.testing.assert_array_equal(data['Freq'], np.arange(6.))
+    finally:
+        load_array_task.root.resources['files'].release()
+        f.close()
+
+
+def test_perform_h5py_lazy(load_array_task):
+    """Test lazily loading a HDF5 file which is still being written.
+
+    """
+    import h5py
+    full_path = os.path.join(load_array_task.folder, 'fake.h5')
+    f = h5py.File(full_path, 'w', libver='latest')
+    f.create_dataset('Freq', data=np.arange(10.), maxshape=(None,))
+    f.create_dataset('Amp', data=np.ones((10, 2)), maxshape=(None, 2))
+    f.attrs['count_calls'] = 4
+    f.swmr_mode = True
+
+    try:
+        load_array_task.filename = 'fake.h5'
+        load_array_task.interface = H5PYLoadInterface(lazy=True)
+        load_array_task.perform()
+        data = load_array_task.get_from_database('Test_array')
+        assert sorted(data) == ['Amp', 'Freq']
+        assert data['Amp'].shape == (4, 2)
+        assert data['Freq'][-1] == 3
+        np.testing.assert_array_equal(data['Freq'], np.arange(4.))
+
+        f.attrs['count_calls'] = 7
+        f.flush()
+        load_array_task.perform()
+        assert load_array_task.get_from_database('Test_array') is data
+        assert data['Freq'].shape == (7,)
+        np.testing.assert_array_equal(data['Freq'], np.arange(7.))
+        with pytest.raises(IndexError):
+            data['Freq'][7]
+    finally:
+        load_array_task.root.resources['files'].release()
+        f.close()
+
+    assert data.closed
+
+
 @pytest.mark.ui
 class TestLoadArrayView(object):
 
@@ -15,13 +15,16 @@ from collections import OrderedDict
 
 import pytest
 import enaml
+import h5py
 import numpy as np
 
 from exopy.tasks.api import RootTask
 from exopy.testing.util import (show_and_close_widget, show_widget)
+from exopy_hqc_legacy.utils.binary_records import load_records, to_text
 from exopy_hqc_legacy.tasks.tasks.util.save_tasks import (SaveTask,
                                                           SaveArrayTask,
-                                                          SaveFileTask)
+                                                          SaveFileTask,
+                                                          SaveFileHDF5Task)
 
 with enaml.imports():
     from exopy_hqc_legacy.tasks.tasks.util.views.save_views\
@@ -56,6 +59,10 @@ class TestSaveTask(object):
 
         assert self.task.get_from_database('Test_array') == np.array([1.0])
 
+        self.task.saving_target = 'Mmap'
+
+        assert self.task.get_from_database('Test_array') == np.array([1.0])
+
     def test_check1(self, tmpdir):
         """Test everything ok in file mode (no array size).
 
@@ -307,6 +314,82 @@ class TestSaveTask(object):
             assert a == ['test\n', '# test a\n', 'toto\ttata\n',
                          'a\t2.0\n', 'a\t2.0\n', 'a\t2.0\n']
 
+    @pytest.mark.parametrize('policy, period', [('Every N lines', '2'),
+                                                ('Every T seconds', '100'),
+                                                ('On close', '')])
+    def test_perform_flush_policy(self, tmpdir, policy, period):
+        """Test that the buffered lines are all written when the measure stops.
+
+        """
+        task = self.task
+        task.saving_target = 'File'
+        task.folder = str(tmpdir)
+        task.filename = 'test_flush.txt'
+        task.array_size = '10'
+        task.flush_policy = policy
+        task.flush_period = period or '1'
+        task.saved_values = OrderedDict([('toto', '{float}')])
+
+        file_path = os.path.join(str(tmpdir), 'test_flush.txt')
+
+        for i in range(3):
+            task.perform()
+
+        with open(file_path) as f:
+            a = f.readlines()
+        assert a == ['toto\n'] + ['2.0\n']*(2 if policy == 'Every N lines'
+                                             else 0)
+
+        # Simulate the end of the measure (the root releases the resources
+        # even when an error occured).
+        self.root.resources['files'].release()
+        with open(file_path) as f:
+            a = f.readlines()
+        assert a == ['toto\n'] + ['2.0\n']*3
+
+    def test_perform_mmap(self, tmpdir):
+        """Test performing in memory mapped mode.
+
+        """
+        task = self.task
+        task.saving_target = 'Mmap'
+        task.folder = str(tmpdir)
+        task.filename = 'test_mmap.npy'
+        task.array_size = '3'
+        task.saved_values = OrderedDict([('toto', '{int}'),
+                                         ('tat{str}', '{float}')])
+        file_path = os.path.join(str(tmpdir), 'test_mmap.npy')
+
+        for i in range(3):
+            task.perform()
+
+        assert not task.initialized
+        array = np.load(file_path)
+        assert array.dtype.names == ('toto', 'tata')
+        np.testing.assert_array_equal(array, task.array)
+        np.testing.assert_array_equal(array['tata'], [2.0]*3)
+
+    def test_perform_mmap_stopped(self, tmpdir):
+        """Test that the file is truncated when the measure stops early.
+
+        """
+        task = self.task
+        task.saving_target = 'Mmap'
+        task.folder = str(tmpdir)
+        task.filename = 'test_mmap.npy'
+        task.array_size = '1000'
+        task.saved_values = OrderedDict([('toto', '{int}')])
+        file_path = os.path.join(str(tmpdir), 'test_mmap.npy')
+
+        for i in range(3):
+            task.perform()
+
+        self.root.resources['files'].release()
+        array = np.load(file_path)
+        assert array.shape == (3,)
+        assert os.path.getsize(file_path) < 1000*8
+        assert len(task.get_from_database('Test_array')) == 3
+
     def test_perform2(self):
         """Test performing in array mode. (Call three times perform)
 
@@ -526,6 +609,211 @@ class TestSaveFileTask(object):
             task.file_object.close()
 
 
+    def test_perform_binary(self, tmpdir):
+        """Test performing in binary format and converting to text.
+
+        """
+        task = self.task
+        task.folder = str(tmpdir)
+        task.filename = 'test_perform.dat'
+        task.file_format = 'Binary'
+        task.header = 'test {float}'
+        task.saved_values = OrderedDict([('toto', '{float}'),
+                                         ('tata', '{array}')])
+        file_path = os.path.join(str(tmpdir), 'test_perform.dat')
+
+        try:
+            task.perform()
+            task.perform()
+        finally:
+            task.file_object.close()
+
+        records = load_records(file_path)
+        assert records.dtype.names == ('toto', 'tata')
+        np.testing.assert_array_equal(records['toto'], 2.0)
+        np.testing.assert_array_equal(records['tata'], list(range(10))*2)
+
+        with open(to_text(file_path)) as f:
+            a = f.readlines()
+        assert a[:2] == ['# test 2.0\n', 'toto\ttata\n']
+        assert float(a[12].split('\t')[1]) == 0.0
+
+    def test_perform_binary_flush_policy(self, tmpdir):
+        """Test that the records are buffered according to the flush policy.
+
+        """
+        task = self.task
+        task.folder = str(tmpdir)
+        task.filename = 'test_flush.dat'
+        task.file_format = 'Binary'
+        task.flush_policy = 'Every N lines'
+        task.flush_period = '2'
+        task.saved_values = OrderedDict([('toto', '{float}')])
+        file_path = os.path.join(str(tmpdir), 'test_flush.dat')
+
+        task.perform()
+        header_size = os.path.getsize(file_path)
+        task.perform()
+        assert os.path.getsize(file_path) == header_size + 16
+        task.perform()
+        assert os.path.getsize(file_path) == header_size + 16
+
+        self.root.resources['files'].release()
+        np.testing.assert_array_equal(load_records(file_path)['toto'],
+                                      [2.0]*3)
+
+    def test_perform_binary_types(self, tmpdir):
+        """Test that the scalar columns are not typed from the first value
+        and that the values which do not fit are refused.
+
+        """
+        task = self.task
+        task.folder = str(tmpdir)
+        task.filename = 'test_types.dat'
+        task.file_format = 'Binary'
+        task.saved_values = OrderedDict([('toto', '{int}')])
+        file_path = os.path.join(str(tmpdir), 'test_types.dat')
+
+        try:
+            task.perform()
+            self.root.write_in_database('int', 2.5)
+            task.perform()
+            self.root.write_in_database('int', True)
+            task.perform()
+            self.root.write_in_database('int', 1j)
+            with pytest.raises(ValueError):
+                task.perform()
+        finally:
+            task.file_object.close()
+
+        records = load_records(file_path)
+        assert records.dtype['toto'] == np.dtype('f8')
+        np.testing.assert_array_equal(records['toto'], [1, 2.5, 1])
+
+        self.root.write_in_database('int', 'a')
+        task.initialized = False
+        try:
+            with pytest.raises(ValueError):
+                task.perform()
+        finally:
+            task.file_object.close()
+
+
+class TestSaveFileHDF5Task(object):
+
+    def setup(self):
+        self.root = RootTask(should_stop=Event(), should_pause=Event())
+        self.task = SaveFileHDF5Task(name='Test')
+        self.root.add_child_task(0, self.task)
+
+        self.root.write_in_database('float', 2.0)
+        self.root.write_in_database('array', np.array(range(10)))
+
+    def test_perform(self, tmpdir):
+        """Test that the staged data are all written when closing.
+
+        """
+        task = self.task
+        task.folder = str(tmpdir)
+        task.filename = 'test_perform.h5'
+        task.saved_values = OrderedDict([('toto', '{float}'),
+                                         ('tata', '{array}')])
+        task.calls_estimation = '2'
+        task.buffer_rows = '2'
+        task.flush_interval = '100'
+        file_path = os.path.join(str(tmpdir), 'test_perform.h5')
+
+        try:
+            for i in range(5):
+                task.perform()
+        finally:
+            task.file_object.close()
+
+        with h5py.File(file_path, 'r') as f:
+            assert f.attrs['count_calls'] == 5
+            np.testing.assert_array_equal(f['toto'][:], [2.0]*5)
+            assert f['tata'].shape == (5, 10)
+            np.testing.assert_array_equal(f['tata'][4], range(10))
+
+    @pytest.mark.parametrize('interval', ['0', '-1'])
+    def test_check_flush_interval(self, tmpdir, interval):
+        """Test that a non positive flush interval is rejected.
+
+        """
+        task = self.task
+        task.folder = str(tmpdir)
+        task.filename = 'test_check.h5'
+        task.saved_values = OrderedDict([('toto', '{float}')])
+        task.flush_interval = interval
+
+        test, traceback = task.check()
+        assert not test
+        assert 'root/Test-flush_interval' in traceback
+
+    @pytest.mark.parametrize('interval', ['0', '-1'])
+    def test_perform_no_interval(self, tmpdir, interval):
+        """Test that a non positive interval only disables the time based
+        writes.
+
+        """
+        task = self.task
+        task.folder = str(tmpdir)
+        task.filename = 'test_interval.h5'
+        task.saved_values = OrderedDict([('toto', '{float}')])
+        task.buffer_rows = '2'
+        task.flush_interval = interval
+        file_path = os.path.join(str(tmpdir), 'test_interval.h5')
+
+        try:
+            for i in range(5):
+                task.perform()
+            writer = task.file_object.writer
+            assert writer.interval is None
+            assert writer._thread.is_alive()
+        finally:
+            task.file_object.close()
+
+        assert writer._error is None
+        with h5py.File(file_path, 'r') as f:
+            assert f.attrs['count_calls'] == 5
+
+    def test_perform_chunks(self, tmpdir):
+        """Test the chunks and filters of the datasets.
+
+        """
+        task = self.task
+        task.folder = str(tmpdir)
+        task.filename = 'test_chunks.h5'
+        task.saved_values = OrderedDict([('toto', '{float}'),
+                                         ('tata', '{array}')])
+        task.compression = 'lzf'
+        task.shuffle = True
+        task.buffer_rows = '50'
+        file_path = os.path.join(str(tmpdir), 'test_chunks.h5')
+
+        try:
+            for i in range(3):
+                task.perform()
+        finally:
+            task.file_object.close()
+
+        with h5py.File(file_path, 'r') as f:
+            assert f['toto'].chunks == (50,)
+            assert f['tata'].chunks == (50, 10)
+            assert f['tata'].compression == 'lzf' and f['tata'].shuffle
+            assert f['toto'].shape == (3,)
+
+        task.chunk_calls = '7'
+        task.initialized = False
+        try:
+            task.perform()
+        finally:
+            task.file_object.close()
+
+        with h5py.File(file_path, 'r') as f:
+            assert f['tata'].chunks == (7, 10)
+
+
 class TestSaveArrayTask(object):
 
     def setup(self):
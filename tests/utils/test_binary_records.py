@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Test the binary records files.
+
+"""
+import os
+
+import numpy as np
+import pytest
+
+from exopy_hqc_legacy.utils.binary_records import (write_header, read_header,
+                                                   load_records, to_text,
+                                                   ALIGNMENT)
+
+DTYPE = np.dtype([('toto', 'f8'), ('tata', 'i8'), ('titi', 'c16')])
+
+
+@pytest.fixture
+def records_file(tmpdir):
+    """File containing 10 records followed by an incomplete one.
+
+    """
+    path = os.path.join(str(tmpdir), 'test.dat')
+    records = np.zeros(10, DTYPE)
+    records['toto'] = 2.0
+    records['tata'] = range(10)
+    records['titi'] = 1j
+    with open(path, 'wb') as f:
+        write_header(f, DTYPE, 'test 2.0\nsecond line')
+        f.write(records.data)
+        f.write(b'\x00'*5)
+    return path
+
+
+def test_header(records_file):
+    """Test reading the header and the alignment of the records.
+
+    """
+    with open(records_file, 'rb') as f:
+        dtype, header, offset = read_header(f)
+    assert dtype == DTYPE
+    assert header == 'test 2.0\nsecond line'
+    assert offset % ALIGNMENT == 0
+
+
+def test_header_invalid(tmpdir):
+    """Test reading a file which is not a binary records file.
+
+    """
+    path = os.path.join(str(tmpdir), 'test.txt')
+    with open(path, 'wb') as f:
+        f.write(b'toto\ttata\n')
+    with open(path, 'rb') as f, pytest.raises(ValueError):
+        read_header(f)
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_load_records(records_file, mmap):
+    """Test loading the complete records.
+
+    """
+    records = load_records(records_file, mmap)
+    assert len(records) == 10
+    np.testing.assert_array_equal(records['tata'], range(10))
+    np.testing.assert_array_equal(records['titi'], 1j)
+
+
+def test_to_text(records_file):
+    """Test converting to the text layout of SaveFileTask.
+
+    """
+    path = to_text(records_file)
+    assert path.endswith('test.txt')
+    with open(path) as f:
+        lines = f.readlines()
+    assert lines[:3] == ['# test 2.0\n', '# second line\n',
+                         'toto\ttata\ttiti\n']
+    assert len(lines) == 13
+    values = lines[4].split('\t')
+    assert [float(v) for v in values[:2]] == [2.0, 1.0]
+    assert complex(values[2]) == 1j
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright 2015-2018 by ExopyHqcLegacy Authors, see AUTHORS for more details.
+#
+# Distributed under the terms of the BSD license.
+#
+# The full license is in the file LICENCE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Test the demodulation tools.
+
+"""
+import numpy as np
+
+from exopy_hqc_legacy.utils.demodulation import (demodulation_kernel,
+                                                 demodulate,
+                                                 demodulate_periods)
+
+FREQ = 50e6
+
+RATE = 500e6
+
+
+def reference(records, nsamples):
+    """Quadratures computed without any optimization.
+
+    """
+    phi = np.linspace(0, 2*np.pi*FREQ*(nsamples-1)/RATE, nsamples)
+    records = records[..., :nsamples]
+    return (2*np.mean(records*np.cos(phi), axis=-1) +
+            2j*np.mean(records*np.sin(phi), axis=-1))
+
+
+def test_kernel_cache():
+    """Test that kernels are cached and read-only.
+
+    """
+    demodulation_kernel.cache_clear()
+    kernel = demodulation_kernel(FREQ, RATE, 100)
+    assert demodulation_kernel(FREQ, RATE, 100) is kernel
+    assert demodulation_kernel(FREQ, 2*RATE, 100) is not kernel
+    info = demodulation_kernel.cache_info()
+    assert info.hits == 1 and info.misses == 2
+    assert not kernel.flags.writeable
+
+
+def test_demodulate():
+    """Test demodulating records by chunks with several loops.
+
+    """
+    records = np.random.normal(size=(30, 105))
+    kernel = demodulation_kernel(FREQ, RATE, 100)
+    res = demodulate(records, kernel, num_loop=3, chunk_size=7)
+    assert res.shape == (10, 3)
+    np.testing.assert_allclose(res.ravel(), reference(records, 100))
+
+
+def test_demodulate_integers():
+    """Test demodulating raw integer records.
+
+    """
+    records = np.random.randint(-2**15, 2**15, (10, 100)).astype(np.int16)
+    kernel = demodulation_kernel(FREQ, RATE, 100)
+    np.testing.assert_allclose(demodulate(records, kernel).ravel(),
+                               reference(records.astype(float), 100))
+
+
+def test_demodulate_periods():
+    """Test demodulating each period of the records.
+
+    """
+    records = np.random.normal(size=(12, 105))
+    kernel = demodulation_kernel(FREQ, RATE, 100)
+    res = demodulate_periods(records, kernel, 10, num_loop=2, chunk_size=5)
+    assert res.shape == (6, 2, 10)
+    expected = [reference(records[:, i*10:(i+1)*10], 10) for i in range(10)]
+    np.testing.assert_allclose(res.reshape(12, 10),
+                               np.array(expected).T)